@@ -94,6 +94,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'restui.middleware.RequestMemoisationMiddleware',
 ]
 
 if DEBUG is True:
@@ -202,6 +203,106 @@ TARK_SERVER = "http://tark.ensembl.org"
 # Ensembl REST server
 ENSEMBL_REST_SERVER = "http://rest.ensembl.org"
 
+# Number of IDs per POST to the Ensembl REST batch endpoints (their limits)
+ENSEMBL_REST_SEQUENCE_BATCH = 50
+ENSEMBL_REST_LOOKUP_BATCH = 1000
+
+# The current Ensembl release is cached for ENSEMBL_RELEASE_TTL seconds. It is
+# asked to the Ensembl REST server, or taken from the latest Ensembl species
+# history loaded with ENSEMBL_RELEASE_FROM_DATABASE
+ENSEMBL_RELEASE_TTL = 6 * 3600
+ENSEMBL_RELEASE_FROM_DATABASE = False
+
+# Calls to the external services (see restui.lib.http_client): connect and
+# read timeouts in seconds, retries of failed connections and transient
+# server errors (the n-th retry waits EXTERNAL_HTTP_BACKOFF * 2^(n-1)
+# seconds) and keep-alive connections kept per host
+EXTERNAL_HTTP_CONNECT_TIMEOUT = 3.05
+EXTERNAL_HTTP_READ_TIMEOUT = 10
+EXTERNAL_HTTP_RETRIES = 2
+EXTERNAL_HTTP_BACKOFF = 0.3
+EXTERNAL_HTTP_POOL_SIZE = 10
+
+# The mapping detail fetches the transcript sequence from Ensembl on a pool of
+# threads while it reads the database, and gives up on it (sequence null)
+# after this many seconds
+ENSEMBL_SEQUENCE_TIMEOUT = 5
+ENSEMBL_SEQUENCE_WORKERS = 8
+
+# Ensembl sequences and translations are cached by stable id and release in
+# this SQLite file (None to disable), keeping at most that many entries
+SEQUENCE_CACHE_PATH = os.path.join(BASE_DIR, 'sequence_cache.sqlite3')
+SEQUENCE_CACHE_MAX_ENTRIES = 500000
+
+# Where the Ensembl sequences and translations come from: 'rest' (the Ensembl
+# REST servers, through the sequence cache) or 'fasta' (the uncompressed
+# peptide FASTA files of each release, in SEQUENCE_FASTA_DIRECTORY/<release>/,
+# e.g. Homo_sapiens.GRCh38.pep.all.fa). The FASTA files only have peptides,
+# the sequence of a transcript is then the peptide it translates to.
+# The index of each FASTA file is written next to it, or in
+# SEQUENCE_FASTA_INDEX_DIRECTORY/<release>/ when set (e.g. when the FASTA
+# directory isn't writable by the web user).
+SEQUENCE_PROVIDER = 'rest'
+SEQUENCE_FASTA_DIRECTORY = os.path.join(BASE_DIR, 'fasta')
+SEQUENCE_FASTA_INDEX_DIRECTORY = None
+
+# Maximum number of mappings the mappings/details/ endpoint gives at once
+MAPPING_DETAILS_MAX_IDS = 500
+
+# Maximum number of mappings the mappings/pairwise/ endpoint aligns at once,
+# and number of processes reconstructing their alignments (0: none, they are
+# reconstructed by the process serving the request). The processes are forked
+# from the web worker serving the first batch: only set it with single
+# threaded workers (e.g. gunicorn sync workers)
+MAPPING_PAIRWISE_MAX_IDS = 100
+PAIRWISE_WORKERS = 0
+
+# Caches
+# 'facets' holds the search facets, keyed by normalised search and by the
+# generation bumped when the statuses change or a release is loaded.
+# 'details' holds the mapping and unmapped entry details, dropped by the views
+# writing to an entry.
+# 'default' holds the generations of the species names and controlled
+# vocabularies each worker keeps in memory, and the current Ensembl release.
+# These three are kept in redis, shared by the web workers and the celery
+# processes for the invalidations to reach them all. They use the celery
+# broker, unless secrets has a CACHE_REDIS_URL.
+CACHE_REDIS_URL = getattr(secrets, 'CACHE_REDIS_URL', secrets.BROKER_URL)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': CACHE_REDIS_URL,
+        'KEY_PREFIX': 'default'
+    },
+    'facets': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': CACHE_REDIS_URL,
+        'KEY_PREFIX': 'facets',
+        'TIMEOUT': 3600
+    },
+    'details': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': CACHE_REDIS_URL,
+        'KEY_PREFIX': 'details',
+        'TIMEOUT': 3600
+    },
+    # the reconstructed pairwise alignments, keyed by their cigar/mdz, never
+    # go stale and so never expire
+    'alignments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'alignments',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000
+        }
+    }
+}
+
+# Load the controlled vocabularies (cv_* tables) on the first request of each
+# process
+VOCABULARY_WARM_UP = True
+
 # CELERY STUFF
 BROKER_URL = secrets.BROKER_URL
 CELERY_RESULT_BACKEND = secrets.CELERY_RESULT_BACKEND
@@ -32,6 +32,17 @@ class UnManagedModelTestRunner(DiscoverRunner):
 
         super(UnManagedModelTestRunner, self).setup_test_environment(*args, **kwargs)
 
+    def setup_databases(self, *args, **kwargs):
+        old_config = super(UnManagedModelTestRunner, self).setup_databases(*args, **kwargs)
+
+        # the fuzzy mappings search needs the trigram functions and operators
+        from django.db import connections
+        for alias in connections:
+            with connections[alias].cursor() as cursor:
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+        return old_config
+
     def teardown_test_environment(self, *args, **kwargs):
         super(UnManagedModelTestRunner, self).teardown_test_environment(*args, **kwargs)
         # reset unmanaged models
@@ -40,6 +51,30 @@ class UnManagedModelTestRunner(DiscoverRunner):
 
 
 DATABASE_ROUTERS = []
+
+# the tests load the vocabularies on first use, from their fixtures
+VOCABULARY_WARM_UP = False
+
+# the alignments are reconstructed in the test process, where the mocks are
+PAIRWISE_WORKERS = 0
+
+# the tests use their own sequence store
+SEQUENCE_CACHE_PATH = None
+
+# no redis in the tests, and the caches would outlive the test transactions
+CACHES['default'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+}
+CACHES['facets'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'facets',
+}
+CACHES['details'] = {
+    'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+}
+CACHES['alignments'] = {
+    'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+}
 #
 # # Skip the migrations by setting "MIGRATION_MODULES"
 # # to the DisableMigrations class defined above
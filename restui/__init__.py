@@ -14,3 +14,5 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+
+default_app_config = 'restui.apps.RestuiConfig'
@@ -16,6 +16,8 @@
 """
 
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.signals import request_started
 
 
 class RestuiConfig(AppConfig):
@@ -23,3 +25,12 @@ class RestuiConfig(AppConfig):
     Register the name of the application
     """
     name = 'restui'
+
+    def ready(self):
+        # connects the signals refreshing the vocabularies and the species
+        # names, in every process (e.g. the celery worker loading the releases)
+        from restui.lib import species  # pylint: disable=unused-import
+        from restui.lib import vocabulary
+
+        if getattr(settings, 'VOCABULARY_WARM_UP', True):
+            request_started.connect(vocabulary.warm_up)
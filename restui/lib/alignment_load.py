@@ -0,0 +1,298 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+"""
+Bulk load of alignments, with their cigar/mdz, from NDJSON or TSV records.
+
+The records are streamed with COPY into a temporary staging table, then
+merged into alignment and ensp_u_cigar with INSERT ... ON CONFLICT: as
+AlignmentCreate does, an alignment already loaded for a run and mapping is
+kept, and so is the cigar/mdz of an alignment.
+
+Needs the unique indexes of schema/schema.sql, see
+schema/patches/alignment_bulk_load_unique_indexes.sql for existing databases
+"""
+
+import csv
+import json
+from collections import OrderedDict
+
+import psycopg2
+from django.db import DatabaseError
+from django.db import connections
+from django.db import router
+from django.db import transaction
+from restui.models.mappings import Alignment
+
+
+def _boolean(value):
+    if isinstance(value, bool):
+        return value
+
+    if str(value).lower() in ('true', 't', '1'):
+        return True
+    if str(value).lower() in ('false', 'f', '0'):
+        return False
+
+    raise ValueError("invalid boolean {}".format(value))
+
+
+# the fields of a record, with the staging table column and the parser of
+# each (both NDJSON values and TSV strings)
+FIELDS = OrderedDict([
+    ('alignment_run', ('alignment_run_id', int)),
+    ('mapping', ('mapping_id', int)),
+    ('uniprot_id', ('uniprot_id', int)),
+    ('transcript', ('transcript_id', int)),
+    ('score1', ('score1', float)),
+    ('report', ('report', str)),
+    ('is_current', ('is_current', _boolean)),
+    ('score2', ('score2', float)),
+    ('cigarplus', ('cigarplus', str)),
+    ('mdz', ('mdz', str))
+])
+
+# the fields the alignments are de-duplicated on
+REQUIRED_FIELDS = ('alignment_run', 'mapping')
+
+STAGING_TABLE = """
+CREATE TEMPORARY TABLE alignment_staging (
+    line bigint NOT NULL,
+    alignment_run_id bigint NOT NULL,
+    mapping_id bigint NOT NULL,
+    uniprot_id bigint,
+    transcript_id bigint,
+    score1 double precision,
+    report character varying(300),
+    is_current boolean,
+    score2 double precision,
+    cigarplus text,
+    mdz text
+) ON COMMIT DROP
+"""
+
+# the first record of each run and mapping, unless already loaded
+MERGE_ALIGNMENTS = """
+INSERT INTO alignment (
+    alignment_run_id, mapping_id, uniprot_id, transcript_id,
+    score1, report, is_current, score2
+)
+SELECT DISTINCT ON (alignment_run_id, mapping_id)
+    alignment_run_id, mapping_id, uniprot_id, transcript_id,
+    score1, report, is_current, score2
+FROM alignment_staging
+ORDER BY alignment_run_id, mapping_id, line
+ON CONFLICT (alignment_run_id, mapping_id) DO NOTHING
+"""
+
+# the first cigar/mdz of each run and mapping, unless the alignment has one
+MERGE_CIGARS = """
+INSERT INTO ensp_u_cigar (alignment_id, cigarplus, mdz)
+SELECT a.alignment_id, s.cigarplus, s.mdz
+FROM (
+    SELECT DISTINCT ON (alignment_run_id, mapping_id)
+        alignment_run_id, mapping_id, cigarplus, mdz
+    FROM alignment_staging
+    WHERE cigarplus IS NOT NULL
+    ORDER BY alignment_run_id, mapping_id, line
+) AS s
+JOIN alignment AS a
+    ON a.alignment_run_id = s.alignment_run_id AND a.mapping_id = s.mapping_id
+ON CONFLICT (alignment_id) DO NOTHING
+"""
+
+
+def ndjson_records(lines):
+    """
+    Yield the line number and record of each JSON object line
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise ValueError("Line {}: invalid JSON".format(number))
+
+        if not isinstance(record, dict):
+            raise ValueError("Line {}: not a JSON object".format(number))
+
+        yield number, record
+
+
+def tsv_records(lines):
+    """
+    Yield the line number and record of each line after the header, which
+    names the fields of the columns, empty values being null
+    """
+    reader = csv.reader(lines, delimiter='\t')
+
+    header = next(reader, None)
+    if header is None:
+        return
+
+    for number, row in enumerate(reader, 2):
+        if not row:
+            continue
+
+        if len(row) != len(header):
+            raise ValueError("Line {}: {} columns, expected {}".format(
+                number,
+                len(row),
+                len(header)
+            ))
+
+        yield number, {
+            field: value if value != '' else None
+            for field, value in zip(header, row)
+        }
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+
+    return str(value).replace(
+        '\\', '\\\\'
+    ).replace(
+        '\t', '\\t'
+    ).replace(
+        '\n', '\\n'
+    ).replace(
+        '\r', '\\r'
+    )
+
+
+def _copy_lines(records):
+    """
+    Yield the COPY text format line of each record, with its line number
+    """
+    for number, record in records:
+        unknown = set(record) - set(FIELDS)
+        if unknown:
+            raise ValueError("Line {}: unknown fields {}".format(
+                number,
+                ', '.join(sorted(unknown))
+            ))
+
+        values = [number]
+        for field, (_, parse) in FIELDS.items():
+            value = record.get(field)
+            if value is None:
+                if field in REQUIRED_FIELDS:
+                    raise ValueError("Line {}: {} is required".format(number, field))
+            else:
+                try:
+                    value = parse(value)
+                except (TypeError, ValueError):
+                    raise ValueError("Line {}: invalid {} {}".format(number, field, value))
+
+            values.append(value)
+
+        yield '\t'.join(_copy_value(value) for value in values) + '\n'
+
+
+class CopyStream(object):
+    """
+    File-like object COPY reads the records from, encoded as they are read.
+
+    An invalid record fails the COPY, the error is kept for the caller.
+    """
+
+    def __init__(self, records):
+        self.lines = _copy_lines(records)
+        self.buffer = ''
+        self.error = None
+
+    def read(self, size=-1):
+        try:
+            while size < 0 or len(self.buffer) < size:
+                line = next(self.lines, None)
+                if line is None:
+                    break
+                self.buffer += line
+        except ValueError as e:
+            self.error = e
+            raise
+
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return data
+
+
+def load_alignments(records):
+    """
+    Load alignments, and their cigar/mdz, in one transaction
+
+    Parameters
+    ----------
+    records : iterable
+        (line number, record) of each alignment, see ndjson_records and
+        tsv_records. The fields of a record are those of FIELDS,
+        alignment_run and mapping being required.
+
+    Returns
+    -------
+    dict
+        received: number of records, alignments: number of alignments
+        inserted, cigars: number of cigars inserted
+
+    Raises
+    ------
+    ValueError
+        When a record is invalid, or couldn't be loaded (e.g. unknown alignment
+        run or mapping), nothing is loaded then
+    """
+    stream = CopyStream(records)
+    db = router.db_for_write(Alignment)
+
+    try:
+        with transaction.atomic(using=db), connections[db].cursor() as cursor:
+            cursor.execute(STAGING_TABLE)
+            cursor.copy_expert(
+                "COPY alignment_staging (line, {}) FROM STDIN".format(
+                    ', '.join(column for column, _ in FIELDS.values())
+                ),
+                stream
+            )
+
+            cursor.execute("SELECT count(*) FROM alignment_staging")
+            received = cursor.fetchone()[0]
+
+            cursor.execute(MERGE_ALIGNMENTS)
+            alignments = cursor.rowcount
+
+            cursor.execute(MERGE_CIGARS)
+            cigars = cursor.rowcount
+
+            # dropped on commit, but the transaction may be nested
+            cursor.execute("DROP TABLE alignment_staging")
+    except (DatabaseError, psycopg2.Error) as e:
+        raise ValueError(stream.error or str(e).strip())
+
+    return {
+        'received': received,
+        'alignments': alignments,
+        'cigars': cigars
+    }
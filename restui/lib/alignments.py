@@ -15,10 +15,36 @@
    limitations under the License.
 """
 
+import logging
+import re
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
 from sam_alignment_reconstructor.pairwise import pairwise_alignment
 from sam_alignment_reconstructor.pairwise import cigar_split
+from restui.lib.cache import ALIGNMENTS_CACHE
+from restui.lib.cache import alignment_cache_key
+from restui.lib.cache import cached_alignment
 from restui.lib.external import ensembl_sequence
+from restui.lib.external import ensembl_sequences
 from restui.lib.external import ensembl_protein
+from restui.lib.external import ensembl_proteins
+
+# the cigar operations counted as differences
+DIFFERENCE_OPS = np.frombuffer(b'IDX', dtype=np.uint8)
+
+_CIGAR_COUNT_RE = re.compile(r'\d+')
+
+# processes reconstructing the alignments of the batch requests, the
+# reconstruction being CPU bound (see PAIRWISE_WORKERS in the settings)
+_reconstruct_executor = None
+_reconstruct_executor_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
 
 
 def fetch_pairwise(mapping):
@@ -38,16 +64,132 @@ def fetch_pairwise(mapping):
             List of the alignments and the matching strings
     """
 
-    pairwise_alignments = []
-
     enst = mapping.transcript.enst_id
     uniprot_id = mapping.uniprot.uniprot_acc
 
+    return {
+        'mapping_id': mapping.mapping_id,
+        'alignments': [
+            _fetch_alignment(alignment, enst, uniprot_id)
+            for alignment in _pairwise_alignments(mapping)
+        ]
+    }
+
+
+def fetch_pairwise_many(mappings):
+    """
+    Fetch the pairwise sequence alignments of many mappings at once, as
+    fetch_pairwise does for one.
+
+    The alignments not cached yet have their sequences fetched in one batch
+    per Ensembl release and are reconstructed on a pool of processes.
+    Alignments whose sequence Ensembl doesn't know are left out.
+
+    Parameters
+    ----------
+    mappings : iterable of Mapping
+        With their transcript, uniprot entry and alignments, with their run
+        and pairwise row, loaded
+
+    Returns
+    -------
+    list of dict
+        One per mapping, as returned by fetch_pairwise
+    """
+    cache = caches[ALIGNMENTS_CACHE]
+    mappings = list(mappings)
+
+    # mapping, alignment, cigarplus, mdz and cache key of each alignment
+    selected = []
+    for mapping in mappings:
+        for alignment in _pairwise_alignments(mapping):
+            cigarplus = mdz = None
+            if alignment.alignment_run.score1_type == 'identity':
+                cigarplus = alignment.pairwise.cigarplus
+                mdz = alignment.pairwise.mdz
+
+            selected.append((
+                mapping,
+                alignment,
+                cigarplus,
+                mdz,
+                alignment_cache_key(alignment.alignment_id, cigarplus, mdz)
+            ))
+
+    cached = cache.get_many([key for _, _, _, _, key in selected])
+    missing = [entry for entry in selected if entry[4] not in cached]
+
+    # the sequences of the missing alignments, one batch per release
+    transcripts = defaultdict(set)
+    for mapping, alignment, _, _, _ in missing:
+        transcripts[alignment.alignment_run.ensembl_release].add(
+            mapping.transcript.enst_id
+        )
+
+    translations = {}
+    sequences = {}
+    for release, enst_ids in transcripts.items():
+        release_translations = ensembl_proteins(enst_ids, release)
+        release_sequences = ensembl_sequences(set(release_translations.values()), release)
+
+        for enst_id, ensp in release_translations.items():
+            translations[(enst_id, release)] = ensp
+            if ensp in release_sequences:
+                sequences[(ensp, release)] = release_sequences[ensp]
+
+    built = []
+    reconstructions = []
+    for mapping, alignment, cigarplus, mdz, key in missing:
+        release = alignment.alignment_run.ensembl_release
+        ensp = translations.get((mapping.transcript.enst_id, release))
+        seq = sequences.get((ensp, release))
+        if seq is None:
+            logger.warning(
+                "Couldn't find the sequence of %s in release %s",
+                mapping.transcript.enst_id,
+                release
+            )
+            continue
+
+        built.append((mapping, alignment, key, ensp, seq))
+        reconstructions.append(
+            (seq, cigarplus, mdz) if alignment.alignment_run.score1_type == 'identity' else None
+        )
+
+    reconstructed = _reconstruct_many(reconstructions)
+
+    fetched = {}
+    for (mapping, alignment, key, ensp, seq), aligned in zip(built, reconstructed):
+        fetched[key] = _pairwise_result(
+            alignment, ensp, mapping.uniprot.uniprot_acc, seq, aligned
+        )
+    cache.set_many(fetched)
+    cached.update(fetched)
+
+    alignments = defaultdict(list)
+    for mapping, _, _, _, key in selected:
+        if key in cached:
+            alignments[mapping.mapping_id].append(cached[key])
+
+    return [
+        {
+            'mapping_id': mapping.mapping_id,
+            'alignments': alignments[mapping.mapping_id]
+        }
+        for mapping in mappings
+    ]
+
+
+def _pairwise_alignments(mapping):
+    """
+    Select the alignments of a mapping shown pairwise: the first identity
+    alignment, preceded by the perfect matches found before it
+    """
+    pairwise_alignments = []
+
     for alignment in mapping.alignments.all():
         if alignment.alignment_run.score1_type == 'identity':
-            pairwise_alignments.append(
-                _fetch_alignment(alignment, enst, uniprot_id)
-            )
+            pairwise_alignments.append(alignment)
 
             # Break out of the loop, we're done
             break
@@ -56,23 +198,53 @@ def fetch_pairwise(mapping):
                 alignment.alignment_run.score1_type == 'perfect_match' and
                 alignment.score1 == 1
         ):
-            pairwise_alignments.append(
-                _fetch_alignment(alignment, enst, uniprot_id)
-            )
+            pairwise_alignments.append(alignment)
 
-    return {
-        'mapping_id': mapping.mapping_id,
-        'alignments': pairwise_alignments
-    }
+    return pairwise_alignments
 
 
 def _fetch_alignment(alignment, enst, uniprot_id):
     """
+    Return the pairwise alignment from the alignments cache, reconstructing
+    it only the first time it is asked for with its current cigar/mdz
+
+    Parameters
+    ----------
+    alignment
+    enst       : str
+    uniprot_id : str
+
+    Returns
+    -------
+    pw_alignment : dict
+        Alignment object
+    """
+    cigarplus = mdz = None
+    if alignment.alignment_run.score1_type == 'identity':
+        cigarplus = alignment.pairwise.cigarplus
+        mdz = alignment.pairwise.mdz
+
+    return cached_alignment(
+        alignment.alignment_id,
+        cigarplus,
+        mdz,
+        lambda: _build_alignment(alignment, enst, uniprot_id, cigarplus, mdz)
+    )
+
+
+def _build_alignment(alignment, enst, uniprot_id, cigarplus, mdz):
+    """
+    Fetch the sequence of the alignment and reconstruct the pairwise
+    alignment from its cigar/mdz, if any
+
     Parameters
     ----------
     alignment
     enst       : str
     uniprot_id : str
+    cigarplus  : str
+        None for the perfect matches
+    mdz        : str
 
     Returns
     -------
@@ -84,20 +256,94 @@ def _fetch_alignment(alignment, enst, uniprot_id):
     ensp = ensembl_protein(enst, ens_release)
     seq = ensembl_sequence(ensp, ens_release)
 
+    aligned = None
+    if alignment.alignment_run.score1_type == 'identity':
+        aligned = _reconstruct(seq, cigarplus, mdz)
+
+    return _pairwise_result(alignment, ensp, uniprot_id, seq, aligned)
+
+
+def _reconstruct(seq, cigarplus, mdz):
+    """
+    Reconstruct the alignment of a sequence from its cigar/mdz
+
+    Returns
+    -------
+    tuple
+        uniprot sequence, match string and ensembl sequence, aligned
+    """
+    if mdz.startswith('MD:Z:'):
+        mdz = mdz[len('MD:Z:'):]
+
+    return pairwise_alignment(seq, cigarplus, mdz)
+
+
+def _reconstruct_many(reconstructions):
+    """
+    Reconstruct many alignments, see _reconstruct, on the pool of processes
+    when there are several (PAIRWISE_WORKERS, 0 to reconstruct them in this
+    process)
+
+    Parameters
+    ----------
+    reconstructions : list
+        (seq, cigarplus, mdz) of each alignment, None for the perfect matches
+
+    Returns
+    -------
+    list
+        The aligned sequences of each alignment, None for the perfect matches
+    """
+    global _reconstruct_executor  # pylint: disable=global-statement
+
+    arguments = [arguments for arguments in reconstructions if arguments is not None]
+
+    if len(arguments) > 1 and settings.PAIRWISE_WORKERS:
+        if _reconstruct_executor is None:
+            with _reconstruct_executor_lock:
+                if _reconstruct_executor is None:
+                    _reconstruct_executor = ProcessPoolExecutor(
+                        max_workers=settings.PAIRWISE_WORKERS
+                    )
+
+        aligned = iter(_reconstruct_executor.map(_reconstruct, *zip(*arguments)))
+    else:
+        aligned = iter([_reconstruct(*args) for args in arguments])
+
+    return [
+        next(aligned) if arguments is not None else None
+        for arguments in reconstructions
+    ]
+
+
+def _pairwise_result(alignment, ensp, uniprot_id, seq, aligned=None):
+    """
+    Build the pairwise alignment object of an alignment
+
+    Parameters
+    ----------
+    alignment
+    ensp       : str
+    uniprot_id : str
+    seq        : str
+        The ensembl sequence
+    aligned    : tuple
+        The reconstructed alignment (see _reconstruct), None for the perfect
+        matches
+
+    Returns
+    -------
+    pw_alignment : dict
+        Alignment object
+    """
     ensembl_seq = seq
     uniprot_seq = seq
 
     match_str = '|' * len(seq)
     alignment_type = 'perfect_match'
 
-    if alignment.alignment_run.score1_type == 'identity':
-        cigarplus = alignment.pairwise.cigarplus
-        mdz = alignment.pairwise.mdz
-
-        if mdz.startswith('MD:Z:'):
-            mdz = mdz[len('MD:Z:'):]
-
-        uniprot_seq, match_str, ensembl_seq = pairwise_alignment(seq, cigarplus, mdz)
+    if aligned is not None:
+        uniprot_seq, match_str, ensembl_seq = aligned
 
         alignment_type = 'identity'
 
@@ -106,7 +352,7 @@ def _fetch_alignment(alignment, enst, uniprot_id):
         'ensembl_alignment': uniprot_seq,
         'match_str': match_str,
         'alignment_id': alignment.alignment_id,
-        'ensembl_release': ens_release,
+        'ensembl_release': alignment.alignment_run.ensembl_release,
         'ensembl_id': ensp,
         'uniprot_id': uniprot_id,
         'alignment_type': alignment_type
@@ -134,3 +380,64 @@ def calculate_difference(cigar):
             diff_count += c
 
     return diff_count
+
+
+def calculate_differences(cigars):
+    """
+    Calculate the differences of many alignments at once, as
+    calculate_difference does for one.
+
+    The cigar strings are parsed together into arrays of operation lengths
+    and codes, the lengths of the differing operations then being summed
+    per alignment.
+
+    Parameters
+    ----------
+    cigars : iterable of str
+        None for the alignments without cigar
+
+    Returns
+    -------
+    list
+        diff_count of each cigar, None for those without
+
+    Raises
+    ------
+    ValueError
+        When a cigar string is malformed
+    """
+    cigars = list(cigars)
+    joined = ''.join(cigar or '' for cigar in cigars)
+
+    differences = [0] * len(cigars)
+    if joined:
+        chars = np.frombuffer(joined.encode('ascii'), dtype=np.uint8)
+        is_op = (chars < ord('0')) | (chars > ord('9'))
+
+        # end offset of each cigar in the joined string
+        ends = np.cumsum([len(cigar or '') for cigar in cigars])
+        non_empty = ends[np.diff(np.concatenate(([0], ends))) > 0]
+
+        # every operation follows its length, and every cigar ends with one
+        if (
+                not is_op[non_empty - 1].all() or
+                is_op[0] or
+                (is_op[1:] & is_op[:-1]).any()
+        ):
+            raise ValueError("Malformed cigar string")
+
+        op_positions = np.flatnonzero(is_op)
+        lengths = np.array(_CIGAR_COUNT_RE.findall(joined)).astype(np.int64)
+        owners = np.searchsorted(ends, op_positions, side='right')
+
+        counted = np.isin(chars[op_positions], DIFFERENCE_OPS)
+        differences = np.bincount(
+            owners[counted],
+            weights=lengths[counted],
+            minlength=len(cigars)
+        ).astype(np.int64).tolist()
+
+    return [
+        difference if cigar is not None else None
+        for cigar, difference in zip(cigars, differences)
+    ]
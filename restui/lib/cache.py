@@ -0,0 +1,255 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import hashlib
+
+from django.core.cache import caches
+from django.db.models import Max
+
+from restui.lib.generations import bump_generation
+from restui.lib.generations import generation
+
+FACETS_CACHE = 'facets'
+DETAILS_CACHE = 'details'
+ALIGNMENTS_CACHE = 'alignments'
+
+# the kinds of detail cached
+MAPPING_DETAIL = 'mapping'
+UNMAPPED_DETAIL = 'unmapped'
+
+
+def facets_cache_key(search_type, search_term, facets):
+    """
+    Build the facets cache key for a search.
+
+    The search is normalised so that equivalent queries share their facets:
+    the search term is case insensitive in every search type, the facets
+    values are sorted. The key also depends on the latest release mapping
+    history, so that facets are recomputed when a new release is mapped.
+
+    Parameters
+    ----------
+    search_type : str
+        The kind of entity the search term matched (e.g. gene, uniprot, ...)
+    search_term : str
+    facets      : dict
+        facet name -> comma separated values
+
+    Returns
+    -------
+    key : str
+    """
+    normalised = [search_type, (search_term or '').lower()]
+    for name in sorted(facets):
+        normalised.append(
+            '{}:{}'.format(name, ','.join(sorted(facets[name].split(','))))
+        )
+
+    # restui.models.mappings imports restui.lib.alignments, which imports
+    # this module
+    from restui.models.mappings import ReleaseMappingHistory
+
+    digest = hashlib.md5('|'.join(normalised).encode('utf-8')).hexdigest()
+
+    latest_release = ReleaseMappingHistory.objects.aggregate(
+        latest=Max('release_mapping_history_id')
+    )['latest']
+
+    return '{}:{}:{}:{}'.format(
+        FACETS_CACHE,
+        generation(caches[FACETS_CACHE], FACETS_CACHE),
+        latest_release,
+        digest
+    )
+
+
+def cached_facets(key, build):
+    """
+    Return the facets cached under key, calling build() to compute and cache
+    them on a miss
+    """
+    cache = caches[FACETS_CACHE]
+
+    facets = cache.get(key)
+    if facets is None:
+        facets = build()
+        cache.set(key, facets)
+
+    return facets
+
+
+def invalidate_facets():
+    """
+    Discard all the cached facets, to be called whenever mapping_view data
+    the facets are counted on changes
+    """
+    bump_generation(caches[FACETS_CACHE], FACETS_CACHE)
+
+
+def detail_cache_key(kind, pk, authenticated=False):
+    """
+    Build the details cache key of an entry, the authenticated and anonymous
+    variants of a detail are cached apart
+
+    Parameters
+    ----------
+    kind          : str
+        MAPPING_DETAIL or UNMAPPED_DETAIL
+    pk            : int
+        The mapping id or the mapping view id of the entry
+    authenticated : bool
+
+    Returns
+    -------
+    key : str
+    """
+    return '{}:{}:{}:{}'.format(
+        DETAILS_CACHE,
+        kind,
+        pk,
+        'authenticated' if authenticated else 'anonymous'
+    )
+
+
+def cached_detail(kind, pk, build, authenticated=False, cacheable=None):
+    """
+    Return the detail of an entry cached under its key, calling build() to
+    compute it on a miss. The computed detail is cached unless
+    cacheable(detail) is false.
+    """
+    cache = caches[DETAILS_CACHE]
+    key = detail_cache_key(kind, pk, authenticated)
+
+    detail = cache.get(key)
+    if detail is None:
+        detail = build()
+        if cacheable is None or cacheable(detail):
+            cache.set(key, detail)
+
+    return detail
+
+
+def invalidate_details(kind, *pks):
+    """
+    Discard both variants of the cached details of the given entries, to be
+    called whenever an entry, or one related to it, is written to
+    """
+    caches[DETAILS_CACHE].delete_many([
+        detail_cache_key(kind, pk, authenticated)
+        for pk in pks
+        for authenticated in (False, True)
+    ])
+
+
+def invalidate_group_details(grouping_id, mapping_id=None, mapping_view_id=None):
+    """
+    Discard the cached details of all the entries of a group: the details
+    list the related entries with their status and alignment difference.
+
+    Entries without a group only have their own details discarded.
+    """
+    invalidate_groups_details([(grouping_id, mapping_id, mapping_view_id)])
+
+
+def invalidate_groups_details(entries):
+    """
+    Discard the cached details of many entries and of all the entries of
+    their groups at once, see invalidate_group_details
+
+    Parameters
+    ----------
+    entries : iterable
+        (grouping_id, mapping_id, mapping_view_id) of each entry
+    """
+    from restui.models.mappings import MappingView  # see facets_cache_key
+
+    discarded = set()
+    grouping_ids = set()
+    for grouping_id, mapping_id, mapping_view_id in entries:
+        if grouping_id is None:
+            discarded.add((mapping_id, mapping_view_id))
+        else:
+            grouping_ids.add(grouping_id)
+
+    if grouping_ids:
+        discarded.update(
+            MappingView.objects.filter(
+                grouping_id__in=grouping_ids
+            ).values_list(
+                'mapping_id',
+                'id'
+            )
+        )
+
+    invalidate_details(
+        MAPPING_DETAIL,
+        *{mapping_id for mapping_id, _ in discarded if mapping_id is not None}
+    )
+    invalidate_details(
+        UNMAPPED_DETAIL,
+        *{mv_id for _, mv_id in discarded if mv_id is not None}
+    )
+
+
+def alignment_cache_key(alignment_id, cigarplus=None, mdz=None):
+    """
+    Build the cache key of a reconstructed pairwise alignment, from its id
+    and a hash of the cigar and mdz strings it is reconstructed from: an
+    alignment whose cigar/mdz is updated gets a new key
+
+    Parameters
+    ----------
+    alignment_id : int
+    cigarplus    : str
+        None for the alignments without cigar (perfect matches)
+    mdz          : str
+
+    Returns
+    -------
+    key : str
+    """
+    digest = hashlib.md5(
+        '{}|{}'.format(cigarplus or '', mdz or '').encode('utf-8')
+    ).hexdigest()
+
+    return '{}:{}:{}'.format(ALIGNMENTS_CACHE, alignment_id, digest)
+
+
+def cached_alignment(alignment_id, cigarplus, mdz, build):
+    """
+    Return the pairwise alignment cached for the alignment and its cigar/mdz,
+    calling build() to reconstruct and cache it on a miss
+    """
+    cache = caches[ALIGNMENTS_CACHE]
+    key = alignment_cache_key(alignment_id, cigarplus, mdz)
+
+    pw_alignment = cache.get(key)
+    if pw_alignment is None:
+        pw_alignment = build()
+        cache.set(key, pw_alignment)
+
+    return pw_alignment
+
+
+def invalidate_alignment(alignment_id, cigarplus, mdz):
+    """
+    Discard the pairwise alignment cached for the alignment and its current
+    cigar/mdz, to be called when they are updated
+    """
+    caches[ALIGNMENTS_CACHE].delete(
+        alignment_cache_key(alignment_id, cigarplus, mdz)
+    )
@@ -15,10 +15,40 @@
    limitations under the License.
 """
 
-import requests
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import caches
+from django.db import close_old_connections
+from django.db.models import Max
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.http import Http404
 from gifts_rest.settings.base import TARK_SERVER
 from gifts_rest.settings.base import ENSEMBL_REST_SERVER
+from gifts_rest.settings.base import ENSEMBL_REST_LOOKUP_BATCH
+from gifts_rest.settings.base import ENSEMBL_REST_SEQUENCE_BATCH
+from gifts_rest.settings.base import ENSEMBL_RELEASE_FROM_DATABASE
+from gifts_rest.settings.base import ENSEMBL_RELEASE_TTL
+from gifts_rest.settings.base import ENSEMBL_SEQUENCE_WORKERS
+from gifts_rest.settings.base import SEQUENCE_PROVIDER
+from restui.lib import fasta
+from restui.lib import http_client
+from restui.lib import sequence_cache
+from restui.models.ensembl import EnsemblSpeciesHistory
+
+# the current Ensembl release is kept in this cache, shared by the workers
+# when the backend is (see CACHES in the settings)
+ENSEMBL_RELEASE_CACHE = 'default'
+ENSEMBL_RELEASE_KEY = 'ensembl_current_release'
+
+# where the sequences and translations come from: the Ensembl REST servers
+# (through the sequence cache) or the local FASTA files (see restui.lib.fasta)
+REST_PROVIDER = 'rest'
+FASTA_PROVIDER = 'fasta'
+
+# threads fetching sequences in the background, see ensembl_sequence_async
+_sequence_executor = ThreadPoolExecutor(max_workers=ENSEMBL_SEQUENCE_WORKERS)
 
 
 def tark_transcript(enst_id, release):
@@ -37,7 +67,7 @@ def tark_transcript(enst_id, release):
     """
     url = "{}/api/transcript/?stable_id={}&release_short_name={}&expand=sequence"
 
-    result = requests.get(url.format(TARK_SERVER, enst_id, release))
+    result = http_client.get(url.format(TARK_SERVER, enst_id, release))
     if not result.ok:
         raise Http404
 
@@ -64,12 +94,83 @@ def ensembl_current_release():
     """
     Get the current Ensembl release number.
 
+    The release is cached for ENSEMBL_RELEASE_TTL seconds. On a miss it is
+    asked to the Ensembl REST server or, with ENSEMBL_RELEASE_FROM_DATABASE,
+    taken from the Ensembl species histories loaded (see
+    seed_ensembl_current_release).
+
+    Returns
+    -------
+    release : int
+    """
+
+    release = caches[ENSEMBL_RELEASE_CACHE].get(ENSEMBL_RELEASE_KEY)
+    if release is None and ENSEMBL_RELEASE_FROM_DATABASE:
+        release = seed_ensembl_current_release()
+
+    if release is None:
+        release = fetch_ensembl_current_release()
+        caches[ENSEMBL_RELEASE_CACHE].set(
+            ENSEMBL_RELEASE_KEY,
+            release,
+            ENSEMBL_RELEASE_TTL
+        )
+
+    return release
+
+
+def seed_ensembl_current_release(release=None):
+    """
+    Cache the current Ensembl release number, by default the latest release
+    of the Ensembl species histories loaded in the database
+
+    Parameters
+    ----------
+    release : int
+
+    Returns
+    -------
+    release : int
+        None when not given and no Ensembl species history was loaded
+    """
+
+    if release is None:
+        release = EnsemblSpeciesHistory.objects.aggregate(
+            latest=Max('ensembl_release')
+        )['latest']
+
+        if release is None:
+            return None
+
+    caches[ENSEMBL_RELEASE_CACHE].set(
+        ENSEMBL_RELEASE_KEY,
+        release,
+        ENSEMBL_RELEASE_TTL
+    )
+
+    return release
+
+
+@receiver(post_save, sender=EnsemblSpeciesHistory)
+def species_history_saved(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    Move to the release of an Ensembl species history when its load
+    completes, if the current release is taken from the database
+    """
+    if ENSEMBL_RELEASE_FROM_DATABASE and instance.status == 'LOAD_COMPLETE':
+        seed_ensembl_current_release()
+
+
+def fetch_ensembl_current_release():
+    """
+    Ask the Ensembl REST server for the current Ensembl release number.
+
     Returns
     -------
     release : int
     """
 
-    result = requests.get(
+    result = http_client.get(
         "{}/info/software".format(ENSEMBL_REST_SERVER),
         headers={
             "Content-Type": "application/json"
@@ -83,7 +184,9 @@ def ensembl_current_release():
 
 def ensembl_sequence(enst_id, release):
     """
-    Get the sequence for an ensembl ID in a given release
+    Get the sequence for an ensembl ID in a given release, from the FASTA
+    files with the FASTA provider, otherwise from the sequence cache unless
+    it has to be fetched (see restui.lib.sequence_cache)
 
     Parameters
     ----------
@@ -96,13 +199,47 @@ def ensembl_sequence(enst_id, release):
     sequence : str
     """
 
-    e_current_release = ensembl_current_release()
+    if SEQUENCE_PROVIDER == FASTA_PROVIDER:
+        return fasta.sequence(enst_id, release)
+
+    return sequence_cache.cached_lookup(
+        sequence_cache.SEQUENCE,
+        enst_id,
+        release,
+        lambda: fetch_ensembl_sequence(enst_id, release)
+    )
+
+
+def ensembl_rest_server(release):
+    """
+    Return the Ensembl REST server of a release: the main one for the current
+    release, the archive of the release otherwise
+    """
+    if release == ensembl_current_release():
+        return ENSEMBL_REST_SERVER
+
+    return "http://e{}.rest.ensembl.org".format(release)
 
-    server = "http://e{}.rest.ensembl.org".format(release)
-    if release == e_current_release:
-        server = ENSEMBL_REST_SERVER
 
-    result = requests.get(
+def fetch_ensembl_sequence(enst_id, release):
+    """
+    Fetch the sequence for an ensembl ID in a given release from the Ensembl
+    REST server of the release
+
+    Parameters
+    ----------
+    enst_id : str
+        This needs to be the e! stable ID (eg ENST...)
+    release : int
+
+    Returns
+    -------
+    sequence : str
+    """
+
+    server = ensembl_rest_server(release)
+
+    result = http_client.get(
         "{}/sequence/id/{}?content-type=text/plain".format(server, enst_id)
     )
     if not result.ok:
@@ -111,9 +248,31 @@ def ensembl_sequence(enst_id, release):
     return result.text
 
 
+def ensembl_sequence_async(enst_id, release):
+    """
+    Start fetching the sequence for an ensembl ID in a given release in the
+    background
+
+    Parameters
+    ----------
+    enst_id : str
+        This needs to be the e! stable ID (eg ENST...)
+    release : int
+
+    Returns
+    -------
+    future : concurrent.futures.Future
+        Resolves to the sequence, or raises what ensembl_sequence raised
+    """
+
+    return _sequence_executor.submit(_in_thread, ensembl_sequence, enst_id, release)
+
+
 def ensembl_protein(enst_id, release):
     """
-    Get the protein ensembl ID in a given transcript id and release number
+    Get the protein ensembl ID in a given transcript id and release number,
+    from the FASTA files with the FASTA provider, otherwise from the sequence
+    cache unless it has to be fetched (see restui.lib.sequence_cache)
 
     Parameters
     ----------
@@ -126,13 +285,36 @@ def ensembl_protein(enst_id, release):
     protein_id : str
     """
 
-    e_current_release = ensembl_current_release()
+    if SEQUENCE_PROVIDER == FASTA_PROVIDER:
+        return fasta.protein(enst_id, release)
+
+    return sequence_cache.cached_lookup(
+        sequence_cache.TRANSLATION,
+        enst_id,
+        release,
+        lambda: fetch_ensembl_protein(enst_id, release)
+    )
+
+
+def fetch_ensembl_protein(enst_id, release):
+    """
+    Fetch the protein ensembl ID of a transcript in a given release from the
+    Ensembl REST server of the release
+
+    Parameters
+    ----------
+    enst_id : str
+        This needs to be the e! stable ID (eg ENST...)
+    release : int
+
+    Returns
+    -------
+    protein_id : str
+    """
 
-    server = "http://e{}.rest.ensembl.org".format(release)
-    if release == e_current_release:
-        server = ENSEMBL_REST_SERVER
+    server = ensembl_rest_server(release)
 
-    result = requests.get(
+    result = http_client.get(
         "{}/lookup/id/{}?expand=1&content-type=application/json".format(server, enst_id)
     )
 
@@ -141,3 +323,175 @@ def ensembl_protein(enst_id, release):
 
     ensembl_json = result.json()
     return ensembl_json['Translation']['id']
+
+
+def ensembl_sequences(stable_ids, release):
+    """
+    Get the sequences of many ensembl IDs in a given release, from the FASTA
+    files with the FASTA provider, otherwise from the sequence cache for
+    those which are, the others being fetched in batches (see
+    fetch_ensembl_sequences)
+
+    Parameters
+    ----------
+    stable_ids : iterable of str
+        e! stable IDs (eg ENST..., ENSP...)
+    release    : int
+
+    Returns
+    -------
+    dict
+        stable ID -> sequence, without the IDs Ensembl doesn't know
+    """
+
+    if SEQUENCE_PROVIDER == FASTA_PROVIDER:
+        return fasta.sequences(stable_ids, release)
+
+    return sequence_cache.cached_lookups(
+        sequence_cache.SEQUENCE,
+        stable_ids,
+        release,
+        lambda missing: fetch_ensembl_sequences(missing, release)
+    )
+
+
+def ensembl_sequences_async(stable_ids, release):
+    """
+    Start getting the sequences of many ensembl IDs in a given release in the
+    background, see ensembl_sequences
+
+    Returns
+    -------
+    future : concurrent.futures.Future
+        Resolves to the stable ID -> sequence dict
+    """
+
+    return _sequence_executor.submit(
+        _in_thread,
+        ensembl_sequences,
+        list(stable_ids),
+        release
+    )
+
+
+def ensembl_proteins(enst_ids, release):
+    """
+    Get the protein ensembl IDs of many transcripts in a given release, from
+    the FASTA files with the FASTA provider, otherwise from the sequence
+    cache for those which are, the others being looked up in batches (see
+    fetch_ensembl_proteins)
+
+    Parameters
+    ----------
+    enst_ids : iterable of str
+        e! transcript stable IDs (eg ENST...)
+    release  : int
+
+    Returns
+    -------
+    dict
+        transcript ID -> protein ID, without the transcripts which aren't
+        translated or that Ensembl doesn't know
+    """
+
+    if SEQUENCE_PROVIDER == FASTA_PROVIDER:
+        return fasta.proteins(enst_ids, release)
+
+    return sequence_cache.cached_lookups(
+        sequence_cache.TRANSLATION,
+        enst_ids,
+        release,
+        lambda missing: fetch_ensembl_proteins(missing, release)
+    )
+
+
+def fetch_ensembl_sequences(stable_ids, release):
+    """
+    Fetch the sequences of many ensembl IDs in a given release from the
+    Ensembl REST server of the release, ENSEMBL_REST_SEQUENCE_BATCH IDs per
+    POST /sequence/id
+
+    Returns
+    -------
+    dict
+        stable ID -> sequence, without the IDs Ensembl doesn't know
+    """
+
+    sequences = {}
+    for response in _post_batches(
+            "{}/sequence/id".format(ensembl_rest_server(release)),
+            stable_ids,
+            ENSEMBL_REST_SEQUENCE_BATCH
+    ):
+        for entry in response:
+            # query is the ID as requested, id may lose its version
+            sequences[entry.get('query', entry['id'])] = entry['seq']
+
+    return sequences
+
+
+def fetch_ensembl_proteins(enst_ids, release):
+    """
+    Fetch the protein ensembl IDs of many transcripts in a given release from
+    the Ensembl REST server of the release, ENSEMBL_REST_LOOKUP_BATCH IDs per
+    POST /lookup/id
+
+    Returns
+    -------
+    dict
+        transcript ID -> protein ID, without the transcripts which aren't
+        translated or that Ensembl doesn't know
+    """
+
+    proteins = {}
+    for response in _post_batches(
+            "{}/lookup/id".format(ensembl_rest_server(release)),
+            enst_ids,
+            ENSEMBL_REST_LOOKUP_BATCH,
+            expand=1
+    ):
+        for enst_id, entry in response.items():
+            if entry and entry.get('Translation'):
+                proteins[enst_id] = entry['Translation']['id']
+
+    return proteins
+
+
+def _in_thread(function, *args):
+    # the pool threads outlive the requests, close the database connection
+    # a task opened (e.g. ensembl_current_release with
+    # ENSEMBL_RELEASE_FROM_DATABASE) as the request handlers do for theirs
+    close_old_connections()
+    try:
+        return function(*args)
+    finally:
+        close_old_connections()
+
+
+def _post_batches(url, ids, batch_size, **payload):
+    """
+    POST the ids to an Ensembl REST batch endpoint, batch_size at a time, and
+    yield the JSON response of each batch.
+
+    When the server says the rate limit is reached (X-RateLimit-Remaining),
+    the next batch waits for the limit to reset. 429 responses are retried by
+    the HTTP client after their Retry-After.
+    """
+    ids = list(ids)
+
+    for start in range(0, len(ids), batch_size):
+        result = http_client.post(
+            url,
+            json=dict(payload, ids=ids[start:start + batch_size]),
+            headers={
+                "Content-Type": "application/json",
+                "Accept": "application/json"
+            }
+        )
+        if not result.ok:
+            result.raise_for_status()
+
+        yield result.json()
+
+        if result.headers.get('X-RateLimit-Remaining') == '0':
+            time.sleep(float(result.headers.get('X-RateLimit-Reset', 1)))
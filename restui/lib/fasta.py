@@ -0,0 +1,297 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+"""
+Offline provider of the Ensembl sequences, read from the peptide FASTA files
+of each release (e.g. Homo_sapiens.GRCh38.pep.all.fa, uncompressed) found in
+SEQUENCE_FASTA_DIRECTORY/<release>/.
+
+Each FASTA file gets an index of the offset of each sequence, written next to
+it (<file>.gifts.idx), or in SEQUENCE_FASTA_INDEX_DIRECTORY/<release>/ when
+set, the first time the file is read and rebuilt whenever the file is newer.
+When the index can't be written (e.g. read-only directory), the file is
+indexed in memory by each process. Sequences are read from the memory-mapped
+file, which is never loaded as a whole.
+
+Records are found by ENSP id, or by the ENST id of their translation (the
+transcript: field of the Ensembl headers): the sequence of a transcript is
+the peptide it translates to. Versions are ignored.
+"""
+
+import glob
+import logging
+import mmap
+import os
+import re
+import threading
+
+from django.conf import settings
+
+INDEX_SUFFIX = '.gifts.idx'
+
+_TRANSCRIPT_RE = re.compile(rb'\btranscript:(\S+)')
+
+_releases = {}
+_releases_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def _unversioned(stable_id):
+    return stable_id.split('.')[0]
+
+
+class FastaFile(object):
+    """
+    A FASTA file, memory-mapped, with its index (next to the file, unless
+    index_path is given)
+    """
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + INDEX_SUFFIX
+
+        # an empty file can't be mapped
+        self.data = b''
+        if os.path.getsize(path):
+            with open(path, 'rb') as fasta:
+                self.data = mmap.mmap(fasta.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.offsets = {}
+        self.translations = {}
+        self._load_index()
+
+    def _load_index(self):
+        if (
+                not os.path.exists(self.index_path) or
+                os.path.getmtime(self.index_path) < os.path.getmtime(self.path)
+        ):
+            records = self._scan()
+            if not self._write_index(records):
+                self._add_records(records)
+                return
+
+        with open(self.index_path) as index:
+            self._add_records(
+                line.rstrip('\n').split('\t')
+                for line in index
+            )
+
+    def _add_records(self, records):
+        for protein_id, transcript_id, start, end in records:
+            self.offsets[protein_id] = (int(start), int(end))
+            if transcript_id:
+                self.translations[transcript_id] = protein_id
+
+    def _scan(self):
+        """
+        Scan the file once for the headers: protein id, transcript id and
+        the byte span of the sequence of each record
+        """
+        records = []
+        position = self.data.find(b'>')
+
+        while position != -1:
+            header_end = self.data.find(b'\n', position)
+            if header_end == -1:
+                header_end = len(self.data)
+
+            header = self.data[position + 1:header_end]
+            next_record = self.data.find(b'\n>', header_end)
+            end = len(self.data) if next_record == -1 else next_record
+
+            transcript = _TRANSCRIPT_RE.search(header)
+            records.append((
+                _unversioned(header.split()[0].decode()),
+                _unversioned(transcript.group(1).decode()) if transcript else '',
+                header_end + 1,
+                end
+            ))
+
+            position = -1 if next_record == -1 else next_record + 1
+
+        return records
+
+    def _write_index(self, records):
+        """
+        Write the index of the records, False when it can't be written
+        """
+        # write then rename, so that a concurrent reader never sees half of it
+        temporary_path = '{}.{}'.format(self.index_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with open(temporary_path, 'w') as index:
+                for record in records:
+                    index.write('{}\t{}\t{}\t{}\n'.format(*record))
+            os.replace(temporary_path, self.index_path)
+        except OSError as e:
+            logger.warning("Couldn't write the index of %s, indexed in memory: %s", self.path, e)
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            return False
+
+        return True
+
+    def sequence(self, protein_id):
+        """
+        Return the sequence of a protein id, None if it isn't in the file
+        """
+        span = self.offsets.get(protein_id)
+        if span is None:
+            return None
+
+        return self.data[span[0]:span[1]].replace(b'\n', b'').replace(b'\r', b'').decode()
+
+
+class ReleaseFasta(object):
+    """
+    The FASTA files of a release
+    """
+
+    def __init__(self, release):
+        pattern = os.path.join(settings.SEQUENCE_FASTA_DIRECTORY, str(release), '*.fa')
+        self.files = [
+            FastaFile(path, _index_path(path, release))
+            for path in sorted(glob.glob(pattern))
+        ]
+
+    def protein(self, enst_id):
+        enst_id = _unversioned(enst_id)
+        for fasta in self.files:
+            protein_id = fasta.translations.get(enst_id)
+            if protein_id is not None:
+                return protein_id
+
+        return None
+
+    def sequence(self, stable_id):
+        stable_id = _unversioned(stable_id)
+        protein_id = self.protein(stable_id) or stable_id
+
+        for fasta in self.files:
+            sequence = fasta.sequence(protein_id)
+            if sequence is not None:
+                return sequence
+
+        return None
+
+
+def _index_path(path, release):
+    """
+    Return where the index of a FASTA file is written, None for next to it
+    """
+    if settings.SEQUENCE_FASTA_INDEX_DIRECTORY is None:
+        return None
+
+    return os.path.join(
+        settings.SEQUENCE_FASTA_INDEX_DIRECTORY,
+        str(release),
+        os.path.basename(path) + INDEX_SUFFIX
+    )
+
+
+def release_fasta(release):
+    """
+    Return the FASTA files of a release, indexed the first time. A release
+    without files is looked for again the next time, its files may have been
+    added since.
+    """
+    release = int(release)
+
+    fasta = _releases.get(release)
+    if fasta is None:
+        with _releases_lock:
+            fasta = _releases.get(release)
+            if fasta is None:
+                fasta = ReleaseFasta(release)
+                if fasta.files:
+                    _releases[release] = fasta
+
+    return fasta
+
+
+def sequence(stable_id, release):
+    """
+    Return the sequence of an ensembl ID (ENSP, or ENST for the peptide it
+    translates to) in a given release
+
+    Raises
+    ------
+    Exception
+        When the FASTA files of the release don't have it
+    """
+    found = release_fasta(release).sequence(stable_id)
+    if found is None:
+        raise Exception(
+            "Couldn't find {} in the FASTA files of release {}".format(stable_id, release)
+        )
+
+    return found
+
+
+def sequences(stable_ids, release):
+    """
+    Return the sequences of many ensembl IDs in a given release, see
+    sequence(), in a stable ID -> sequence dict without those not found
+    """
+    fasta = release_fasta(release)
+
+    found = {}
+    for stable_id in stable_ids:
+        stable_sequence = fasta.sequence(stable_id)
+        if stable_sequence is not None:
+            found[stable_id] = stable_sequence
+
+    return found
+
+
+def protein(enst_id, release):
+    """
+    Return the protein ensembl ID a transcript translates to in a given
+    release
+
+    Raises
+    ------
+    Exception
+        When the FASTA files of the release don't have it
+    """
+    found = release_fasta(release).protein(enst_id)
+    if found is None:
+        raise Exception(
+            "Couldn't find the translation of {} in the FASTA files of release {}".format(
+                enst_id,
+                release
+            )
+        )
+
+    return found
+
+
+def proteins(enst_ids, release):
+    """
+    Return the protein ensembl IDs many transcripts translate to in a given
+    release, in a transcript ID -> protein ID dict without those not found
+    """
+    fasta = release_fasta(release)
+
+    found = {}
+    for enst_id in enst_ids:
+        protein_id = fasta.protein(enst_id)
+        if protein_id is not None:
+            found[enst_id] = protein_id
+
+    return found
@@ -0,0 +1,51 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+"""
+Generation counters kept in a Django cache.
+
+Data cached by a process (in the process memory or under keys built from the
+generation) is stale once the generation it was built from has been bumped,
+by any process sharing the cache backend.
+"""
+
+
+def generation(cache, name):
+    """
+    Return the current generation of name
+    """
+    key = '{}:generation'.format(name)
+
+    current = cache.get(key)
+    if current is None:
+        cache.add(key, 1, None)
+        current = cache.get(key, 1)
+
+    return current
+
+
+def bump_generation(cache, name):
+    """
+    Move name to a new generation
+    """
+    key = '{}:generation'.format(name)
+
+    try:
+        cache.incr(key)
+    except ValueError:
+        # not yet set, or evicted
+        cache.set(key, 2, None)
@@ -0,0 +1,207 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+"""
+Shared HTTP client of the calls to external services (Ensembl REST, TaRK).
+
+All the requests of a process go through one session, which keeps a pool of
+keep-alive connections per host, bounds the connect and read times of each
+request and retries failed connections and transient server errors with an
+exponential backoff.
+
+Latency and errors are counted per host, see metrics().
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from gifts_rest.settings.base import EXTERNAL_HTTP_BACKOFF
+from gifts_rest.settings.base import EXTERNAL_HTTP_CONNECT_TIMEOUT
+from gifts_rest.settings.base import EXTERNAL_HTTP_POOL_SIZE
+from gifts_rest.settings.base import EXTERNAL_HTTP_READ_TIMEOUT
+from gifts_rest.settings.base import EXTERNAL_HTTP_RETRIES
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+# the external services are only read, POST included (e.g. Ensembl REST
+# batch lookups), so every request can safely be retried
+RETRIED_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'POST'])
+RETRIED_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+_session = None
+_session_lock = threading.Lock()
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def session():
+    """
+    Return the process wide session, created on first use
+    """
+    global _session  # pylint: disable=global-statement
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                retries = Retry(
+                    total=EXTERNAL_HTTP_RETRIES,
+                    backoff_factor=EXTERNAL_HTTP_BACKOFF,
+                    status_forcelist=RETRIED_STATUSES,
+                    method_whitelist=RETRIED_METHODS,
+                    # hand back the last response, callers check its status
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=EXTERNAL_HTTP_POOL_SIZE,
+                    pool_maxsize=EXTERNAL_HTTP_POOL_SIZE,
+                    max_retries=retries
+                )
+
+                new_session = requests.Session()
+                new_session.mount('http://', adapter)
+                new_session.mount('https://', adapter)
+                _session = new_session
+
+    return _session
+
+
+def request(method, url, **kwargs):
+    """
+    Send a request with the shared session, within the connect and read
+    timeouts unless the caller gives its own, and record its latency and
+    outcome in the metrics of the host
+
+    Returns
+    -------
+    response : requests.Response
+
+    Raises
+    ------
+    requests.RequestException
+        When the request couldn't be completed, after the retries
+    """
+    kwargs.setdefault(
+        'timeout',
+        (EXTERNAL_HTTP_CONNECT_TIMEOUT, EXTERNAL_HTTP_READ_TIMEOUT)
+    )
+
+    host = urlsplit(url).netloc
+    start = time.monotonic()
+    try:
+        response = session().request(method, url, **kwargs)
+    except requests.Timeout:
+        _record(host, time.monotonic() - start, 'timeouts')
+        raise
+    except requests.RequestException:
+        _record(host, time.monotonic() - start, 'errors')
+        raise
+
+    _record(
+        host,
+        time.monotonic() - start,
+        None if response.ok else 'errors'
+    )
+
+    return response
+
+
+def get(url, **kwargs):
+    """
+    GET url, see request()
+    """
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    """
+    POST to url, see request()
+    """
+    return request('POST', url, **kwargs)
+
+
+def _record(host, latency, failure=None):
+    with _metrics_lock:
+        host_metrics = _metrics.get(host)
+        if host_metrics is None:
+            host_metrics = _metrics[host] = {
+                'requests': 0,
+                'errors': 0,
+                'timeouts': 0,
+                'latency_total': 0.0,
+                'latency_max': 0.0,
+                'latency_buckets': [0] * len(LATENCY_BUCKETS)
+            }
+
+        host_metrics['requests'] += 1
+        if failure is not None:
+            host_metrics[failure] += 1
+
+        host_metrics['latency_total'] += latency
+        host_metrics['latency_max'] = max(host_metrics['latency_max'], latency)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                host_metrics['latency_buckets'][i] += 1
+                break
+
+
+def metrics():
+    """
+    Return the metrics of the requests sent by this process, per host: the
+    number of requests, of errors (failed connections and error statuses) and
+    of timeouts, the mean and max latency in seconds and the number of
+    requests in each latency bucket (keyed by upper bound, 'inf' for the
+    last one)
+
+    Returns
+    -------
+    dict
+        host -> metrics
+    """
+    snapshot = OrderedDict()
+
+    with _metrics_lock:
+        for host in sorted(_metrics):
+            host_metrics = _metrics[host]
+            snapshot[host] = OrderedDict([
+                ('requests', host_metrics['requests']),
+                ('errors', host_metrics['errors']),
+                ('timeouts', host_metrics['timeouts']),
+                ('latencyMean', host_metrics['latency_total'] / host_metrics['requests']),
+                ('latencyMax', host_metrics['latency_max']),
+                ('latencyBuckets', OrderedDict(
+                    (str(bound), count)
+                    for bound, count in zip(LATENCY_BUCKETS, host_metrics['latency_buckets'])
+                ))
+            ])
+
+    return snapshot
+
+
+def reset_metrics():
+    """
+    Forget the metrics recorded so far
+    """
+    with _metrics_lock:
+        _metrics.clear()
@@ -0,0 +1,74 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+"""
+Request scoped memoisation.
+
+Lookups repeated while serving a request (e.g. the latest history of a
+mapping) are computed once and remembered until the end of the request, see
+restui.middleware.RequestMemoisationMiddleware. Outside a memoisation context
+(management commands, celery tasks) nothing is remembered.
+"""
+
+import threading
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+@contextmanager
+def memoisation():
+    """
+    Remember the memoised lookups made within the context, contexts can be
+    nested and share the outermost one's memo
+    """
+    if getattr(_local, 'memo', None) is not None:
+        yield
+        return
+
+    _local.memo = {}
+    try:
+        yield
+    finally:
+        _local.memo = None
+
+
+def memoised(namespace, key, compute):
+    """
+    Return the value remembered for (namespace, key) in the current
+    memoisation context, calling compute() to get it the first time.
+    Exceptions raised by compute() are not remembered.
+
+    Parameters
+    ----------
+    namespace : str
+        The kind of lookup, e.g. 'latest_mapped_history'
+    key       : hashable
+        What the lookup is for, e.g. a mapping id
+    compute   : callable
+        Makes the lookup, without argument
+    """
+    memo = getattr(_local, 'memo', None)
+    if memo is None:
+        return compute()
+
+    try:
+        return memo[(namespace, key)]
+    except KeyError:
+        value = memo[(namespace, key)] = compute()
+
+    return value
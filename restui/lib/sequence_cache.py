@@ -0,0 +1,320 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+"""
+Persistent cache of the Ensembl lookups which never change for a release:
+the sequence of a stable id and the translation (ENSP) of a transcript.
+
+Entries are kept in a SQLite file (SEQUENCE_CACHE_PATH) shared by the
+processes of a host, keyed by kind, stable id and release. Beyond
+SEQUENCE_CACHE_MAX_ENTRIES entries, the least recently used ones are evicted.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+# the kinds of lookup cached
+SEQUENCE = 'sequence'
+TRANSLATION = 'translation'
+
+# share of the entries kept when the store is full
+CULL_KEEP = 0.9
+
+# the last use of the entries read is written by batches of this size
+TOUCH_BATCH = 100
+
+logger = logging.getLogger(__name__)
+
+_store = None
+_store_lock = threading.Lock()
+
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+class SequenceStore(object):
+    """
+    Size-bounded LRU store of the Ensembl lookups in a SQLite file, each
+    thread has its own connection.
+
+    Reads don't write: the last use of the entries read is remembered and
+    written by batches, with the next entries cached or every TOUCH_BATCH
+    reads. The number of entries is counted again only once the entries
+    cached since the last count may have filled the store.
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+
+        # estimate of the number of entries, None until first counted
+        self._entries = None
+        # (kind, stable_id, release) -> last use, not yet written
+        self._touched = {}
+        self._touched_lock = threading.Lock()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS lookup ("
+                "kind TEXT NOT NULL, "
+                "stable_id TEXT NOT NULL, "
+                "release INTEGER NOT NULL, "
+                "value TEXT NOT NULL, "
+                "last_used REAL NOT NULL, "
+                "PRIMARY KEY (kind, stable_id, release))"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS lookup_last_used_idx ON lookup (last_used)"
+            )
+            connection.commit()
+            self._local.connection = connection
+
+        return connection
+
+    def get(self, kind, stable_id, release):
+        """
+        Return the value cached for the lookup, None on a miss
+        """
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT value FROM lookup WHERE kind = ? AND stable_id = ? AND release = ?",
+            (kind, stable_id, release)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        with self._touched_lock:
+            self._touched[(kind, stable_id, release)] = time.time()
+            touched = self._take_touched() if len(self._touched) >= TOUCH_BATCH else None
+
+        if touched:
+            try:
+                with connection:
+                    self._write_touched(connection, touched)
+            except sqlite3.Error as e:
+                # only the eviction order is lost
+                logger.warning("Couldn't write the last use of the sequence cache entries: %s", e)
+
+        return row[0]
+
+    def _take_touched(self):
+        touched, self._touched = self._touched, {}
+        return touched
+
+    @staticmethod
+    def _write_touched(connection, touched):
+        connection.executemany(
+            "UPDATE lookup SET last_used = ? "
+            "WHERE kind = ? AND stable_id = ? AND release = ?",
+            [
+                (last_used, kind, stable_id, release)
+                for (kind, stable_id, release), last_used in touched.items()
+            ]
+        )
+
+    def set_many(self, entries):
+        """
+        Cache the (kind, stable_id, release, value) entries, evicting the
+        least recently used ones if the store is then full
+        """
+        now = time.time()
+        connection = self._connection()
+
+        with self._touched_lock:
+            touched = self._take_touched()
+
+        with connection:
+            if touched:
+                self._write_touched(connection, touched)
+
+            inserted = connection.executemany(
+                "INSERT OR REPLACE INTO lookup (kind, stable_id, release, value, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (kind, stable_id, release, value, now)
+                    for kind, stable_id, release, value in entries
+                ]
+            ).rowcount
+
+            # replaced entries are counted as new ones, and the other
+            # processes' aren't: the count is only an estimate
+            if self._entries is not None and self._entries + inserted <= self.max_entries:
+                self._entries += inserted
+                return
+
+            count = connection.execute("SELECT COUNT(*) FROM lookup").fetchone()[0]
+            if count > self.max_entries:
+                culled = connection.execute(
+                    "DELETE FROM lookup WHERE rowid IN ("
+                    "SELECT rowid FROM lookup ORDER BY last_used LIMIT ?)",
+                    (count - int(self.max_entries * CULL_KEEP),)
+                ).rowcount
+                count -= culled
+
+            self._entries = count
+
+    def set(self, kind, stable_id, release, value):
+        """
+        Cache the value of the lookup
+        """
+        self.set_many([(kind, stable_id, release, value)])
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM lookup").fetchone()[0]
+
+
+def store():
+    """
+    Return the process wide store, None when SEQUENCE_CACHE_PATH isn't set
+    """
+    global _store  # pylint: disable=global-statement
+
+    if settings.SEQUENCE_CACHE_PATH is None:
+        return None
+
+    if _store is None or _store.path != settings.SEQUENCE_CACHE_PATH:
+        with _store_lock:
+            if _store is None or _store.path != settings.SEQUENCE_CACHE_PATH:
+                _store = SequenceStore(
+                    settings.SEQUENCE_CACHE_PATH,
+                    settings.SEQUENCE_CACHE_MAX_ENTRIES
+                )
+
+    return _store
+
+
+def _count(outcome):
+    with _stats_lock:
+        _stats[outcome] += 1
+
+
+def cached_lookup(kind, stable_id, release, fetch):
+    """
+    Return the value of the lookup from the store, calling fetch() to get it
+    and cache it on a miss.
+
+    The store failing (e.g. locked for too long) doesn't fail the lookup, it
+    is fetched.
+    """
+    sequence_store = store()
+    if sequence_store is None:
+        return fetch()
+
+    try:
+        value = sequence_store.get(kind, stable_id, int(release))
+    except sqlite3.Error as e:
+        logger.warning("Sequence cache lookup failed: %s", e)
+        return fetch()
+
+    if value is not None:
+        _count('hits')
+        return value
+
+    _count('misses')
+    value = fetch()
+
+    try:
+        sequence_store.set(kind, stable_id, int(release), value)
+    except sqlite3.Error as e:
+        logger.warning("Couldn't cache the sequence lookup: %s", e)
+
+    return value
+
+
+def cached_lookups(kind, stable_ids, release, fetch_many):
+    """
+    Return the values of many lookups, from the store for those which are,
+    calling fetch_many(missing stable ids) to get the others, in a dict, and
+    cache them.
+
+    Returns
+    -------
+    dict
+        stable id -> value, without the stable ids fetch_many didn't find
+    """
+    stable_ids = list(OrderedDict.fromkeys(stable_ids))
+
+    sequence_store = store()
+    if sequence_store is None:
+        return fetch_many(stable_ids)
+
+    values = {}
+    try:
+        for stable_id in stable_ids:
+            value = sequence_store.get(kind, stable_id, int(release))
+            if value is not None:
+                values[stable_id] = value
+    except sqlite3.Error as e:
+        logger.warning("Sequence cache lookup failed: %s", e)
+        return fetch_many(stable_ids)
+
+    missing = [stable_id for stable_id in stable_ids if stable_id not in values]
+
+    with _stats_lock:
+        _stats['hits'] += len(values)
+        _stats['misses'] += len(missing)
+
+    if not missing:
+        return values
+
+    fetched = fetch_many(missing)
+
+    try:
+        sequence_store.set_many(
+            (kind, stable_id, int(release), value)
+            for stable_id, value in fetched.items()
+        )
+    except sqlite3.Error as e:
+        logger.warning("Couldn't cache the sequence lookups: %s", e)
+
+    values.update(fetched)
+
+    return values
+
+
+def stats():
+    """
+    Return the hits and misses of the lookups of this process, with the
+    number of entries in the store
+    """
+    with _stats_lock:
+        current = dict(_stats)
+
+    sequence_store = store()
+    current['entries'] = len(sequence_store) if sequence_store is not None else 0
+
+    return current
+
+
+def reset_stats():
+    """
+    Forget the hits and misses counted so far
+    """
+    with _stats_lock:
+        _stats['hits'] = 0
+        _stats['misses'] = 0
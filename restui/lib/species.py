@@ -0,0 +1,103 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from django.core.cache import caches
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from restui.lib.generations import bump_generation
+from restui.lib.generations import generation
+from restui.lib.memo import memoised
+from restui.models.ensembl import EnsemblSpeciesHistory
+
+# the generation of the index is kept in this cache, shared by the processes
+# (see CACHES in the settings), so that every process reloads its index when
+# an Ensembl load completes in another one, e.g. the celery bulk upload
+SPECIES_CACHE = 'default'
+SPECIES_NAMES = 'species_names'
+
+_species_names = None
+_species_names_generation = None
+
+
+def _load_species_names():
+    """
+    Map every taxonomy id to the species name of its latest Ensembl species
+    history, in one query
+    """
+    latest_histories = EnsemblSpeciesHistory.objects.order_by(
+        'ensembl_tax_id',
+        '-time_loaded'
+    ).distinct(
+        'ensembl_tax_id'
+    ).values_list(
+        'ensembl_tax_id',
+        'species'
+    )
+
+    return dict(latest_histories)
+
+
+def species_names():
+    """
+    Return the process wide taxonomy id -> species name index, (re)loading it
+    the first time and whenever it has been refreshed since. The generation
+    is checked once per request.
+    """
+    global _species_names, _species_names_generation  # pylint: disable=global-statement
+
+    current = memoised(
+        'generation',
+        SPECIES_NAMES,
+        lambda: generation(caches[SPECIES_CACHE], SPECIES_NAMES)
+    )
+    if _species_names is None or current != _species_names_generation:
+        # swap the whole index, concurrent readers keep the previous one
+        _species_names = _load_species_names()
+        _species_names_generation = current
+
+    return _species_names
+
+
+def species_name(tax_id):
+    """
+    Return the species name of the latest Ensembl species history loaded for
+    the given taxonomy id, None if there is none
+    """
+    return species_names().get(tax_id)
+
+
+def refresh_species_names():
+    """
+    Make every process reload its species names index, to be called when an
+    Ensembl species history load is complete
+    """
+    global _species_names  # pylint: disable=global-statement
+
+    bump_generation(caches[SPECIES_CACHE], SPECIES_NAMES)
+
+    _species_names = None
+
+
+@receiver(post_save, sender=EnsemblSpeciesHistory)
+def species_history_saved(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    Refresh the species names when an Ensembl species history load completes
+    (see restui.pipeline.bulk_upload)
+    """
+    if instance.status == 'LOAD_COMPLETE':
+        refresh_species_names()
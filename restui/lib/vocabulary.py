@@ -0,0 +1,176 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+"""
+Process wide cache of the controlled vocabularies (cv_* tables).
+
+Every vocabulary maps ids to descriptions and back. The vocabularies are
+loaded together, warmed on the first request of the process (see
+RestuiConfig) and reloaded by every process once any of the cv tables has been written to.
+"""
+
+import logging
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.signals import request_started
+from django.db import DatabaseError
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django_redis.exceptions import ConnectionInterrupted
+
+from restui.lib.generations import bump_generation
+from restui.lib.generations import generation
+from restui.lib.memo import memoised
+from restui.models.annotations import CvEntryType
+from restui.models.annotations import CvUeLabel
+from restui.models.annotations import CvUeStatus
+
+logger = logging.getLogger(__name__)
+
+# the generation of the vocabularies is kept in this cache, which must be
+# shared by the processes for them to see each other changes
+VOCABULARY_CACHE = 'default'
+VOCABULARIES = 'vocabularies'
+
+STATUS = 'status'
+ENTRY_TYPE = 'entry_type'
+LABEL = 'label'
+
+VOCABULARY_MODELS = OrderedDict([
+    (STATUS, CvUeStatus),
+    (ENTRY_TYPE, CvEntryType),
+    (LABEL, CvUeLabel),
+])
+
+_vocabularies = None
+_vocabularies_generation = None
+
+
+def _load_vocabularies():
+    """
+    Return vocabulary name -> (id -> description, description -> id) for all
+    the vocabularies, ordered by id
+    """
+    loaded = {}
+    for name, model in VOCABULARY_MODELS.items():
+        descriptions = OrderedDict(
+            model.objects.order_by('id').values_list('id', 'description')
+        )
+        ids = {term: term_id for term_id, term in descriptions.items()}
+
+        loaded[name] = (descriptions, ids)
+
+    return loaded
+
+
+def vocabularies():
+    """
+    Return the vocabularies, (re)loading them the first time and whenever
+    they have been refreshed since. The generation is checked once per
+    request.
+    """
+    global _vocabularies, _vocabularies_generation  # pylint: disable=global-statement
+
+    current = memoised(
+        'generation',
+        VOCABULARIES,
+        lambda: generation(caches[VOCABULARY_CACHE], VOCABULARIES)
+    )
+    if _vocabularies is None or current != _vocabularies_generation:
+        # swap them all, concurrent readers keep the previous ones
+        _vocabularies = _load_vocabularies()
+        _vocabularies_generation = current
+
+    return _vocabularies
+
+
+def description(vocabulary, term_id):
+    """
+    Return the description of the term with the given id in a vocabulary,
+    None if there is no such term
+
+    Parameters
+    ----------
+    vocabulary : str
+        STATUS, ENTRY_TYPE or LABEL
+    term_id    : int
+    """
+    return vocabularies()[vocabulary][0].get(term_id)
+
+
+def identity(vocabulary, term):
+    """
+    Return the id of the term with the given description in a vocabulary,
+    None if there is no such term
+
+    Parameters
+    ----------
+    vocabulary : str
+        STATUS, ENTRY_TYPE or LABEL
+    term       : str
+        The description of the term
+    """
+    return vocabularies()[vocabulary][1].get(term)
+
+
+def terms(vocabulary):
+    """
+    Return the list of (id, description) of all the terms in a vocabulary,
+    ordered by id
+    """
+    return list(vocabularies()[vocabulary][0].items())
+
+
+def warm_up(**kwargs):  # pylint: disable=unused-argument
+    """
+    Load the vocabularies when the first request of the process starts, as a
+    request_started receiver disconnecting itself: the management commands
+    don't load them. The database or the cache may not be available, the
+    vocabularies are then loaded on first use.
+    """
+    request_started.disconnect(warm_up)
+
+    try:
+        vocabularies()
+    except (DatabaseError, ConnectionInterrupted) as e:
+        logger.warning("Couldn't warm up the vocabularies: %s", e)
+
+
+def refresh_vocabularies():
+    """
+    Make every process reload the vocabularies
+    """
+    global _vocabularies  # pylint: disable=global-statement
+
+    bump_generation(caches[VOCABULARY_CACHE], VOCABULARIES)
+
+    _vocabularies = None
+
+
+@receiver(post_save, sender=CvUeStatus)
+@receiver(post_save, sender=CvEntryType)
+@receiver(post_save, sender=CvUeLabel)
+@receiver(post_delete, sender=CvUeStatus)
+@receiver(post_delete, sender=CvEntryType)
+@receiver(post_delete, sender=CvUeLabel)
+def vocabulary_changed(sender, **kwargs):  # pylint: disable=unused-argument
+    """
+    Refresh the vocabularies when any of their terms changes
+    """
+    refresh_vocabularies()
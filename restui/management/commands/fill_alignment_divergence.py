@@ -17,27 +17,279 @@
 
 from __future__ import print_function
 
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db import router
+from django.db import transaction
+from django.db.models import Prefetch
+from restui.lib.cache import MAPPING_DETAIL
+from restui.lib.cache import invalidate_details
+from restui.lib.cache import invalidate_facets
+from restui.lib.cache import invalidate_groups_details
+from restui.models.mappings import Alignment
 from restui.models.mappings import Mapping
+from restui.models.mappings import MappingView
+
+logger = logging.getLogger(__name__)
+
+# tables whose alignment_difference is filled, by mapping id
+UPDATED_TABLES = ('mapping', 'mapping_view')
+
+
+def fill_chunk(mapping_ids):
+    """
+    Compute the alignment difference of a chunk of mappings and write it to
+    the mapping and mapping_view rows where it changed, then discard the
+    facets and the details of the groups of the mappings changed.
+
+    The mappings with a malformed cigar string are logged and left without
+    difference, the rest of the chunk is still written.
+
+    Parameters
+    ----------
+    mapping_ids : list of int
+
+    Returns
+    -------
+    updated : int
+        Number of rows updated, in both tables
+    malformed : int
+        Number of mappings with a malformed cigar string
+    """
+    mappings = Mapping.objects.filter(
+        pk__in=mapping_ids
+    ).prefetch_related(
+        Prefetch(
+            'alignments',
+            queryset=Alignment.objects.select_related(
+                'alignment_run',
+                'pairwise'
+            ).order_by(
+                'alignment_id'
+            )
+        )
+    )
+    malformed = 0
+    try:
+        differences = Mapping.differences(mappings)
+    except ValueError:
+        # the cigars are scored at once, find the malformed ones mapping by
+        # mapping
+        differences = {}
+        for mapping in mappings:
+            try:
+                differences.update(Mapping.differences([mapping]))
+            except ValueError as e:
+                logger.warning(
+                    "Mapping %s has a malformed cigar string: %s",
+                    mapping.mapping_id,
+                    e
+                )
+                differences[mapping.mapping_id] = None
+                malformed += 1
+
+    if not differences:
+        return 0, malformed
+
+    values = ', '.join(['(%s::bigint, %s::integer)'] * len(differences))
+    params = [value for item in differences.items() for value in item]
+
+    updated = 0
+    changed = set()
+    db = router.db_for_write(Mapping)
+    with transaction.atomic(using=db), connections[db].cursor() as cursor:
+        for table in UPDATED_TABLES:
+            cursor.execute(
+                "UPDATE {table} AS t SET alignment_difference = v.difference "
+                "FROM (VALUES {values}) AS v (mapping_id, difference) "
+                "WHERE t.mapping_id = v.mapping_id "
+                "AND t.alignment_difference IS DISTINCT FROM v.difference "
+                "RETURNING t.mapping_id".format(
+                    table=table,
+                    values=values
+                ),
+                params
+            )
+            updated += cursor.rowcount
+            changed.update(mapping_id for mapping_id, in cursor.fetchall())
+
+    if changed:
+        # the facets count the divergences, the details list the alignment
+        # difference of the related entries
+        invalidate_facets()
+        invalidate_details(MAPPING_DETAIL, *changed)
+        invalidate_groups_details(
+            MappingView.objects.filter(
+                mapping_id__in=changed
+            ).values_list(
+                'grouping_id',
+                'mapping_id',
+                'id'
+            )
+        )
+
+    return updated, malformed
+
+
+def _started():
+    # lets the parent wait for the worker processes to be forked
+    return os.getpid()
 
 
 class Command(BaseCommand):
     """
-    Base commands
+    Back-fill the protein alignment divergence of the mappings
     """
 
+    help = (
+        "Compute the alignment difference of the mappings, by chunks, and write "
+        "it to the mapping and mapping_view tables. Interrupted runs resume "
+        "after the last chunk written (see --checkpoint)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help="Number of mappings computed and written at once"
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help="Number of processes computing the chunks"
+        )
+        parser.add_argument(
+            '--checkpoint',
+            default='fill_alignment_divergence.checkpoint',
+            help="File recording the last mapping id of the chunks written"
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help="Ignore the checkpoint, start from the first mapping"
+        )
+
     def handle(self, *args, **options):
         """
         Back-filling protein alignment divergence
         """
         print("Back-filling protein alignment divergence")
 
-        mappings = Mapping.objects.all()
+        checkpoint = options['checkpoint']
+        chunk_size = options['chunk_size']
 
-        for mapping in mappings:
-            print("Mapping id {}".format(mapping.mapping_id))
-            difference = mapping.difference
+        last_mapping_id = 0
+        if not options['restart'] and os.path.exists(checkpoint):
+            with open(checkpoint) as checkpoint_file:
+                last_mapping_id = int(checkpoint_file.read().strip() or 0)
+            print("Resuming after mapping id {}".format(last_mapping_id))
+
+        mappings = Mapping.objects.filter(
+            mapping_id__gt=last_mapping_id
+        ).order_by(
+            'mapping_id'
+        )
+        total = mappings.count()
+        print("{} mappings".format(total))
+
+        executor = None
+        if options['workers'] > 1:
+            # the workers open their own connections: fork them all (the pool
+            # starts its processes with the first tasks) before the cursor
+            # streaming the ids is opened, without any connection
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=options['workers'])
+            for future in [executor.submit(_started) for _ in range(options['workers'])]:
+                future.result()
+
+        start = time.time()
+        done = 0
+        updated = 0
+        malformed = 0
+
+        # chunks being computed, in id order, with their last mapping id
+        pending = deque()
+
+        def write_oldest():
+            nonlocal done, updated, malformed
+
+            chunk_result, chunk_length, chunk_last_id = pending.popleft()
+            if executor is not None:
+                chunk_result = chunk_result.result()
+
+            self._write_checkpoint(checkpoint, chunk_last_id)
+
+            chunk_updated, chunk_malformed = chunk_result
+            done += chunk_length
+            updated += chunk_updated
+            malformed += chunk_malformed
+            self._report(done, total, updated, malformed, time.time() - start)
+
+        try:
+            chunk = []
+            ids = mappings.values_list('mapping_id', flat=True).iterator(chunk_size=chunk_size)
+
+            for mapping_id in ids:
+                chunk.append(mapping_id)
+                if len(chunk) < chunk_size:
+                    continue
+
+                pending.append(self._submit(executor, chunk))
+                chunk = []
+
+                # bound the chunks in flight, writing the checkpoint in order
+                while len(pending) >= max(options['workers'], 1) * 2:
+                    write_oldest()
+
+            if chunk:
+                pending.append(self._submit(executor, chunk))
+
+            while pending:
+                write_oldest()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        # complete, the next run starts over
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        print("Done: {} mappings, {} rows updated, {} malformed cigars in {:.1f}s".format(
+            done,
+            updated,
+            malformed,
+            time.time() - start
+        ))
+
+    @staticmethod
+    def _submit(executor, chunk):
+        if executor is None:
+            return fill_chunk(chunk), len(chunk), chunk[-1]
+
+        return executor.submit(fill_chunk, chunk), len(chunk), chunk[-1]
 
-            mapping.alignment_difference = difference
+    @staticmethod
+    def _write_checkpoint(checkpoint, mapping_id):
+        # write then rename, an interruption never leaves it half written
+        temporary_path = '{}.tmp'.format(checkpoint)
+        with open(temporary_path, 'w') as checkpoint_file:
+            checkpoint_file.write(str(mapping_id))
+        os.replace(temporary_path, checkpoint)
 
-            mapping.save()
+    @staticmethod
+    def _report(done, total, updated, malformed, elapsed):
+        print("\t{}/{} mappings, {} rows updated, {} malformed cigars, {:.0f} mappings/s".format(
+            done,
+            total,
+            updated,
+            malformed,
+            done / elapsed if elapsed else 0
+        ))
@@ -0,0 +1,133 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from restui.lib import sequence_cache
+from restui.lib.external import fetch_ensembl_sequence
+from restui.models.ensembl import TranscriptHistory
+
+# number of entries cached at once
+CHUNK_SIZE = 1000
+
+
+class Command(BaseCommand):
+    """
+    Pre-warm the sequence cache for an Ensembl release
+    """
+
+    help = (
+        "Cache the translations (ENST -> ENSP) of the transcripts loaded for an "
+        "Ensembl release, then fetch the sequences of their ENST and ENSP ids "
+        "which aren't cached yet"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('release', type=int, help="Ensembl release")
+        parser.add_argument(
+            '--species',
+            type=int,
+            help="Only the transcripts of this Ensembl taxonomy id"
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=8,
+            help="Number of sequences fetched at the same time"
+        )
+        parser.add_argument(
+            '--translations-only',
+            action='store_true',
+            help="Don't fetch the sequences"
+        )
+
+    def handle(self, *args, **options):
+        store = sequence_cache.store()
+        if store is None:
+            raise CommandError("The sequence cache is disabled (SEQUENCE_CACHE_PATH)")
+
+        release = options['release']
+        print("Warming the sequence cache for Ensembl release {}".format(release))
+
+        histories = TranscriptHistory.objects.filter(
+            ensembl_species_history__ensembl_release=release
+        )
+        if options['species'] is not None:
+            histories = histories.filter(
+                ensembl_species_history__ensembl_tax_id=options['species']
+            )
+
+        transcripts = list(
+            histories.values_list(
+                'transcript__enst_id',
+                'transcript__ensp_id'
+            ).distinct()
+        )
+        print("{} transcripts".format(len(transcripts)))
+
+        # the translations are known from the load, no need to ask Ensembl
+        translations = [
+            (sequence_cache.TRANSLATION, enst_id, release, ensp_id)
+            for enst_id, ensp_id in transcripts
+            if enst_id and ensp_id
+        ]
+        for start in range(0, len(translations), CHUNK_SIZE):
+            store.set_many(translations[start:start + CHUNK_SIZE])
+        print("Cached {} translations".format(len(translations)))
+
+        if options['translations_only']:
+            return
+
+        stable_ids = {
+            stable_id
+            for transcript in transcripts
+            for stable_id in transcript
+            if stable_id and store.get(sequence_cache.SEQUENCE, stable_id, release) is None
+        }
+        print("Fetching {} sequences".format(len(stable_ids)))
+
+        def fetch(stable_id):
+            try:
+                return stable_id, fetch_ensembl_sequence(stable_id, release)
+            except Exception as e:  # pylint: disable=broad-except
+                print("{}: {}".format(stable_id, e))
+                return stable_id, None
+
+        # the sequences are fetched concurrently, and cached by chunks
+        fetched = 0
+        chunk = []
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for count, (stable_id, sequence) in enumerate(executor.map(fetch, stable_ids), 1):
+                if sequence is not None:
+                    chunk.append((sequence_cache.SEQUENCE, stable_id, release, sequence))
+
+                if len(chunk) == CHUNK_SIZE:
+                    store.set_many(chunk)
+                    fetched += len(chunk)
+                    chunk = []
+
+                if count % 1000 == 0:
+                    print("\t{}/{}".format(count, len(stable_ids)))
+
+        if chunk:
+            store.set_many(chunk)
+            fetched += len(chunk)
+
+        print("Cached {} sequences, {} failed".format(fetched, len(stable_ids) - fetched))
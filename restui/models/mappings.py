@@ -16,15 +16,91 @@
 """
 
 from collections import defaultdict
+from collections import OrderedDict
 
+from django.contrib.auth import get_user_model
+from django.contrib.postgres.search import TrigramSimilarity
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections
 from django.db import models
 from django.db.models import Count
 from django.db.models import Case
+from django.db.models import Q
 from django.db.models import When
+from django.db.models.functions import Greatest
+from django.db.models.functions import Lower
+from restui.lib import vocabulary
 from restui.lib.alignments import calculate_difference
-from restui.models.annotations import CvEntryType
-from restui.models.annotations import CvUeStatus
-from restui.models.ensembl import EnsemblSpeciesHistory
+from restui.lib.alignments import calculate_differences
+from restui.lib.memo import memoised
+from restui.models.annotations import UeMappingStatus
+
+# allow lookups like gene_name__lower__startswith, which compile to
+# lower(gene_name) LIKE 'term%' and can use the lower() expression indexes
+# on mapping_view (iregex/istartswith can't)
+models.CharField.register_lookup(Lower)
+
+def status_histories(mapping_ids, usernames=False):
+    """
+    Load the status history of the given mappings, with one query for the
+    statuses and, with usernames, one for the users (who live in the default
+    database, so they can't be joined)
+
+    Parameters
+    ----------
+    mapping_ids : iterable of int
+    usernames   : bool
+        Whether to give the full name of the user who set each status
+
+    Returns
+    -------
+    histories : defaultdict
+        mapping id -> list of {'status', 'time_stamp', 'user'} dicts in
+        chronological order, empty for mappings without history
+    """
+    mapping_ids = set(mapping_ids)
+    mapping_ids.discard(None)
+
+    records = defaultdict(list)
+    user_ids = set()
+
+    if mapping_ids:
+        status_set = UeMappingStatus.objects.filter(
+            mapping_id__in=mapping_ids
+        ).order_by(
+            'time_stamp'
+        ).values_list(
+            'mapping_id', 'status_id', 'time_stamp', 'user_stamp_id'
+        )
+
+        for mapping_id, status_id, time_stamp, user_id in status_set:
+            records[mapping_id].append((status_id, time_stamp, user_id))
+            user_ids.add(user_id)
+
+    user_ids.discard(None)
+
+    users = {}
+    if usernames and user_ids:
+        users = dict(
+            get_user_model().objects.filter(
+                pk__in=user_ids
+            ).values_list(
+                'pk', 'full_name'
+            )
+        )
+
+    histories = defaultdict(list)
+    for mapping_id, mapping_records in records.items():
+        histories[mapping_id] = [
+            {
+                'status': vocabulary.description(vocabulary.STATUS, status_id),
+                'time_stamp': time_stamp,
+                'user': users.get(user_id)
+            }
+            for status_id, time_stamp, user_id in mapping_records
+        ]
+
+    return histories
 
 
 class Alignment(models.Model):
@@ -52,6 +128,7 @@ class Alignment(models.Model):
     class Meta:
         managed = False
         db_table = 'alignment'
+        unique_together = (('alignment_run', 'mapping'),)
 
 
 class AlignmentRun(models.Model):
@@ -159,9 +236,7 @@ class MappingQuerySet(models.query.QuerySet):
         grouped_results_added = defaultdict(set)
 
         for result in sub_qs:
-            grouping_id = result.mapping_history.latest(
-                'release_mapping_history__time_mapped'
-            ).grouping_id
+            grouping_id = result.latest_mapped_history().grouping_id
 
             # skip if the mapping has already been added to the group
             if result.mapping_id in grouped_results_added[grouping_id]:
@@ -169,13 +244,11 @@ class MappingQuerySet(models.query.QuerySet):
 
             # a mapping might refer to an older release mapping history,
             # keep only those relative to the most recent for a certain species
-            result_rmh = result.mapping_history.latest(
-                'release_mapping_history__time_mapped'
-            ).release_mapping_history
+            result_rmh = result.latest_mapped_history().release_mapping_history
             result_species = result_rmh.uniprot_taxid
-            species_latest_rmh = ReleaseMappingHistory.objects.filter(
-                uniprot_taxid=result_species
-            ).latest('time_mapped')
+            species_latest_rmh = ReleaseMappingHistory.latest_for_species(
+                result_species
+            )
 
             if result_rmh != species_latest_rmh:
                 continue
@@ -303,52 +376,115 @@ class Mapping(models.Model):
 
         return None
 
+    @staticmethod
+    def differences(mappings):
+        """
+        Return the difference of many mappings, as the difference property
+        does for one, with all their cigar strings scored at once (see
+        calculate_differences).
+
+        The mappings should have their alignments prefetched, with their run
+        and pairwise row. Identity alignments without pairwise row are
+        skipped.
+
+        Returns
+        -------
+        dict
+            mapping id -> difference
+        """
+        differences = {}
+        cigars = OrderedDict()
+
+        for mapping in mappings:
+            differences[mapping.mapping_id] = None
+
+            for alignment in mapping.alignments.all():
+                if (
+                        alignment.alignment_run.score1_type == 'perfect_match' and
+                        alignment.score1 == 1
+                ):
+                    differences[mapping.mapping_id] = 0
+                    cigars.pop(mapping.mapping_id, None)
+                    break
+
+                if alignment.alignment_run.score1_type == 'identity':
+                    try:
+                        cigars[mapping.mapping_id] = alignment.pairwise.cigarplus
+                    except ObjectDoesNotExist:
+                        pass
+
+        for mapping_id, diff_count in zip(cigars, calculate_differences(cigars.values())):
+            differences[mapping_id] = diff_count or None
+
+        return differences
+
+    def latest_history(self):
+        """
+        Return the latest history of the mapping, with its release and species
+        histories, memoised for the request
+        """
+        return memoised(
+            'mapping_latest_history',
+            self.mapping_id,
+            lambda: self.mapping_history.select_related(
+                'release_mapping_history__ensembl_species_history'
+            ).latest(
+                'mapping_history_id'
+            )
+        )
+
+    def latest_mapped_history(self):
+        """
+        Return the history of the mapping in its latest mapped release, with
+        the release and species histories, memoised for the request
+        """
+        return memoised(
+            'mapping_latest_mapped_history',
+            self.mapping_id,
+            lambda: self.mapping_history.select_related(
+                'release_mapping_history__ensembl_species_history'
+            ).latest(
+                'release_mapping_history__time_mapped'
+            )
+        )
+
     def statuses(self, usernames=False):
         """
-        Return a list of all the status history of this mapping
+        Return a list of all the status history of this mapping, as loaded by
+        prefetch_statuses if it was called for this mapping
         """
-        status_set = self.status_history.order_by('time_stamp')
-        statuses = []
+        if getattr(self, '_status_history_usernames', None) != usernames:
+            Mapping.prefetch_statuses([self], usernames=usernames)
 
-        for status in status_set:
-            if usernames and status.user_stamp:
-                user = status.user_stamp.full_name
-            else:
-                user = None
+        return self._status_history
+
+    @classmethod
+    def prefetch_statuses(cls, mappings, usernames=False):
+        """
+        Load the status history of all the given mappings at once (see
+        status_histories) and hand each mapping its history so that
+        statuses() doesn't query the database.
+        """
+        mappings = list(mappings)
 
-            statuses.append({
-                'status': Mapping.status_type(status.status.id),
-                'time_stamp': status.time_stamp,
-                'user': user
-            })
+        histories = status_histories(
+            [mapping.mapping_id for mapping in mappings],
+            usernames=usernames
+        )
 
-        return statuses
+        for mapping in mappings:
+            mapping._status_history = histories[mapping.mapping_id]  # pylint: disable=protected-access
+            mapping._status_history_usernames = usernames  # pylint: disable=protected-access
 
 
-    # The goal of these two functions is to reduce the number of database calls.
-    # Rather than a lookup per mapping record, we'll cache these constants for
-    # the life of the request in the serializer class.
-    _entry_type = {}
-    _status_type = {}
+    # The vocabularies are cached process wide, see restui.lib.vocabulary
     @classmethod
     def entry_type(cls, identity):
-        if not cls._entry_type:
-            entries = {}
-            for entry in CvEntryType.objects.all():
-                entries[entry.id] = entry.description
-            cls._entry_type = entries
-
-        return cls._entry_type[identity]
+        return vocabulary.description(vocabulary.ENTRY_TYPE, identity)
 
     @classmethod
     def status_type(cls, identity):
-        if not cls._status_type:
-            statuses = {}
-            for status in CvUeStatus.objects.all():
-                statuses[status.id] = status.description
-            cls._status_type = statuses
-
-        return cls._status_type[identity]
+        return vocabulary.description(vocabulary.STATUS, identity)
 
     def __str__(self):
         return "{0} - ({1}, {2})".format(
@@ -367,6 +503,22 @@ class Mapping(models.Model):
 class MappingViewQuerySet(models.query.QuerySet):
     _counts = None
 
+    # facet name -> SQL expression over mapping_view the facet is counted on
+    facet_expressions = OrderedDict([
+        ('status', "status"),
+        ('organism', "uniprot_tax_id"),
+        ('divergence', (
+            "CASE"
+            " WHEN alignment_difference = 0 THEN 'identical'"
+            " WHEN alignment_difference > 0 AND alignment_difference <= 5 THEN 'small'"
+            " WHEN alignment_difference > 5 THEN 'large'"
+            " END"
+        )),
+        ('chromosome', "chromosome"),
+        ('type', "uniprot_mapping_status"),
+        ('patch', "COALESCE(region_accession ~* '^CHR', FALSE)"),
+    ])
+
     def grouped_counts(self):
         """
         Retrieve a list of unique grouping_id counts from a queryset.
@@ -434,79 +586,256 @@ class MappingViewQuerySet(models.query.QuerySet):
 
         return grouped_results
 
-    def statuses(self):
+    def grouped_window_slice(self, offset, limit, score=None):
         """
-        Return a list of all the statuses represented in this queryset
+        Fetch a subset of MappingView records grouped by unique grouping_id,
+        along with the total number of groups, in a single query.
+
+        Groups are ranked in SQL with DENSE_RANK() over the descending
+        grouping_id (records without a grouping_id rank first, as one group)
+        and only the rows of the groups ranked offset+1 to offset+limit are
+        returned, each carrying the total number of groups in the queryset.
+
+        When score is given, groups are ranked by the best score of their
+        records first, ties broken by the descending grouping_id.
+
+        Parameters
+        ----------
+        offset : int
+        limit  : int
+        score  : str
+            Name of an annotation of the queryset to rank the groups by,
+            eg search_similarity (see fuzzy_search)
+
+        Returns
+        -------
+        (grouped_results, total) : tuple
+            grouped_results is the same dict of lists as in grouped_slice,
+            total is the number of groups, 0 if the slice is empty
         """
-        status_set = self.values('status').distinct()
+        compiler = self.order_by().query.get_compiler(using=self.db)
+        filtered_sql, filtered_params = compiler.as_sql()
 
-        status_list = []
-        for status in status_set:
-            status_list.append(status['status'])
+        if score is None:
+            group_score = ""
+            group_order = "scored.grouping_id DESC"
+        else:
+            group_score = (
+                ", MAX(filtered.\"{}\") OVER (PARTITION BY filtered.grouping_id)"
+                " AS group_score"
+            ).format(score)
+            group_order = "scored.group_score DESC, scored.grouping_id DESC"
+
+        sql = (
+            "SELECT * FROM ("
+            " SELECT ranked.*, MAX(ranked.group_rank) OVER () AS group_total"
+            " FROM ("
+            "  SELECT scored.*,"
+            "   DENSE_RANK() OVER (ORDER BY {order}) AS group_rank"
+            "  FROM (SELECT filtered.*{score} FROM ({filtered}) filtered) scored"
+            " ) ranked"
+            ") counted"
+            " WHERE counted.group_rank > %s AND counted.group_rank <= %s"
+            " ORDER BY counted.group_rank"
+        ).format(order=group_order, score=group_score, filtered=filtered_sql)
+
+        params = tuple(filtered_params) + (offset, offset + limit)
+
+        grouped_results = OrderedDict()
+        total = 0
+
+        for result in self.raw(sql, params):
+            total = result.group_total
 
-        return status_list
+            try:
+                grouped_results[result.grouping_id].append(result)
+            except KeyError:
+                grouped_results[result.grouping_id] = [result]
 
-    def species(self):
+        return grouped_results, total
+
+    def grouped_total(self):
         """
-        Return a list of all the unique (tax_id, species name) tuples in this queryset
+        Retrieve the total number of groups based on unique grouping_id with
+        a single aggregate query, without materialising the per-group counts.
+        Records without a grouping_id are counted as one group, as they are
+        by grouped_counts().
         """
-        species_set = self.values('uniprot_tax_id').distinct()
+        totals = self.aggregate(
+            groups=Count('grouping_id', distinct=True),
+            ungrouped=Count('id', filter=Q(grouping_id__isnull=True))
+        )
 
-        species_list = []
-        for species in species_set:
-            species_name = EnsemblSpeciesHistory.objects.filter(
-                ensembl_tax_id=species['uniprot_tax_id']
-            ).latest(
-                'time_loaded'
-            ).species
-            species_list.append((species['uniprot_tax_id'], species_name))
+        return totals['groups'] + (1 if totals['ungrouped'] else 0)
 
-        return species_list
+    def keyset_grouping_ids(self, limit, after=None, skip_ungrouped=False):
+        """
+        Return up to limit unique grouping_ids in descending order, starting
+        right after a previously served grouping_id.
 
-    def divergences(self):
+        Records without a grouping_id sort first in descending order, so they
+        are only returned when the page does not start after another group.
+
+        Parameters
+        ----------
+        limit          : int
+        after          : int, the last grouping_id already served
+        skip_ungrouped : bool, whether the ungrouped records have already
+                         been served
+
+        Returns
+        -------
+        grouping_ids : list
         """
-        Return a list of all the alignment differences levels represented in the queryset
+        queryset = self
+        if after is not None:
+            queryset = queryset.filter(grouping_id__lt=after)
+        elif skip_ungrouped:
+            queryset = queryset.filter(grouping_id__isnull=False)
+
+        return list(
+            queryset.order_by(
+                '-grouping_id'
+            ).values_list(
+                'grouping_id', flat=True
+            ).distinct()[:limit]
+        )
+
+    def grouped_by_ids(self, grouping_ids):
         """
-        identical = self.filter(alignment_difference=0).count()
+        Fetch the MappingView records for the given grouping_ids, packaged up
+        as in grouped_slice() in a dict of lists keyed by grouping_id
+        """
+        group_filter = Q(
+            grouping_id__in=[g for g in grouping_ids if g is not None]
+        )
+        if None in grouping_ids:
+            group_filter |= Q(grouping_id__isnull=True)
 
-        small = self.filter(
-            alignment_difference__gt=0,
-            alignment_difference__lte=5
-        ).count()
+        grouped_results = OrderedDict(
+            (grouping_id, []) for grouping_id in grouping_ids
+        )
 
-        large = self.filter(alignment_difference__gt=5).count()
+        for result in self.filter(group_filter).order_by('-grouping_id'):
+            grouped_results[result.grouping_id].append(result)
 
-        return [identical, small, large]
+        return grouped_results
 
-    def chromosomes(self):
-        """
-        Return a list of all chromosomes for the genes represented in the queryset
+    def prefix_search(self, term, *fields):
         """
-        chromosomes = []
+        Filter the records having any of the given fields starting with
+        term, case insensitive.
 
-        for pair in self.values('chromosome').distinct():
-            if pair['chromosome']:
-                chromosomes.append(pair['chromosome'])
+        The term is matched literally (% and _ are escaped), the comparison
+        is made on lower(field) so that it's served by the
+        mapping_view_<field>_lower_idx indexes.
 
-        return sorted(chromosomes)
+        Parameters
+        ----------
+        term : str
+            The prefix to look for
+        fields : str
+            Names of the char fields to search
 
-    def types(self):
+        Returns
+        -------
+        queryset : MappingViewQuerySet
         """
-        Return a list of all mapping types
+        query_filter = Q()
+        for field in fields:
+            query_filter |= Q(**{'{}__lower__startswith'.format(field): term.lower()})
+
+        return self.filter(query_filter)
+
+    def fuzzy_search(self, term, *fields):
         """
-        mappings = []
+        Filter the records having any of the given fields similar to term,
+        according to pg_trgm (the % operator, served by the
+        mapping_view_<field>_trgm_idx GIN indexes).
 
-        for pair in self.values('uniprot_mapping_status').distinct():
-            mappings.append(pair['uniprot_mapping_status'])
+        The records are annotated with search_similarity, the best trigram
+        similarity of their fields to term, to rank the results by.
 
-        return mappings
+        Parameters
+        ----------
+        term : str
+            The (possibly mistyped) term to look for
+        fields : str
+            Names of the char fields to search
+
+        Returns
+        -------
+        queryset : MappingViewQuerySet
+        """
+        query_filter = Q()
+        similarities = []
+        for field in fields:
+            query_filter |= Q(**{'{}__trigram_similar'.format(field): term})
+            similarities.append(TrigramSimilarity(field, term))
+
+        if len(similarities) > 1:
+            similarity = Greatest(*similarities)
+        else:
+            similarity = similarities[0]
+
+        return self.filter(query_filter).annotate(search_similarity=similarity)
 
-    def has_patches(self):
+    def facet_counts(self):
         """
-        Return whether the queryset has entries defined on patches
+        Count the records of the queryset for every value of every facet
+        (see facet_expressions) in one aggregate query using GROUPING SETS.
+
+        Returns
+        -------
+        facets : OrderedDict
+            facet name -> list of (value, count) tuples sorted by value,
+            None values included, eg
+            {
+              'status': [(1, 19), (5, 6)],
+              'organism': [(9606, 25)],
+              'divergence': [('identical', 10), ('large', 3), (None, 12)],
+              ...
+              'patch': [(False, 24), (True, 1)]
+            }
         """
+        names = list(self.facet_expressions.keys())
+        compiler = self.order_by().query.get_compiler(using=self.db)
+        filtered_sql, filtered_params = compiler.as_sql()
+
+        columns = ', '.join('"{}"'.format(name) for name in names)
+        sql = (
+            "SELECT {columns}, GROUPING({columns}) AS facet_set, COUNT(*) AS total"
+            " FROM (SELECT {expressions} FROM ({filtered}) filtered) facet"
+            " GROUP BY GROUPING SETS ({sets})"
+        ).format(
+            columns=columns,
+            expressions=', '.join(
+                '{} AS "{}"'.format(expression, name)
+                for name, expression in self.facet_expressions.items()
+            ),
+            filtered=filtered_sql,
+            sets=', '.join('("{}")'.format(name) for name in names)
+        )
+
+        # GROUPING() sets the bit of every column not grouped in the row,
+        # the leftmost column being the most significant bit
+        all_bits = (1 << len(names)) - 1
+        facet_sets = {
+            all_bits ^ (1 << (len(names) - 1 - i)): i for i in range(len(names))
+        }
+
+        facets = OrderedDict((name, []) for name in names)
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, filtered_params)
+
+            for row in cursor.fetchall():
+                index = facet_sets[row[-2]]
+                facets[names[index]].append((row[index], row[-1]))
 
-        return self.filter(region_accession__iregex=r"^CHR").count() > 0
+        for values in facets.values():
+            values.sort(key=lambda value: (value[0] is None, value[0]))
+
+        return facets
 
 
 class MappingViewManager(models.Manager):
@@ -532,6 +861,18 @@ class ReleaseMappingHistory(models.Model):
     uniprot_taxid = models.BigIntegerField(blank=True, null=True)
     status = models.CharField(max_length=20, blank=True, null=True)
 
+    @classmethod
+    def latest_for_species(cls, tax_id):
+        """
+        Return the latest release mapping history of a species, memoised for
+        the request
+        """
+        return memoised(
+            'species_latest_release_mapping_history',
+            tax_id,
+            lambda: cls.objects.filter(uniprot_taxid=tax_id).latest('time_mapped')
+        )
+
     class Meta:
         managed = False
         db_table = 'release_mapping_history'
@@ -673,66 +1014,46 @@ class MappingView(models.Model):
 
     def statuses(self, usernames=False):
         """
-        Return a list of all the status history of a mapping
+        Return a list of all the status history of a mapping, as loaded by
+        prefetch_statuses if it was called for this mapping view
         """
+        if getattr(self, '_status_history_usernames', None) != usernames:
+            MappingView.prefetch_statuses([self], usernames=usernames)
 
-        statuses = []
+        return self._status_history
 
-        try:
-            mapping = Mapping.objects.get(pk=self.mapping_id)
-            status_set = mapping.status_history.order_by('time_stamp')
-
-            for status in status_set:
-                if usernames and status.user_stamp:
-                    user = status.user_stamp.full_name
-                else:
-                    user = None
-
-                    statuses.append({
-                        'status': MappingView.status_type(status.status.id),
-                        'time_stamp': status.time_stamp,
-                        'user': user
-                    })
-        except:
-            pass  # no mapping ID: cannot get status
+    @classmethod
+    def prefetch_statuses(cls, mapping_views, usernames=False):
+        """
+        Load the status history of all the given mapping views at once (see
+        status_histories) and hand each mapping view its history so that
+        statuses() doesn't query the database.
 
-        return statuses
+        Parameters
+        ----------
+        mapping_views : iterable of MappingView
+        usernames     : bool
+            Whether to give the full name of the user who set each status
+        """
+        mapping_views = list(mapping_views)
 
-    # The goal of these two functions is to reduce the number of database calls.
-    # Rather than a lookup per mapping record, we'll cache these constants for
-    # the life of the request in the serializer class.
-    _entry_type = {}
-    _status_type = {}
+        histories = status_histories(
+            [mapping_view.mapping_id for mapping_view in mapping_views],
+            usernames=usernames
+        )
 
+        for mapping_view in mapping_views:
+            mapping_view._status_history = histories[mapping_view.mapping_id]  # pylint: disable=protected-access
+            mapping_view._status_history_usernames = usernames  # pylint: disable=protected-access
+
+    # The vocabularies are cached process wide, see restui.lib.vocabulary
     @classmethod
     def entry_description(cls, identity):
-        if not cls._entry_type:
-            entries = {}
-            for entry in CvEntryType.objects.all():
-                entries[entry.id] = entry.description
-            cls._entry_type = entries
-
-        try:
-            return cls._entry_type[identity]
-        except KeyError:
-            pass
-
-        return None
+        return vocabulary.description(vocabulary.ENTRY_TYPE, identity)
 
     @classmethod
     def status_description(cls, identity):
-        if not cls._status_type:
-            statuses = {}
-            for status in CvUeStatus.objects.all():
-                statuses[status.id] = status.description
-            cls._status_type = statuses
-
-        try:
-            return cls._status_type[identity]
-        except KeyError:
-            pass
-
-        return None
+        return vocabulary.description(vocabulary.STATUS, identity)
 
     class Meta:
         managed = False
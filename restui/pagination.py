@@ -17,9 +17,13 @@
 
 from collections import OrderedDict
 from rest_framework import status
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
 from rest_framework.pagination import LimitOffsetPagination, PageNumberPagination
+from rest_framework.utils.urls import replace_query_param
 
+from restui.lib.cache import cached_facets
+from restui.lib.species import species_name
 from restui.serializers.mappings import MappingsSerializer
 from restui.serializers.mappings import MappingViewsSerializer
 from restui.serializers.unmapped import UnmappedEnsemblEntrySerializer
@@ -148,15 +152,38 @@ class FacetPagination(LimitOffsetPagination):
         ]))
 
 class MappingViewFacetPagination(LimitOffsetPagination):
+    """
+    Paginate mapping views by groups, either by limit/offset or, when the
+    'cursor' query parameter is given, by keyset on the grouping_id.
+
+    In cursor mode the cursor is the last grouping_id served ('null' when that
+    was the group of records without a grouping_id, empty for the first page)
+    so that deep pages cost the same as the first one. Cursor pages only link
+    forward.
+
+    When the view ranks the search results (search_score, eg fuzzy search),
+    groups are ordered by score and paginated by limit/offset only.
+    """
+
+    cursor_query_param = 'cursor'
+    ungrouped_cursor = 'null'
+
     def __init__(self):
         self.count = None
         self.limit = None
         self.offset = None
+        self.cursor = None
+        self.next_cursor = None
         self.request = None
         self.facets = None
         self.display_page_controls = None
 
     def create_facets(self, queryset):
+        """
+        Build the facets of the result set, all counted in a single query
+        """
+        facet_counts = queryset.facet_counts()
+
         statuses = OrderedDict([
             ('name', 'status'),
             ('label', 'Status'),
@@ -187,79 +214,126 @@ class MappingViewFacetPagination(LimitOffsetPagination):
             ('items', [])
         ])
 
-        if queryset.has_patches():
-            patches["items"].append({'name': 'include', 'label': 'Include'})
-            patches["items"].append({'name': 'exclude', 'label': 'Exclude'})
-            patches["items"].append({'name': 'only', 'label': 'Only patches'})
+        patch_counts = dict(facet_counts['patch'])
+        if patch_counts.get(True):
+            patches["items"].append({
+                'name': 'include',
+                'label': 'Include',
+                'count': sum(patch_counts.values())
+            })
+            patches["items"].append({
+                'name': 'exclude',
+                'label': 'Exclude',
+                'count': patch_counts.get(False, 0)
+            })
+            patches["items"].append({
+                'name': 'only',
+                'label': 'Only patches',
+                'count': patch_counts[True]
+            })
+
+        for tax_id, count in facet_counts['organism']:
+            if tax_id is None:
+                continue
 
-        species_set = queryset.species()
-        for species in species_set:
             organism["items"].append({
-                "name": species[0],
-                "label": species[1]
+                "name": tax_id,
+                "label": species_name(tax_id),
+                "count": count
             })
 
-        for query_status in queryset.statuses():
-            try:
-                description = MappingView.status_description(query_status)
-                statuses["items"].append({
-                    "name": description,
-                    "label": description.replace(
-                        "_", " "
-                    ).capitalize()
-                })
-            except:
-                pass
+        for query_status, count in facet_counts['status']:
+            description = MappingView.status_description(query_status)
+            if description is None:
+                continue
 
-        differences = queryset.divergences()
-        if differences[0]:
-            sequence["items"].append({
-                "label": "Identical",
-                "name": "identical",
-                "count": differences[0]
+            statuses["items"].append({
+                "name": description,
+                "label": description.replace(
+                    "_", " "
+                ).capitalize(),
+                "count": count
             })
 
-        if differences[1]:
-            sequence["items"].append({
-                "label": "Small diff",
-                "name": "small",
-                "count": differences[1]
-            })
+        differences = dict(facet_counts['divergence'])
+        for name, label in (
+                ('identical', 'Identical'),
+                ('small', 'Small diff'),
+                ('large', 'Large diff')
+        ):
+            if differences.get(name):
+                sequence["items"].append({
+                    "label": label,
+                    "name": name,
+                    "count": differences[name]
+                })
 
-        if differences[2]:
-            sequence["items"].append({
-                "label": "Large diff",
-                "name": "large",
-                "count": differences[2]
-            })
+        for mapping_type, count in facet_counts['type']:
+            if mapping_type is None:
+                continue
 
-        for mapping_type in queryset.types():
             types["items"].append({
                 'name': mapping_type,
                 'label': mapping_type.replace(
                     "_", " "
-                ).capitalize()
+                ).capitalize(),
+                'count': count
             })
 
-        if len(species_set) == 1:
+        if len(organism["items"]) == 1:
             chromosomes = OrderedDict([
                 ('name', 'chromosomes'),
                 ('label', 'Chromosomes'),
                 ('items', [])
             ])
 
-            for chromosome in queryset.chromosomes():
+            for chromosome, count in facet_counts['chromosome']:
+                if not chromosome:
+                    continue
+
                 chromosomes["items"].append({
                     'name': chromosome.lower(),
-                    'label': chromosome.upper()
+                    'label': chromosome.upper(),
+                    'count': count
                 })
 
             return [statuses, organism, sequence, chromosomes, types, patches]
 
         return [statuses, organism, sequence, types, patches]
 
+    def get_facets(self, queryset, view):
+        """
+        Return the facets of the search, from the facets cache when the view
+        provides a key for the search
+        """
+        key = getattr(view, 'facets_cache_key', None)
+        if key is None:
+            return self.create_facets(queryset)
+
+        return cached_facets(key, lambda: self.create_facets(queryset))
+
+    def get_cursor(self, request):
+        """
+        Return the cursor query parameter, None when not in cursor mode
+        """
+        cursor = request.query_params.get(self.cursor_query_param)
+
+        if cursor is None or cursor in ('', self.ungrouped_cursor):
+            return cursor
+
+        try:
+            return int(cursor)
+        except ValueError:
+            raise NotFound('Invalid cursor')
+
     def paginate_queryset(self, queryset, request, view=None):
-        self.count = queryset.grouped_count
+        score = getattr(view, 'search_score', None)
+
+        # keyset pagination relies on groups ordered by grouping_id
+        self.cursor = self.get_cursor(request) if score is None else None
+        if self.cursor is not None:
+            return self.paginate_queryset_by_cursor(queryset, request, view)
+
         self.limit = self.get_limit(request)
 
         if self.limit is None:
@@ -268,22 +342,91 @@ class MappingViewFacetPagination(LimitOffsetPagination):
         self.offset = self.get_offset(request)
 
         self.request = request
+
+        # the page groups and the total number of groups come in one query
+        grouped_results, self.count = queryset.grouped_window_slice(
+            self.offset,
+            self.limit,
+            score=score
+        )
+
         if self.count > self.limit and self.template is not None:
             self.display_page_controls = True
 
-        if self.count == 0 or self.offset > self.count:
+        if not grouped_results:
             return []
 
-        mapping_groups = []
-        self.facets = self.create_facets(queryset)
-        for _, group in queryset.grouped_slice(self.offset, self.limit).items():
-            mapping_groups.append(
-                MappingViewsSerializer.build_mapping_group(
-                    group
-                )
+        self.facets = self.get_facets(queryset, view)
+
+        return MappingViewsSerializer.build_mapping_groups(
+            list(grouped_results.values())
+        )
+
+    def paginate_queryset_by_cursor(self, queryset, request, view=None):
+        """
+        Fetch the next limit groups after the cursor by keyset on grouping_id,
+        one more group is looked up to know whether there is a next page
+        """
+        self.limit = self.get_limit(request)
+
+        if self.limit is None:
+            return None
+
+        self.request = request
+        self.count = queryset.grouped_total()
+
+        if self.count == 0:
+            return []
+
+        if isinstance(self.cursor, int):
+            grouping_ids = queryset.keyset_grouping_ids(
+                self.limit + 1,
+                after=self.cursor
+            )
+        else:
+            grouping_ids = queryset.keyset_grouping_ids(
+                self.limit + 1,
+                skip_ungrouped=self.cursor == self.ungrouped_cursor
             )
 
-        return mapping_groups
+        if not grouping_ids:
+            return []
+
+        self.next_cursor = None
+        if len(grouping_ids) > self.limit:
+            grouping_ids = grouping_ids[:self.limit]
+            last_grouping_id = grouping_ids[-1]
+            if last_grouping_id is None:
+                self.next_cursor = self.ungrouped_cursor
+            else:
+                self.next_cursor = last_grouping_id
+
+        if self.next_cursor is not None and self.template is not None:
+            self.display_page_controls = True
+
+        self.facets = self.get_facets(queryset, view)
+
+        return MappingViewsSerializer.build_mapping_groups(
+            list(queryset.grouped_by_ids(grouping_ids).values())
+        )
+
+    def get_next_link(self):
+        if self.cursor is None:
+            return super(MappingViewFacetPagination, self).get_next_link()
+
+        if self.next_cursor is None:
+            return None
+
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_previous_link(self):
+        if self.cursor is None:
+            return super(MappingViewFacetPagination, self).get_previous_link()
+
+        return None
 
     def get_paginated_response(self, data):
 
@@ -4,6 +4,7 @@ from psqlextra.query import ConflictAction
 # flatten list of lists, i.e. list of transcripts for each gene
 from itertools import chain
 
+from restui.lib.cache import invalidate_facets
 from restui.models.ensembl import EnsemblGene
 from restui.models.ensembl import EnsemblTranscript
 from restui.models.ensembl import EnsemblSpeciesHistory
@@ -144,3 +145,6 @@ def bulk_upload(task, history, data):
     species_history.time_loaded = timezone.now()
     species_history.status = 'LOAD_COMPLETE'
     species_history.save()
+
+    # search facets might refer to the previous release
+    invalidate_facets()
@@ -17,19 +17,65 @@
 
 from __future__ import print_function
 
+import logging
+from collections import defaultdict
+
+import requests
 from rest_framework import serializers
 from django.http import Http404
 
 from restui.lib.external import ensembl_sequence
+from restui.lib.external import ensembl_sequences
+from restui.lib.species import species_name
 from restui.models.mappings import Mapping
 from restui.models.mappings import MappingView
 from restui.models.mappings import ReleaseMappingHistory
 from restui.models.mappings import MappingHistory
 from restui.models.mappings import ReleaseStats
-from restui.models.ensembl import EnsemblSpeciesHistory
 from restui.serializers.ensembl import SpeciesHistorySerializer
 from restui.serializers.annotations import StatusHistorySerializer
 
+logger = logging.getLogger(__name__)
+
+
+def fetch_sequences(transcripts):
+    """
+    Fetch the sequences of many transcripts with one batch of Ensembl REST
+    lookups per release (see restui.lib.external.ensembl_sequences)
+
+    Parameters
+    ----------
+    transcripts : iterable of (enst_id, release) tuples
+
+    Returns
+    -------
+    dict
+        (enst_id, release) -> sequence, without those which couldn't be
+        fetched
+    """
+    enst_ids = defaultdict(set)
+    for enst_id, release in transcripts:
+        if enst_id:
+            enst_ids[release].add(enst_id)
+
+    sequences = {}
+    for release, release_enst_ids in enst_ids.items():
+        try:
+            release_sequences = ensembl_sequences(release_enst_ids, release)
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(
+                "Couldn't fetch the sequences of %s in release %s: %s",
+                ', '.join(sorted(release_enst_ids)),
+                release,
+                e
+            )
+            continue
+
+        for enst_id, sequence in release_sequences.items():
+            sequences[(enst_id, release)] = sequence
+
+    return sequences
+
 
 class TaxonomySerializer(serializers.Serializer):
     """
@@ -117,7 +163,18 @@ class RelatedEntriesSerializer(serializers.Serializer):
     unmapped = EnsemblUniprotRelatedUnmappedSerializer()
 
 
-class MappingSerializer(serializers.Serializer):
+class MappingDetailSerializer(serializers.Serializer):
+    """
+    Serialize the detail of a mapping, i.e. the mapping, its taxonomy and its
+    related entries.
+    """
+
+    taxonomy = TaxonomySerializer()
+    mapping = EnsemblUniprotMappingSerializer()
+    relatedEntries = RelatedEntriesSerializer()
+
+
+class MappingSerializer(MappingDetailSerializer):
     """
     Serialize data in call to mapping/:id endpoint.
 
@@ -125,12 +182,18 @@ class MappingSerializer(serializers.Serializer):
     https://github.com/ebi-uniprot/gifts-mock/blob/master/data/mapping.json
     """
 
-    taxonomy = TaxonomySerializer()
-    mapping = EnsemblUniprotMappingSerializer()
-    relatedEntries = RelatedEntriesSerializer()
     emailRecipientsList = serializers.DictField(child=serializers.CharField())
 
 
+class MappingDetailsSerializer(serializers.Serializer):
+    """
+    Serialize data in call to mappings/details/ endpoint.
+    """
+
+    results = MappingDetailSerializer(many=True)
+    notFound = serializers.ListField(child=serializers.IntegerField())
+
+
 class MappingHistorySerializer(serializers.ModelSerializer):
     """
     Serializer for MappingHistory instances
@@ -175,22 +238,24 @@ class MappingsSerializer(serializers.Serializer):
     entryMappings = EnsemblUniprotMappingSerializer(many=True)
 
     @classmethod
-    def build_mapping(cls, mapping, fetch_sequence=False, authenticated=False):
-        mapping_history = mapping.mapping_history.select_related(
-            'release_mapping_history'
-        ).select_related(
-            'release_mapping_history__ensembl_species_history'
-        ).latest(
-            'mapping_history_id'
-        )
+    def build_mapping(cls, mapping, fetch_sequence=False, authenticated=False,
+                      mapping_history=None, sequence=None):
+        """
+        mapping_history, the latest history of the mapping with its release
+        and species histories, is fetched when not given
+
+        sequence is the transcript sequence when it was fetched beforehand
+        (e.g. along with the group's, see fetch_sequences)
+        """
+        if mapping_history is None:
+            mapping_history = mapping.latest_history()
 
         release_mapping_history = mapping_history.release_mapping_history
 
         ensembl_history = mapping_history.release_mapping_history.ensembl_species_history
 
-        status = mapping.status.id
+        status = mapping.status_id
 
-        sequence = None
         if fetch_sequence:
             try:
                 sequence = ensembl_sequence(
@@ -266,11 +331,32 @@ class MappingsSerializer(serializers.Serializer):
 
         mapping_set['entryMappings'] = []
 
+        histories = {
+            mapping.mapping_id: mapping.latest_history()
+            for mapping in mappings_group
+        }
+
+        # the sequences of the group are fetched in batches
+        sequences = {}
+        if fetch_sequence:
+            sequences = fetch_sequences(
+                (
+                    mapping.transcript.enst_id,
+                    histories[mapping.mapping_id].release_mapping_history.ensembl_species_history.ensembl_release
+                )
+                for mapping in mappings_group
+            )
+
         for mapping in mappings_group:
+            history = histories[mapping.mapping_id]
             mapping_set['entryMappings'].append(
                 cls.build_mapping(
                     mapping,
-                    fetch_sequence=fetch_sequence
+                    mapping_history=history,
+                    sequence=sequences.get((
+                        mapping.transcript.enst_id,
+                        history.release_mapping_history.ensembl_species_history.ensembl_release
+                    ))
                 )
             )
 
@@ -286,12 +372,7 @@ class MappingsSerializer(serializers.Serializer):
         fetch one history as the tax id remains the same across all of them
         """
         try:
-            ensembl_history = mapping.mapping_history.select_related(
-                'release_mapping_history'
-            ).select_related(
-                'release_mapping_history__ensembl_species_history'
-            ).latest(
-                'mapping_history_id'
+            ensembl_history = mapping.latest_history(
             ).release_mapping_history.ensembl_species_history
             # ensembl_history = mapping.transcript.history.latest('ensembl_release')
             uniprot_tax_id = mapping.uniprot.uniprot_tax_id
@@ -335,10 +416,14 @@ class MappingViewsSerializer(serializers.Serializer):
     entryMappings = EnsemblUniprotMappingSerializer(many=True)
 
     @classmethod
-    def build_mapping(cls, mapping_view, fetch_sequence=False, authenticated=False):
+    def build_mapping(cls, mapping_view, fetch_sequence=False, authenticated=False,
+                      sequence=None):
+        """
+        sequence is the transcript sequence when it was fetched beforehand
+        (e.g. along with the group's, see fetch_sequences)
+        """
         status = mapping_view.status
 
-        sequence = None
         if fetch_sequence:
             try:
                 sequence = ensembl_sequence(
@@ -408,16 +493,41 @@ class MappingViewsSerializer(serializers.Serializer):
             'entryMappings': []
         }
 
+        # the sequences of the group are fetched in batches
+        sequences = {}
+        if fetch_sequence:
+            sequences = fetch_sequences(
+                (mapping_view.enst_id, mapping_view.ensembl_release)
+                for mapping_view in group
+            )
+
         for mapping_view in group:
             mapping_set['entryMappings'].append(
                 cls.build_mapping(
                     mapping_view,
-                    fetch_sequence=fetch_sequence
+                    sequence=sequences.get(
+                        (mapping_view.enst_id, mapping_view.ensembl_release)
+                    )
                 )
             )
 
         return mapping_set
 
+    @classmethod
+    def build_mapping_groups(cls, groups, fetch_sequence=False):
+        """
+        Serialize a page of groups, the status histories of the mapping views
+        of all the groups are loaded at once
+        """
+        MappingView.prefetch_statuses(
+            [mapping_view for group in groups for mapping_view in group]
+        )
+
+        return [
+            cls.build_mapping_group(group, fetch_sequence=fetch_sequence)
+            for group in groups
+        ]
+
     @classmethod
     def build_taxonomy_data(cls, group):
         """
@@ -427,24 +537,21 @@ class MappingViewsSerializer(serializers.Serializer):
         if the group contains mapped and potentially unmapped data
         return information from the first mapping with could find
         taxonomy data from
+
+        Species names come from the process wide index (see restui.lib.species),
+        no query is made per group
         """
         for mapping_view in group:
-            try:
-                mapping = Mapping.objects.get(pk=mapping_view.mapping_id)
-            except Mapping.DoesNotExist:
+            if mapping_view.mapping_id is None:
                 continue
 
-            ensembl_history = mapping.mapping_history.select_related(
-                'release_mapping_history'
-            ).select_related(
-                'release_mapping_history__ensembl_species_history'
-            ).latest(
-                'mapping_history_id'
-            ).release_mapping_history.ensembl_species_history
+            species = species_name(mapping_view.uniprot_tax_id)
+            if species is None:
+                continue
 
             return {
-                'species': ensembl_history.species,
-                'ensemblTaxId': ensembl_history.ensembl_tax_id,
+                'species': species,
+                'ensemblTaxId': mapping_view.uniprot_tax_id,
                 'uniprotTaxId': mapping_view.uniprot_tax_id
             }
 
@@ -456,17 +563,14 @@ class MappingViewsSerializer(serializers.Serializer):
             tax_ids.append(mapping_view.uniprot_tax_id)
 
         if len(tax_ids) == 1:
-            species_history = EnsemblSpeciesHistory.objects.filter(
-                ensembl_tax_id=tax_ids[0]
-            ).latest(
-                'time_loaded'
-            )
+            species = species_name(tax_ids[0])
 
-            return {
-                'species': species_history.species,
-                'ensemblTaxId': species_history.ensembl_tax_id,
-                'uniprotTaxId': group[0].uniprot_tax_id
-            }
+            if species is not None:
+                return {
+                    'species': species,
+                    'ensemblTaxId': tax_ids[0],
+                    'uniprotTaxId': group[0].uniprot_tax_id
+                }
 
         return {
             'species': None,
@@ -522,6 +626,15 @@ class MappingAlignmentsSerializer(serializers.Serializer):
     alignments = MappingPairwiseAlignmentSerializer(many=True)
 
 
+class MappingsAlignmentsSerializer(serializers.Serializer):
+    """
+    Serialize data in call to mappings/pairwise/ endpoint.
+    """
+
+    results = MappingAlignmentsSerializer(many=True)
+    notFound = serializers.ListField(child=serializers.IntegerField())
+
+
 class UniprotMappedCountSerializer(serializers.Serializer):
     """
     Serializer for counts related to mapped/unmapped Uniprot entries
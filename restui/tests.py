@@ -15,24 +15,53 @@
    limitations under the License.
 """
 
+import io
 import os
 import json
+import sqlite3
+import subprocess
+import sys
+import time
+import tempfile
 import mock
+import requests
+from contextlib import redirect_stdout
 
 from rest_framework.test import APIClient
 from rest_framework.test import APITestCase
 
 from django.http import Http404
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.test import override_settings
+from django_redis.exceptions import ConnectionInterrupted
 
 from restui.models.ensembl import EnsemblGene
 from restui.models.ensembl import EnsemblTranscript
 from restui.models.ensembl import EnsemblSpeciesHistory
+from restui.models.ensembl import EnspUCigar
+from restui.models.mappings import Alignment
 from restui.models.mappings import Mapping
+from restui.models.mappings import MappingView
 from restui.models.uniprot import UniprotEntry
+from restui.models.annotations import CvUeStatus
+from restui.models.annotations import UeMappingStatus
+
+from restui.serializers.mappings import MappingViewsSerializer
 
 from restui.exceptions import FalloverROException
+from restui.lib import alignment_load
 from restui.lib import alignments
+from restui.lib import cache
 from restui.lib import external
+from restui.lib import fasta
+from restui.lib import http_client
+from restui.lib import memo
+from restui.lib import sequence_cache
+from restui.lib import species
+from restui.lib import vocabulary
 from restui.views import mappings
 from restui.views import unmapped
 from restui.views import version
@@ -349,6 +378,79 @@ class EnsemblMapping(APITestCase):
         self.assertEqual(unrelated_mappings['ensembl'], [])
         self.assertEqual(len(unrelated_mappings['uniprot']), 3)
 
+    def test_load_mapping_detail(self):
+        vocabulary.vocabularies()
+
+        # mapping, histories, taxonomy, status history, related mappings,
+        # their histories and status histories, unmapped entries/transcripts
+        with self.assertNumQueries(9):
+            detail = mappings.load_mapping_detail(3, fetch_sequence=False)
+
+        self.assertEqual(detail['taxonomy']['ensemblTaxId'], 9606)
+        self.assertEqual(detail['mapping']['mappingId'], 3)
+        self.assertEqual(detail['relatedEntries']['mapped'][0]['mappingId'], 4)
+        self.assertEqual(len(detail['relatedEntries']['unmapped']['uniprot']), 3)
+
+        with self.assertRaises(Http404):
+            mappings.load_mapping_detail(99)
+
+    def test_load_mapping_details(self):
+        vocabulary.vocabularies()
+
+        # as many queries for the details of a list as for a single detail
+        with self.assertNumQueries(9):
+            details = mappings.load_mapping_details([3, 4, 99])
+
+        self.assertEqual(sorted(details), [3, 4])
+        for pk in (3, 4):
+            detail = mappings.load_mapping_detail(pk, fetch_sequence=False)
+            self.assertEqual(details[pk]['taxonomy'], detail['taxonomy'])
+            self.assertEqual(details[pk]['mapping'], detail['mapping'])
+            self.assertEqual(
+                sorted(m['mappingId'] for m in details[pk]['relatedEntries']['mapped']),
+                sorted(m['mappingId'] for m in detail['relatedEntries']['mapped'])
+            )
+            self.assertEqual(
+                len(details[pk]['relatedEntries']['unmapped']['uniprot']),
+                len(detail['relatedEntries']['unmapped']['uniprot'])
+            )
+
+        self.assertEqual(mappings.load_mapping_details([99]), {})
+
+    def test_mapping_details_request(self):
+        client = APIClient()
+        response = client.get('/mappings/details/?ids=4,3,99,3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [detail['mapping']['mappingId'] for detail in response.data['results']],
+            [4, 3]
+        )
+        self.assertEqual(response.data['notFound'], [99])
+
+        response = client.get('/mappings/details/?ids=3,a')
+        self.assertEqual(response.status_code, 404)
+
+        with self.settings(MAPPING_DETAILS_MAX_IDS=1):
+            response = client.get('/mappings/details/?ids=3,4')
+        self.assertEqual(response.status_code, 400)
+
+    @mock.patch('restui.lib.external.ensembl_sequence')
+    def test_load_mapping_detail_sequence(self, mock_sequence):
+        mock_sequence.return_value = 'MPIGSKERPTFFEIFKTRCNKADLGPISLNWFEELSSEAPPYNSEPAEESEHK'
+
+        detail = mappings.load_mapping_detail(1)
+        self.assertEqual(
+            detail['mapping']['ensemblTranscript']['sequence'],
+            mock_sequence.return_value
+        )
+
+        # the detail doesn't wait for a sequence which takes too long
+        mock_sequence.side_effect = lambda *args: time.sleep(1) or 'MPIG'
+        with self.settings(ENSEMBL_SEQUENCE_TIMEOUT=0.1):
+            detail = mappings.load_mapping_detail(1)
+        self.assertIsNone(detail['mapping']['ensemblTranscript']['sequence'])
+        self.assertEqual(detail['mapping']['mappingId'], 1)
+
     def test_mapping_request(self):
         client = APIClient()
         response = client.get('/mapping/1/')
@@ -598,6 +700,191 @@ class EnsemblMappings(APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['count'], 1)
 
+    def test_mappings_grouped_window_slice(self):
+        groups, total = MappingView.objects.all().grouped_window_slice(1, 1)
+        self.assertEqual(total, 3)
+        self.assertEqual(list(groups.keys()), [629])
+
+        groups, total = MappingView.objects.all().grouped_window_slice(0, 10)
+        self.assertEqual(total, 3)
+        self.assertEqual(list(groups.keys()), [None, 629, 2])
+        self.assertEqual(len(groups[None]), 2)
+
+        groups, total = MappingView.objects.all().grouped_window_slice(3, 10)
+        self.assertEqual(total, 0)
+        self.assertEqual(groups, {})
+
+    def test_mappings_prefix_search(self):
+        queryset = MappingView.objects.all()
+        fields = ('gene_symbol_up', 'gene_symbol_eg', 'gene_name')
+
+        self.assertEqual(queryset.prefix_search('brca', *fields).count(), 2)
+        self.assertEqual(queryset.prefix_search('DVL', *fields).count(), 2)
+        self.assertEqual(queryset.prefix_search('DVL2', *fields).count(), 1)
+        self.assertEqual(queryset.prefix_search('punm4p', 'uniprot_acc').count(), 1)
+
+        # wildcards are matched literally
+        self.assertEqual(queryset.prefix_search('BRCA%', *fields).count(), 0)
+        self.assertEqual(queryset.prefix_search('BRC_2', *fields).count(), 0)
+
+    def test_mappings_fuzzy_search(self):
+        queryset = MappingView.objects.all().fuzzy_search(
+            'BRCA3', 'gene_symbol_up', 'gene_symbol_eg', 'gene_name'
+        )
+        self.assertEqual(queryset.count(), 2)
+        self.assertGreater(queryset[0].search_similarity, 0.3)
+
+        client = APIClient()
+        response = client.get('/mappings/?searchTerm=DVL2P1&searchMode=fuzzy')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 2)
+
+        # groups ranked by similarity, not by grouping_id
+        self.assertEqual(
+            response.data['results'][0]['entryMappings'][0]['groupingId'],
+            2
+        )
+
+    @mock.patch('restui.serializers.mappings.ensembl_sequences')
+    def test_mapping_group_sequences(self, mock_sequences):
+        mock_sequences.side_effect = lambda enst_ids, release: {
+            enst_id: 'ACGT' for enst_id in enst_ids
+        }
+
+        group = list(MappingView.objects.filter(pk__in=(1, 3)))
+        mapping_group = MappingViewsSerializer.build_mapping_group(
+            group,
+            fetch_sequence=True
+        )
+
+        # one batch per release of the group (87 and 95)
+        self.assertEqual(mock_sequences.call_count, 2)
+        self.assertEqual(
+            [m['ensemblTranscript']['sequence'] for m in mapping_group['entryMappings']],
+            ['ACGT', 'ACGT']
+        )
+
+        # a release failing leaves its sequences out
+        mock_sequences.side_effect = requests.ConnectionError('unreachable')
+        with self.assertLogs('restui.serializers.mappings', 'WARNING'):
+            mapping_group = MappingViewsSerializer.build_mapping_group(
+                group,
+                fetch_sequence=True
+            )
+        self.assertEqual(
+            [m['ensemblTranscript'].get('sequence') for m in mapping_group['entryMappings']],
+            [None, None]
+        )
+
+    def test_mappings_prefetch_statuses(self):
+        UeMappingStatus.objects.create(
+            time_stamp='2019-06-01T00:00:00Z',
+            status_id=1,
+            mapping_id=1
+        )
+        UeMappingStatus.objects.create(
+            time_stamp='2019-06-02T00:00:00Z',
+            status_id=5,
+            mapping_id=1
+        )
+
+        mapping_views = list(MappingView.objects.order_by('id'))
+        vocabulary.vocabularies()
+        with self.assertNumQueries(1):
+            MappingView.prefetch_statuses(mapping_views)
+
+        with self.assertNumQueries(0):
+            history = mapping_views[0].statuses()
+            self.assertEqual(mapping_views[1].statuses(), [])
+
+        self.assertEqual(
+            [status['status'] for status in history],
+            ['TESTING', 'TESTING5']
+        )
+        self.assertIsNone(history[0]['user'])
+
+    def test_mappings_facet_counts(self):
+        facets = MappingView.objects.all().facet_counts()
+        self.assertEqual(facets['organism'], [(9606, 4)])
+        self.assertEqual(facets['status'], [(1, 2), (5, 2)])
+        self.assertEqual(
+            facets['divergence'],
+            [('identical', 1), ('large', 1), ('small', 2)]
+        )
+        self.assertEqual(facets['patch'], [(False, 3), (True, 1)])
+
+        client = APIClient()
+        response = client.get('/mappings/')
+        self.assertEqual(response.status_code, 200)
+        organism = response.data['facets'][1]
+        self.assertEqual(organism['name'], 'organism')
+        self.assertEqual(organism['items'][0]['count'], 4)
+
+    def test_mappings_cursor_request(self):
+        client = APIClient()
+
+        # groups are served by descending grouping_id, ungrouped entries first
+        response = client.get('/mappings/?cursor=&limit=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNone(response.data['previous'])
+        self.assertIn('cursor=null', response.data['next'])
+
+        response = client.get(response.data['next'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.data['results'][0]['entryMappings'][0]['groupingId'],
+            629
+        )
+
+        response = client.get('/mappings/?cursor=629&limit=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(
+            response.data['results'][0]['entryMappings'][0]['groupingId'],
+            2
+        )
+        self.assertIsNone(response.data['next'])
+
+        response = client.get('/mappings/?cursor=2')
+        self.assertEqual(response.status_code, 204)
+
+        response = client.get('/mappings/?cursor=invalid')
+        self.assertEqual(response.status_code, 404)
+
+    def test_mappings_export_request(self):
+        client = APIClient()
+
+        response = client.get('/mappings/export/?searchTerm=BRCA2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0])['gene_symbol_up'], 'BRCA2')
+
+        response = client.get('/mappings/export/?output=tsv&facets=patches:only')
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0].split('\t')[0], 'id')
+        self.assertEqual(lines[1].split('\t')[0], '4')
+
+        # the rows are streamed after the request, the vocabularies are then
+        # looked up once rather than for every row
+        with mock.patch(
+                'restui.lib.vocabulary.generation',
+                wraps=vocabulary.generation
+        ) as mock_generation:
+            response = client.get('/mappings/export/?searchTerm=BRCA2')
+            mock_generation.reset_mock()
+            lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(mock_generation.call_count, 1)
+        self.assertIsInstance(json.loads(lines[0])['status'], str)
+
+        response = client.get('/mappings/export/?output=xml')
+        self.assertEqual(response.status_code, 404)
+
     def test_mappings_release_request(self):
         client = APIClient()
         response = client.get('/mappings/release/9606/')
@@ -977,10 +1264,473 @@ class LibAlignment(APITestCase):
         self.assertEqual(response.status_code, 201)
         self.assertEqual(response.data['alignment_id'], 4)
 
+    @override_settings(CACHES=dict(
+        settings.CACHES,
+        alignments={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+    ))
+    @mock.patch('restui.lib.alignments.pairwise_alignment')
+    @mock.patch('restui.lib.alignments.ensembl_sequence')
+    @mock.patch('restui.lib.alignments.ensembl_protein')
+    def test_fetch_pairwise_cache(self, mock_protein, mock_sequence, mock_pairwise):
+        mock_protein.return_value = 'ENSP00000371469'
+        mock_sequence.return_value = 'MPIGSKE'
+        mock_pairwise.return_value = ('MPIGSKE', '|||||||', 'MPIGSKE')
+
+        mapping = Mapping.objects.get(pk=3)
+        for _ in range(2):
+            pwaln = alignments.fetch_pairwise(mapping)
+        self.assertEqual(pwaln['alignments'][0]['match_str'], '|||||||')
+        self.assertEqual(mock_sequence.call_count, 1)
+        self.assertEqual(mock_pairwise.call_count, 1)
+
+        # a cigar/mdz updated through the API drops the cached alignment and
+        # the new one is reconstructed
+        pairwise = EnspUCigar.objects.get(alignment=3)
+        old_key = cache.alignment_cache_key(3, pairwise.cigarplus, pairwise.mdz)
+        self.assertIsNotNone(caches[cache.ALIGNMENTS_CACHE].get(old_key))
+
+        client = APIClient()
+        client.force_authenticate(user=mock.Mock(is_authenticated=True))
+        response = client.put(
+            '/ensembl/cigar/alignment/3/',
+            {'alignment': 3, 'cigarplus': '7=', 'mdz': 'MD:Z:7'},
+            format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(caches[cache.ALIGNMENTS_CACHE].get(old_key))
+
+        alignments.fetch_pairwise(Mapping.objects.get(pk=3))
+        self.assertEqual(mock_pairwise.call_count, 2)
+        mock_pairwise.assert_called_with('MPIGSKE', '7=', '7')
+
+    @mock.patch('restui.lib.alignments.pairwise_alignment')
+    @mock.patch('restui.lib.alignments.ensembl_sequences')
+    @mock.patch('restui.lib.alignments.ensembl_proteins')
+    def test_mappings_pairwise_request(self, mock_proteins, mock_sequences, mock_pairwise):
+        mock_proteins.side_effect = lambda enst_ids, release: {
+            enst_id: 'ENSP{}'.format(release) for enst_id in enst_ids
+        }
+        mock_sequences.side_effect = lambda ensp_ids, release: {
+            ensp_id: 'MPIGSKE' for ensp_id in ensp_ids
+        }
+        mock_pairwise.return_value = ('MPIGSKE', '|||||||', 'MPIGSKE')
+
+        response = APIClient().get('/mappings/pairwise/?ids=3,1,999')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [result['mapping_id'] for result in response.data['results']],
+            [3, 1]
+        )
+        self.assertEqual(response.data['notFound'], [999])
+
+        identity = response.data['results'][0]['alignments'][0]
+        self.assertEqual(identity['alignment_type'], 'identity')
+        self.assertEqual(identity['ensembl_id'], 'ENSP95')
+        perfect_match = response.data['results'][1]['alignments'][0]
+        self.assertEqual(perfect_match['alignment_type'], 'perfect_match')
+        self.assertEqual(perfect_match['ensembl_id'], 'ENSP87')
+
+        # one batch of lookups per release
+        self.assertEqual(mock_proteins.call_count, 2)
+        self.assertEqual(mock_sequences.call_count, 2)
+        self.assertEqual(mock_pairwise.call_count, 1)
+
+        response = APIClient().get('/mappings/pairwise/')
+        self.assertEqual(response.status_code, 404)
+
+        # Ensembl failing isn't a missing mapping
+        mock_proteins.side_effect = requests.ConnectionError('unreachable')
+        response = APIClient().get('/mappings/pairwise/?ids=3')
+        self.assertEqual(response.status_code, 502)
+
+    def test_load_alignments(self):
+        lines = [
+            '{"alignment_run": 2, "mapping": 1, "transcript": 1, "score1": 0.9, '
+            '"is_current": true, "cigarplus": "7=", "mdz": "MD:Z:7"}\n',
+            '{"alignment_run": 2, "mapping": 1, "cigarplus": "3=4X", "mdz": "MD:Z:3A0A0A0A"}\n',
+            '\n',
+            '{"alignment_run": 2, "mapping": 3, "cigarplus": "7=", "mdz": "MD:Z:7"}\n'
+        ]
+
+        loaded = alignment_load.load_alignments(alignment_load.ndjson_records(lines))
+        self.assertEqual(loaded, {'received': 3, 'alignments': 1, 'cigars': 1})
+
+        alignment = Alignment.objects.get(alignment_run=2, mapping=1)
+        self.assertEqual(alignment.score1, 0.9)
+        self.assertTrue(alignment.is_current)
+        self.assertEqual(alignment.pairwise.cigarplus, '7=')
+
+        # the alignments already loaded are kept
+        self.assertEqual(EnspUCigar.objects.get(alignment=3).mdz[:8], 'MD:Z:282')
+
+        with self.assertRaisesRegex(ValueError, 'Line 1: mapping is required'):
+            alignment_load.load_alignments(
+                alignment_load.ndjson_records(['{"alignment_run": 2}\n'])
+            )
+
+    def test_load_alignments_request(self):
+        client = APIClient()
+        client.force_authenticate(user=mock.Mock(is_authenticated=True))
+
+        response = client.post(
+            '/alignments/alignment/bulk/',
+            data='alignment_run\tmapping\tscore1\treport\n1\t3\t1\t\n',
+            content_type='text/tab-separated-values'
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data, {'received': 1, 'alignments': 1, 'cigars': 0})
+        self.assertIsNone(Alignment.objects.get(alignment_run=1, mapping=3).report)
+
+        response = client.post(
+            '/alignments/alignment/bulk/',
+            data='alignment_run\tmapping\n1\tx\n',
+            content_type='text/tab-separated-values'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Line 2: invalid mapping x')
+
     def test_calculate_difference(self):
         diff = alignments.calculate_difference('3M1I3M1D5M')
         self.assertEqual(diff, 2)
 
+    def test_calculate_differences(self):
+        self.assertEqual(
+            alignments.calculate_differences(['3M1I3M1D5M', None, '', '10=', '2X3=4D']),
+            [2, None, 0, 0, 6]
+        )
+        self.assertEqual(alignments.calculate_differences([]), [])
+
+        for cigar in ('3M1', 'M3', '3MM'):
+            with self.assertRaises(ValueError):
+                alignments.calculate_differences(['10=', cigar])
+
+        mappings = Mapping.objects.prefetch_related(
+            'alignments__alignment_run',
+            'alignments__pairwise'
+        ).filter(pk__in=[1, 3])
+        self.assertEqual(
+            Mapping.differences(mappings),
+            {mapping.mapping_id: mapping.difference for mapping in mappings}
+        )
+
+
+class CommandFillAlignmentDivergence(APITestCase):
+    """
+    Tests for the fill_alignment_divergence command
+    """
+
+    fixtures = [
+        'ensembl_gene', 'ensembl_transcript', 'uniprot_entry',
+        'cv_ue_status', 'mapping', 'ensembl_species_history',
+        'release_mapping_history', 'alignment_run', 'alignment',
+        'ensp_u_cigar', 'transcript_history', 'cv_entry_type',
+        'mapping_history', 'mapping_view'
+    ]
+
+    @mock.patch('restui.management.commands.fill_alignment_divergence.invalidate_groups_details')
+    @mock.patch('restui.management.commands.fill_alignment_divergence.invalidate_facets')
+    def test_fill_alignment_divergence(self, mock_facets, mock_details):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'checkpoint')
+
+            # resumes after the checkpoint
+            with open(checkpoint, 'w') as checkpoint_file:
+                checkpoint_file.write('2')
+            call_command('fill_alignment_divergence', chunk_size=1, checkpoint=checkpoint)
+
+            self.assertFalse(os.path.exists(checkpoint))
+            self.assertIsNone(Mapping.objects.get(pk=1).alignment_difference)
+            self.assertEqual(Mapping.objects.get(pk=3).alignment_difference, 58)
+            self.assertEqual(
+                MappingView.objects.get(mapping_id=3).alignment_difference,
+                58
+            )
+            self.assertFalse(
+                MappingView.objects.filter(
+                    mapping_id=4,
+                    alignment_difference__isnull=False
+                ).exists()
+            )
+
+            # the caches are dropped for each chunk changed
+            self.assertEqual(mock_facets.call_count, 2)
+            self.assertEqual(
+                {
+                    mapping_id
+                    for call in mock_details.call_args_list
+                    for _, mapping_id, _ in call[0][0]
+                },
+                {3, 4}
+            )
+
+            call_command(
+                'fill_alignment_divergence',
+                chunk_size=2,
+                checkpoint=checkpoint,
+                restart=True
+            )
+            self.assertEqual(Mapping.objects.get(pk=1).alignment_difference, 0)
+            self.assertEqual(
+                MappingView.objects.get(mapping_id=1).alignment_difference,
+                0
+            )
+
+    @mock.patch('restui.management.commands.fill_alignment_divergence.invalidate_groups_details')
+    @mock.patch('restui.management.commands.fill_alignment_divergence.invalidate_facets')
+    def test_fill_alignment_divergence_malformed_cigar(self, mock_facets, mock_details):
+        EnspUCigar.objects.create(alignment_id=2, cigarplus='X282=')
+
+        with tempfile.TemporaryDirectory() as directory:
+            out = io.StringIO()
+            with self.assertLogs(
+                    'restui.management.commands.fill_alignment_divergence',
+                    'WARNING'
+            ) as logs, redirect_stdout(out):
+                call_command(
+                    'fill_alignment_divergence',
+                    chunk_size=4,
+                    checkpoint=os.path.join(directory, 'checkpoint')
+                )
+
+        # the rest of the chunk is written
+        self.assertIsNone(Mapping.objects.get(pk=2).alignment_difference)
+        self.assertEqual(Mapping.objects.get(pk=1).alignment_difference, 0)
+        self.assertEqual(Mapping.objects.get(pk=3).alignment_difference, 58)
+        self.assertIn('Mapping 2', logs.output[0])
+        self.assertIn('1 malformed cigars', out.getvalue())
+
+
+class LibCache(APITestCase):
+    """
+    Tests for the /lib/cache functions
+    """
+
+    fixtures = ['ensembl_species_history', 'release_mapping_history']
+
+    def test_facets_cache_key(self):
+        key = cache.facets_cache_key(
+            'gene', 'BRCA2', {'status': 'unreviewed,testing', 'organism': '9606'}
+        )
+        self.assertEqual(
+            key,
+            cache.facets_cache_key(
+                'gene', 'brca2', {'organism': '9606', 'status': 'testing,unreviewed'}
+            )
+        )
+        self.assertNotEqual(key, cache.facets_cache_key('uniprot', 'BRCA2', {}))
+
+        self.assertEqual(cache.cached_facets(key, lambda: ['facets']), ['facets'])
+        self.assertEqual(cache.cached_facets(key, lambda: ['changed']), ['facets'])
+
+        cache.invalidate_facets()
+        key = cache.facets_cache_key(
+            'gene', 'BRCA2', {'status': 'unreviewed,testing', 'organism': '9606'}
+        )
+        self.assertEqual(cache.cached_facets(key, lambda: ['changed']), ['changed'])
+
+    @override_settings(CACHES=dict(
+        settings.CACHES,
+        details={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+    ))
+    def test_cached_detail(self):
+        self.assertEqual(
+            cache.cached_detail(cache.MAPPING_DETAIL, 1, lambda: {'mapping': 1}),
+            {'mapping': 1}
+        )
+        self.assertEqual(
+            cache.cached_detail(cache.MAPPING_DETAIL, 1, lambda: {'mapping': 2}),
+            {'mapping': 1}
+        )
+
+        # each variant and kind of detail is cached apart
+        self.assertEqual(
+            cache.cached_detail(
+                cache.MAPPING_DETAIL, 1, lambda: {'mapping': 3}, authenticated=True
+            ),
+            {'mapping': 3}
+        )
+        self.assertEqual(
+            cache.cached_detail(cache.UNMAPPED_DETAIL, 1, lambda: {'entry': 1}),
+            {'entry': 1}
+        )
+
+        cache.invalidate_details(cache.MAPPING_DETAIL, 1)
+        self.assertEqual(
+            cache.cached_detail(
+                cache.MAPPING_DETAIL, 1, lambda: {'mapping': 4}, authenticated=True
+            ),
+            {'mapping': 4}
+        )
+        self.assertEqual(
+            cache.cached_detail(cache.UNMAPPED_DETAIL, 1, lambda: {'entry': 2}),
+            {'entry': 1}
+        )
+
+        # entries without a group
+        cache.invalidate_group_details(None, mapping_id=1, mapping_view_id=1)
+        self.assertEqual(
+            cache.cached_detail(
+                cache.UNMAPPED_DETAIL,
+                1,
+                lambda: {'error': 'mapped'},
+                cacheable=lambda detail: 'error' not in detail
+            ),
+            {'error': 'mapped'}
+        )
+        self.assertEqual(
+            cache.cached_detail(cache.UNMAPPED_DETAIL, 1, lambda: {'entry': 3}),
+            {'entry': 3}
+        )
+
+
+class LibMemo(APITestCase):
+    """
+    Tests for the /lib/memo functions
+    """
+
+    def test_memoised(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        # nothing is remembered outside a memoisation context
+        self.assertEqual(memo.memoised('test', 1, compute), 1)
+        self.assertEqual(memo.memoised('test', 1, compute), 2)
+
+        with memo.memoisation():
+            self.assertEqual(memo.memoised('test', 1, compute), 3)
+            with memo.memoisation():
+                self.assertEqual(memo.memoised('test', 1, compute), 3)
+            self.assertEqual(memo.memoised('test', 2, compute), 4)
+            self.assertEqual(memo.memoised('test', 1, compute), 3)
+
+        self.assertEqual(memo.memoised('test', 1, compute), 5)
+
+
+class LibSpecies(APITestCase):
+    """
+    Tests for the /lib/species functions
+    """
+
+    fixtures = ['ensembl_species_history']
+
+    def test_species_name(self):
+        self.assertEqual(species.species_name(9606), 'homo_sapiens')
+        self.assertIsNone(species.species_name(10090))
+
+    def test_species_names_refresh(self):
+        names = species.species_names()
+        self.assertIs(species.species_names(), names)
+
+        EnsemblSpeciesHistory.objects.create(
+            species='mus_musculus',
+            ensembl_tax_id=10090,
+            ensembl_release=95,
+            status='LOAD_COMPLETE',
+            time_loaded='2019-06-01T00:00:00Z'
+        )
+        self.assertEqual(species.species_name(10090), 'mus_musculus')
+
+    def test_refresh_connected_on_setup(self):
+        # the celery worker loading the releases never imports the
+        # serializers, the application connects the refresh
+        script = (
+            "import sys\n"
+            "import django\n"
+            "django.setup()\n"
+            "from django.db.models.signals import post_save\n"
+            "from restui.models.ensembl import EnsemblSpeciesHistory\n"
+            "assert 'restui.serializers.mappings' not in sys.modules\n"
+            "receivers = post_save._live_receivers(EnsemblSpeciesHistory)\n"
+            "assert any(\n"
+            "    getattr(receiver, '__module__', None) == 'restui.lib.species'\n"
+            "    for receiver in receivers\n"
+            ")\n"
+        )
+        subprocess.run(
+            [sys.executable, '-c', script],
+            cwd=os.path.dirname(settings.BASE_DIR),
+            check=True
+        )
+
+    @mock.patch('restui.lib.species.bump_generation')
+    def test_load_complete_refreshes(self, mock_bump):
+        history = EnsemblSpeciesHistory.objects.create(
+            species='mus_musculus',
+            ensembl_tax_id=10090,
+            ensembl_release=95,
+            status='LOAD_STARTED',
+            time_loaded='2019-06-01T00:00:00Z'
+        )
+        mock_bump.assert_not_called()
+
+        history.status = 'LOAD_COMPLETE'
+        history.save()
+        mock_bump.assert_called_once_with(mock.ANY, species.SPECIES_NAMES)
+
+    def test_generation_once_per_request(self):
+        with mock.patch(
+                'restui.lib.species.generation',
+                wraps=species.generation
+        ) as mock_generation, memo.memoisation():
+            species.species_name(9606)
+            species.species_name(10090)
+
+        self.assertEqual(mock_generation.call_count, 1)
+
+
+class LibVocabulary(APITestCase):
+    """
+    Tests for the /lib/vocabulary functions
+    """
+
+    fixtures = ['cv_ue_status', 'cv_entry_type', 'cv_ue_label']
+
+    def test_lookups(self):
+        self.assertEqual(vocabulary.description(vocabulary.STATUS, 2), 'TESTING2')
+        self.assertEqual(vocabulary.identity(vocabulary.STATUS, 'TESTING2'), 2)
+        self.assertEqual(
+            vocabulary.description(vocabulary.ENTRY_TYPE, 2),
+            'SwissProt entry type'
+        )
+        self.assertEqual(
+            vocabulary.terms(vocabulary.LABEL)[0],
+            (1, 'overlapping locus')
+        )
+        self.assertIsNone(vocabulary.description(vocabulary.STATUS, 10))
+        self.assertIsNone(vocabulary.identity(vocabulary.STATUS, 'UNKNOWN'))
+
+    def test_refresh(self):
+        self.assertIsNone(vocabulary.identity(vocabulary.STATUS, 'TESTING6'))
+
+        CvUeStatus.objects.create(id=6, description='TESTING6')
+        self.assertEqual(vocabulary.identity(vocabulary.STATUS, 'TESTING6'), 6)
+
+    def test_generation_once_per_request(self):
+        with mock.patch(
+                'restui.lib.vocabulary.generation',
+                wraps=vocabulary.generation
+        ) as mock_generation, memo.memoisation():
+            vocabulary.description(vocabulary.STATUS, 2)
+            vocabulary.identity(vocabulary.STATUS, 'TESTING2')
+            vocabulary.terms(vocabulary.LABEL)
+
+        self.assertEqual(mock_generation.call_count, 1)
+
+    @mock.patch('restui.lib.vocabulary.vocabularies')
+    def test_warm_up(self, mock_vocabularies):
+        mock_vocabularies.side_effect = ConnectionInterrupted(connection=None)
+        request_started.connect(vocabulary.warm_up)
+
+        # on the first request only, an unreachable cache is logged
+        with self.assertLogs('restui.lib.vocabulary', 'WARNING'):
+            request_started.send(sender=None)
+        request_started.send(sender=None)
+
+        self.assertEqual(mock_vocabularies.call_count, 1)
+
 
 class LibExternal(APITestCase):
     """
@@ -1003,6 +1753,332 @@ class LibExternal(APITestCase):
         prot = external.ensembl_protein('ENST00000382038', 95)
         self.assertEqual(prot, 'ENSP00000371469')
 
+    @mock.patch('restui.lib.external.fetch_ensembl_current_release')
+    def test_ensembl_current_release_cache(self, mock_fetch):
+        mock_fetch.return_value = 98
+        caches[external.ENSEMBL_RELEASE_CACHE].delete(external.ENSEMBL_RELEASE_KEY)
+
+        self.assertEqual(external.ensembl_current_release(), 98)
+        self.assertEqual(external.ensembl_current_release(), 98)
+        self.assertEqual(mock_fetch.call_count, 1)
+
+        # seeded from the database, without asking Ensembl
+        EnsemblSpeciesHistory.objects.create(
+            species='homo_sapiens',
+            assembly_accession='GCA_000001405.27',
+            ensembl_tax_id=9606,
+            ensembl_release=99,
+            status='LOAD_STARTED'
+        )
+        self.assertEqual(external.seed_ensembl_current_release(), 99)
+        self.assertEqual(external.ensembl_current_release(), 99)
+        self.assertEqual(mock_fetch.call_count, 1)
+
+        caches[external.ENSEMBL_RELEASE_CACHE].delete(external.ENSEMBL_RELEASE_KEY)
+
+    @mock.patch('restui.lib.external.close_old_connections')
+    @mock.patch('restui.lib.external.ensembl_sequence')
+    def test_ensembl_sequence_async(self, mock_sequence, mock_close):
+        mock_sequence.return_value = 'ACGT'
+
+        future = external.ensembl_sequence_async('ENST00000382038', 95)
+        self.assertEqual(future.result(), 'ACGT')
+
+        # the pool thread closes the connection the task may have opened
+        self.assertEqual(mock_close.call_count, 2)
+
+    @mock.patch('restui.lib.external.time.sleep')
+    @mock.patch('restui.lib.external.ensembl_current_release')
+    @mock.patch('restui.lib.http_client.post')
+    def test_fetch_ensembl_sequences(self, mock_post, mock_release, mock_sleep):
+        mock_release.return_value = 95
+        mock_post.side_effect = lambda url, json, headers: mock.Mock(
+            ok=True,
+            headers={'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '2'},
+            json=lambda: [
+                {'query': stable_id, 'id': stable_id.split('.')[0], 'seq': 'ACGT'}
+                for stable_id in json['ids']
+            ]
+        )
+
+        with mock.patch('restui.lib.external.ENSEMBL_REST_SEQUENCE_BATCH', 2):
+            sequences = external.fetch_ensembl_sequences(
+                ['ENST00000382038.6', 'ENST00000380152.7', 'ENST00000544455.5'],
+                95
+            )
+
+        self.assertEqual(
+            sequences,
+            {
+                'ENST00000382038.6': 'ACGT',
+                'ENST00000380152.7': 'ACGT',
+                'ENST00000544455.5': 'ACGT'
+            }
+        )
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(
+            mock_post.call_args_list[0][0][0],
+            '{}/sequence/id'.format(settings.ENSEMBL_REST_SERVER)
+        )
+
+        # waits for the rate limit to reset
+        mock_sleep.assert_called_with(2.0)
+
+    @mock.patch('restui.lib.external.ensembl_current_release')
+    @mock.patch('restui.lib.http_client.post')
+    def test_fetch_ensembl_proteins(self, mock_post, mock_release):
+        mock_release.return_value = 96
+        mock_post.return_value = mock.Mock(
+            ok=True,
+            headers={},
+            json=lambda: {
+                'ENST00000382038': {'Translation': {'id': 'ENSP00000371469'}},
+                'ENST00000380152': {'id': 'ENST00000380152'},
+                'ENST00000000000': None
+            }
+        )
+
+        proteins = external.fetch_ensembl_proteins(
+            ['ENST00000382038', 'ENST00000380152', 'ENST00000000000'],
+            95
+        )
+
+        self.assertEqual(proteins, {'ENST00000382038': 'ENSP00000371469'})
+        self.assertEqual(
+            mock_post.call_args[0][0],
+            'http://e95.rest.ensembl.org/lookup/id'
+        )
+        self.assertEqual(mock_post.call_args[1]['json']['expand'], 1)
+
+    @mock.patch('restui.lib.http_client.session')
+    def test_http_client_metrics(self, mock_session):
+        http_client.reset_metrics()
+
+        mock_session.return_value.request.return_value = mock.Mock(ok=True)
+        http_client.get('http://rest.ensembl.org/info/software')
+        mock_session.return_value.request.return_value = mock.Mock(ok=False)
+        http_client.get('http://rest.ensembl.org/info/software')
+
+        mock_session.return_value.request.side_effect = requests.ConnectTimeout
+        with self.assertRaises(requests.Timeout):
+            http_client.get('http://rest.ensembl.org/info/software')
+
+        # the timeouts are set unless given
+        self.assertEqual(
+            mock_session.return_value.request.call_args[1]['timeout'],
+            (settings.EXTERNAL_HTTP_CONNECT_TIMEOUT, settings.EXTERNAL_HTTP_READ_TIMEOUT)
+        )
+
+        metrics = http_client.metrics()['rest.ensembl.org']
+        self.assertEqual(metrics['requests'], 3)
+        self.assertEqual(metrics['errors'], 1)
+        self.assertEqual(metrics['timeouts'], 1)
+        self.assertEqual(sum(metrics['latencyBuckets'].values()), 3)
+
+        response = APIClient().get('/service/external/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['rest.ensembl.org']['requests'], 3)
+
+
+class LibSequenceCache(APITestCase):
+    """
+    Tests for the /lib/sequence_cache functions
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'sequences.sqlite3')
+        sequence_cache.reset_stats()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_cached_lookup(self):
+        fetch = mock.Mock(return_value='MPIGSKERPTF')
+
+        with self.settings(SEQUENCE_CACHE_PATH=self.path):
+            for _ in range(2):
+                self.assertEqual(
+                    sequence_cache.cached_lookup(
+                        sequence_cache.SEQUENCE, 'ENSP00000371469', 95, fetch
+                    ),
+                    'MPIGSKERPTF'
+                )
+            self.assertEqual(fetch.call_count, 1)
+
+            # keyed by release too
+            sequence_cache.cached_lookup(
+                sequence_cache.SEQUENCE, 'ENSP00000371469', 96, fetch
+            )
+            self.assertEqual(fetch.call_count, 2)
+
+            self.assertEqual(
+                sequence_cache.stats(),
+                {'hits': 1, 'misses': 2, 'entries': 2}
+            )
+
+            response = APIClient().get('/service/sequence_cache/')
+            self.assertEqual(response.data['entries'], 2)
+
+        # without a store, always fetched
+        with self.settings(SEQUENCE_CACHE_PATH=None):
+            sequence_cache.cached_lookup(
+                sequence_cache.SEQUENCE, 'ENSP00000371469', 95, fetch
+            )
+        self.assertEqual(fetch.call_count, 3)
+
+    @mock.patch('restui.lib.external.fetch_ensembl_protein')
+    def test_ensembl_protein(self, mock_fetch):
+        mock_fetch.return_value = 'ENSP00000371469'
+
+        with self.settings(SEQUENCE_CACHE_PATH=self.path):
+            external.ensembl_protein('ENST00000382038', 95)
+            self.assertEqual(
+                external.ensembl_protein('ENST00000382038', 95),
+                'ENSP00000371469'
+            )
+        self.assertEqual(mock_fetch.call_count, 1)
+
+    def test_store_eviction(self):
+        store = sequence_cache.SequenceStore(self.path, 2)
+
+        store.set(sequence_cache.SEQUENCE, 'ENST1', 95, 'A')
+        store.set(sequence_cache.SEQUENCE, 'ENST2', 95, 'C')
+        time.sleep(0.01)
+        # ENST1 is now the most recently used
+        self.assertEqual(store.get(sequence_cache.SEQUENCE, 'ENST1', 95), 'A')
+
+        store.set(sequence_cache.SEQUENCE, 'ENST3', 95, 'G')
+        self.assertLessEqual(len(store), 2)
+        self.assertIsNone(store.get(sequence_cache.SEQUENCE, 'ENST2', 95))
+        self.assertEqual(store.get(sequence_cache.SEQUENCE, 'ENST3', 95), 'G')
+
+    @mock.patch('restui.lib.sequence_cache.TOUCH_BATCH', 2)
+    def test_store_touch_batch(self):
+        store = sequence_cache.SequenceStore(self.path, 10)
+        store.set_many([
+            (sequence_cache.SEQUENCE, 'ENST1', 95, 'A'),
+            (sequence_cache.SEQUENCE, 'ENST2', 95, 'C')
+        ])
+
+        def last_used():
+            with sqlite3.connect(self.path) as connection:
+                return dict(connection.execute(
+                    "SELECT stable_id, last_used FROM lookup"
+                ).fetchall())
+
+        cached = last_used()
+        time.sleep(0.01)
+
+        # the reads are only written by batches
+        store.get(sequence_cache.SEQUENCE, 'ENST1', 95)
+        self.assertEqual(last_used(), cached)
+
+        store.get(sequence_cache.SEQUENCE, 'ENST2', 95)
+        self.assertGreater(last_used()['ENST1'], cached['ENST1'])
+        self.assertGreater(last_used()['ENST2'], cached['ENST2'])
+
+
+class LibFasta(APITestCase):
+    """
+    Tests for the /lib/fasta functions
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.directory.name, '95'))
+        self.path = os.path.join(self.directory.name, '95', 'Homo_sapiens.GRCh38.pep.all.fa')
+        with open(self.path, 'w') as fasta_file:
+            fasta_file.write(
+                ">ENSP00000371469.3 pep chromosome:GRCh38:13:32315508:32400268:1 "
+                "gene:ENSG00000139618.15 transcript:ENST00000380152.7 gene_biotype:protein_coding\n"
+                "MPIGSKERPTFFEIFKTRCNKADLGPISLNWFEEL\n"
+                "SSEAPPYNSEPAEESEHK\n"
+                ">ENSP00000439902.1 pep scaffold:GRCh38:KI270744.1:51009:51114:-1\n"
+                "MKKVTAEAISWNESTSETNNSMVTEFIFLGLSDSQ\n"
+            )
+        fasta._releases.clear()
+
+    def tearDown(self):
+        fasta._releases.clear()
+        self.directory.cleanup()
+
+    def test_fasta_lookups(self):
+        with self.settings(SEQUENCE_FASTA_DIRECTORY=self.directory.name):
+            self.assertEqual(
+                fasta.sequence('ENSP00000371469', 95),
+                'MPIGSKERPTFFEIFKTRCNKADLGPISLNWFEELSSEAPPYNSEPAEESEHK'
+            )
+            # a transcript has the sequence of its translation
+            self.assertEqual(
+                fasta.sequence('ENST00000380152.7', 95),
+                fasta.sequence('ENSP00000371469', 95)
+            )
+            self.assertEqual(
+                fasta.sequence('ENSP00000439902', 95),
+                'MKKVTAEAISWNESTSETNNSMVTEFIFLGLSDSQ'
+            )
+            self.assertEqual(fasta.protein('ENST00000380152', 95), 'ENSP00000371469')
+            self.assertEqual(
+                fasta.proteins(['ENST00000380152', 'ENST00000000000'], 95),
+                {'ENST00000380152': 'ENSP00000371469'}
+            )
+
+            with self.assertRaises(Exception):
+                fasta.sequence('ENSP00000000000', 95)
+            with self.assertRaises(Exception):
+                fasta.sequence('ENSP00000371469', 96)
+
+        self.assertTrue(os.path.exists(self.path + fasta.INDEX_SUFFIX))
+
+    def test_fasta_index_directory(self):
+        with tempfile.TemporaryDirectory() as index_directory, \
+             self.settings(
+                 SEQUENCE_FASTA_DIRECTORY=self.directory.name,
+                 SEQUENCE_FASTA_INDEX_DIRECTORY=index_directory
+             ):
+            self.assertEqual(fasta.protein('ENST00000380152', 95), 'ENSP00000371469')
+            self.assertTrue(os.path.exists(os.path.join(
+                index_directory, '95', 'Homo_sapiens.GRCh38.pep.all.fa' + fasta.INDEX_SUFFIX
+            )))
+        self.assertFalse(os.path.exists(self.path + fasta.INDEX_SUFFIX))
+
+    @mock.patch('restui.lib.fasta.os.replace', side_effect=PermissionError('read-only'))
+    def test_fasta_read_only(self, mock_replace):
+        # indexed in memory
+        with self.settings(SEQUENCE_FASTA_DIRECTORY=self.directory.name):
+            self.assertEqual(fasta.protein('ENST00000380152', 95), 'ENSP00000371469')
+        self.assertEqual(
+            os.listdir(os.path.join(self.directory.name, '95')),
+            ['Homo_sapiens.GRCh38.pep.all.fa']
+        )
+
+    def test_fasta_release_added(self):
+        with self.settings(SEQUENCE_FASTA_DIRECTORY=self.directory.name):
+            self.assertEqual(fasta.proteins(['ENST00000380152'], 96), {})
+
+            os.rename(
+                os.path.join(self.directory.name, '95'),
+                os.path.join(self.directory.name, '96')
+            )
+            self.assertEqual(
+                fasta.proteins(['ENST00000380152'], 96),
+                {'ENST00000380152': 'ENSP00000371469'}
+            )
+
+    @mock.patch('restui.lib.external.fetch_ensembl_sequences')
+    def test_fasta_provider(self, mock_fetch):
+        with self.settings(SEQUENCE_FASTA_DIRECTORY=self.directory.name), \
+             mock.patch('restui.lib.external.SEQUENCE_PROVIDER', external.FASTA_PROVIDER):
+            self.assertEqual(
+                external.ensembl_sequences(['ENST00000380152', 'ENSP00000439902'], 95),
+                {
+                    'ENST00000380152': 'MPIGSKERPTFFEIFKTRCNKADLGPISLNWFEELSSEAPPYNSEPAEESEHK',
+                    'ENSP00000439902': 'MKKVTAEAISWNESTSETNNSMVTEFIFLGLSDSQ'
+                }
+            )
+        mock_fetch.assert_not_called()
+
 
 class APIVersion(APITestCase):
     """
@@ -66,6 +66,9 @@ urlpatterns = [
     path('alignments/alignment/alignment_run/<int:pk>/',
          alignments.AlignmentByAlignmentRunFetch().as_view()),
 
+    # insert alignments in bulk (NDJSON or TSV body)
+    path('alignments/alignment/bulk/', alignments.AlignmentBulkLoad.as_view()),
+
     # retrieve alignment by ID
     path('alignments/alignment/<int:pk>/', alignments.AlignmentFetch.as_view()),
 
@@ -148,7 +151,18 @@ urlpatterns = [
     # retrieve mapping and related entries
     path('mapping/<int:pk>/', mappings.MappingDetailed.as_view(), name="get_mapping"),
 
-    # search the mappings (limit/offset paginated results)
+    # retrieve the pairwise alignments of a list of mappings
+    #   param: ids (comma separated mapping ids) or grouping_id
+    path('mappings/pairwise/', mappings.MappingsPairwiseAlignment.as_view()),
+
+    # retrieve the details of a list of mappings
+    #   param: ids (comma separated mapping ids), sequence
+    path('mappings/details/', mappings.MappingDetails.as_view()),
+
+    # export all the mappings matching a search (streamed NDJSON or TSV)
+    path('mappings/export/', mappings.MappingViewsExport.as_view()),
+
+    # search the mappings (limit/offset or cursor paginated results)
     path('mappings/', mappings.MappingViewsSearch.as_view()),
 
     # fetch uniprot entry by db ID
@@ -182,6 +196,12 @@ urlpatterns = [
     # return service status
     path('service/ping/', service.PingService.as_view()),
 
+    # return the metrics of the calls to the external services
+    path('service/external/', service.ExternalServicesMetrics.as_view()),
+
+    # return the hits and misses of the sequence cache
+    path('service/sequence_cache/', service.SequenceCacheStats.as_view()),
+
     # return API version
     path('version/', version.APIVersion.as_view()),
 
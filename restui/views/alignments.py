@@ -29,6 +29,9 @@ from rest_framework.permissions import IsAuthenticated
 import coreapi
 import coreschema
 
+from restui.lib.alignment_load import load_alignments
+from restui.lib.alignment_load import ndjson_records
+from restui.lib.alignment_load import tsv_records
 from restui.models.mappings import Alignment
 from restui.models.mappings import AlignmentRun
 from restui.serializers.alignments import AlignmentSerializer
@@ -89,6 +92,41 @@ class AlignmentCreate(APIView):
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class AlignmentBulkLoad(APIView):
+    """
+    Insert alignments, with their cigar/mdz, in bulk
+    """
+
+    permission_classes = (IsAuthenticated,)
+
+    schema = ManualSchema(
+        description=(
+            "Insert alignments, with their cigar/mdz, in bulk. The body is NDJSON "
+            "(one alignment object per line) or, with a text/tab-separated-values "
+            "content type, TSV with a header naming the fields. The fields are "
+            "those of an alignment, with cigarplus and mdz; alignment_run and "
+            "mapping are required. Alignments already loaded for a run and "
+            "mapping are kept."
+        ),
+        fields=[]
+    )
+
+    def post(self, request):
+        lines = (line.decode('utf-8') for line in request.stream or [])
+
+        if request.content_type.startswith('text/tab-separated-values'):
+            records = tsv_records(lines)
+        else:
+            records = ndjson_records(lines)
+
+        try:
+            loaded = load_alignments(records)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(loaded, status=status.HTTP_201_CREATED)
+
+
 class AlignmentFetch(generics.RetrieveAPIView):
     """
     Retrieve an Alignment
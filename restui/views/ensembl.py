@@ -27,6 +27,7 @@ from rest_framework.schemas import ManualSchema
 import coreapi
 import coreschema
 
+from restui.lib.cache import invalidate_alignment
 from restui.models.ensembl import EnsemblTranscript
 from restui.models.ensembl import EnspUCigar
 from restui.models.ensembl import EnsemblSpeciesHistory
@@ -210,6 +211,15 @@ class EnspUCigarFetchUpdateByAlignment(generics.RetrieveUpdateAPIView):
 
         return obj
 
+    def perform_update(self, serializer):
+        # the cached pairwise alignment is keyed by the cigar/mdz replaced
+        invalidate_alignment(
+            serializer.instance.alignment_id,
+            serializer.instance.cigarplus,
+            serializer.instance.mdz
+        )
+        serializer.save()
+
 
 class LatestEnsemblRelease(APIView):
     """
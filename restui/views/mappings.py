@@ -15,13 +15,26 @@
    limitations under the License.
 """
 
+import csv
+import json
+import logging
 import pprint
 import re
+import time
 import urllib.parse
-
+from collections import OrderedDict
+from collections import defaultdict
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import reduce
+from itertools import chain
+from operator import or_
+
+import requests
+from django.core.serializers.json import DjangoJSONEncoder
 from django.http import Http404
+from django.http import StreamingHttpResponse
 from django.utils import timezone
-from django.core.exceptions import MultipleObjectsReturned
+from django.db.models import Prefetch
 from django.db.models import Q
 from rest_framework.views import APIView
 from rest_framework.response import Response
@@ -36,6 +49,7 @@ import coreschema
 
 from restui.models.ensembl import EnsemblSpeciesHistory
 from restui.models.ensembl import TranscriptHistory
+from restui.models.mappings import Alignment
 from restui.models.mappings import Mapping
 from restui.models.mappings import MappingView
 from restui.models.mappings import MappingHistory
@@ -43,7 +57,6 @@ from restui.models.mappings import ReleaseMappingHistory
 from restui.models.mappings import ReleaseStats
 from restui.models.uniprot import UniprotEntryHistory
 from restui.models.annotations import CvUeStatus
-from restui.models.annotations import CvUeLabel
 from restui.models.annotations import UeMappingStatus
 from restui.models.annotations import UeMappingComment
 from restui.models.annotations import UeMappingLabel
@@ -51,10 +64,12 @@ from restui.serializers.mappings import MappingByHistorySerializer
 from restui.serializers.mappings import ReleaseMappingHistorySerializer
 from restui.serializers.mappings import EnsemblUniprotMappingSerializer
 from restui.serializers.mappings import MappingSerializer
+from restui.serializers.mappings import MappingDetailsSerializer
 from restui.serializers.mappings import MappingCommentsSerializer
 from restui.serializers.mappings import MappingsSerializer
 from restui.serializers.mappings import MappingViewsSerializer
 from restui.serializers.mappings import MappingAlignmentsSerializer
+from restui.serializers.mappings import MappingsAlignmentsSerializer
 from restui.serializers.mappings import CommentLabelSerializer
 from restui.serializers.mappings import ReleaseStatsSerializer
 from restui.serializers.mappings import ReleasePerSpeciesSerializer
@@ -64,10 +79,23 @@ from restui.serializers.annotations import MappingCommentSerializer
 from restui.serializers.annotations import MappingLabelSerializer
 from restui.serializers.annotations import LabelsSerializer
 from restui.pagination import MappingViewFacetPagination, LongResultsPagination
+from restui.lib import vocabulary
 from restui.lib.alignments import fetch_pairwise
+from restui.lib.alignments import fetch_pairwise_many
+from restui.lib.cache import facets_cache_key
+from restui.lib.cache import MAPPING_DETAIL
+from restui.lib.cache import cached_detail
+from restui.lib.cache import invalidate_details
+from restui.lib.cache import invalidate_facets
+from restui.lib.cache import invalidate_group_details
+from restui.lib.external import ensembl_sequence_async
+from restui.lib.external import ensembl_sequences_async
 from restui.lib.mail import GiftsEmail
+from restui.lib.memo import memoised
 from django.conf import settings
 
+logger = logging.getLogger(__name__)
+
 
 def get_mapping(pk):
     try:
@@ -85,9 +113,13 @@ def build_taxonomy_data(mapping):
     fetch one history as the tax id remains the same across all of them
     """
     try:
-        ensembl_species_history = EnsemblSpeciesHistory.objects.filter(
-            transcripthistory__transcript=mapping.transcript
-        ).latest('time_loaded')
+        ensembl_species_history = memoised(
+            'transcript_latest_species_history',
+            mapping.transcript_id,
+            lambda: EnsemblSpeciesHistory.objects.filter(
+                transcripthistory__transcript=mapping.transcript
+            ).latest('time_loaded')
+        )
     except EnsemblSpeciesHistory.DoesNotExist:
         raise Http404(
             (
@@ -95,6 +127,14 @@ def build_taxonomy_data(mapping):
             ).format(mapping.mapping_id)
         )
 
+    return taxonomy_data(mapping, ensembl_species_history)
+
+
+def taxonomy_data(mapping, ensembl_species_history):
+    """
+    Return the taxonomy of the mapping given the ensembl species history of
+    its transcript
+    """
     try:
         return {
             'species': ensembl_species_history.species,
@@ -110,14 +150,62 @@ def build_taxonomy_data(mapping):
         )
 
 
-def build_related_mappings_data(mapping):
+# relations of a mapping and of a mapping history the detail is built from
+MAPPING_RELATIONS = ('uniprot', 'transcript__gene')
+MAPPING_HISTORY_RELATIONS = ('release_mapping_history__ensembl_species_history',)
+
+
+def latest_mapped_history(mapping):
+    """
+    Return the history of the mapping in its latest mapped release, with the
+    release and species histories (see Mapping.latest_mapped_history)
+    """
+    try:
+        return mapping.latest_mapped_history()
+    except MappingHistory.DoesNotExist:
+        raise Http404(
+            "Couldn't find a history for mapping {}".format(mapping.mapping_id)
+        )
+
+
+def latest_histories(mapping_ids):
+    """
+    Return the latest history of each of the given mappings, with the release
+    and species histories, in one query
+
+    Returns
+    -------
+    dict
+        mapping id -> MappingHistory
+    """
+    histories = MappingHistory.objects.filter(
+        mapping_id__in=set(mapping_ids)
+    ).select_related(
+        *MAPPING_HISTORY_RELATIONS
+    ).order_by(
+        'mapping_id',
+        '-mapping_history_id'
+    ).distinct(
+        'mapping_id'
+    )
+
+    return {mh.mapping_id: mh for mh in histories}
+
+
+def build_related_mappings_data(mapping, mapping_history=None):
     """
     Return the list of mappings sharing the same ENST or Uniprot accession of
     the given mapping.
 
+    The related mappings, their latest histories and their status histories
+    are each fetched with one query, whatever the size of the group.
+
     Parameters
     ----------
     mapping : Mapping object
+    mapping_history : MappingHistory object
+        The latest mapped history of the mapping (see latest_mapped_history),
+        fetched when not given
 
     Returns
     -------
@@ -126,94 +214,128 @@ def build_related_mappings_data(mapping):
     """
 
     # related mappings share the same group_id and tax id
-    mapping_mh = mapping.mapping_history.latest(
-        'release_mapping_history__time_mapped'
-    )
-
-    mapping_mh_rmh = mapping_mh.release_mapping_history
-    mapping_grouping_id = mapping_mh.grouping_id
+    if mapping_history is None:
+        mapping_history = latest_mapped_history(mapping)
 
     related_mappings_mh = MappingHistory.objects.filter(
-        release_mapping_history=mapping_mh_rmh,
-        grouping_id=mapping_grouping_id
+        release_mapping_history_id=mapping_history.release_mapping_history_id,
+        grouping_id=mapping_history.grouping_id
+    ).exclude(
+        mapping_id=mapping.mapping_id
+    ).select_related(
+        *('mapping__{}'.format(relation) for relation in MAPPING_RELATIONS)
     )
 
-    related_mappings = []
-    for mh in related_mappings_mh:
-        m = mh.mapping
-        if m.mapping_id != mapping.mapping_id:
-            related_mappings.append(
-                MappingsSerializer.build_mapping(m, fetch_sequence=False)
+    related_mappings = [mh.mapping for mh in related_mappings_mh]
+    if not related_mappings:
+        return []
+
+    # the latest history of each related mapping, as in build_mapping
+    latest_history = latest_histories(m.mapping_id for m in related_mappings)
+
+    Mapping.prefetch_statuses(related_mappings)
+
+    related_mappings_data = []
+    for m in related_mappings:
+        related_mappings_data.append(
+            MappingsSerializer.build_mapping(
+                m,
+                fetch_sequence=False,
+                mapping_history=latest_history[m.mapping_id]
             )
+        )
 
-    return related_mappings
+    return related_mappings_data
 
 
-def build_related_unmapped_entries_data(mapping):
+def unmapped_uniprot_data(up_entry):
+    """
+    Return the data of a uniprot entry related to a mapping
+    """
+    return {
+        'uniprot_id': up_entry.uniprot_id,
+        'uniprotAccession': up_entry.uniprot_acc,
+        'entryType': Mapping.entry_type(up_entry.entry_type_id),
+        'sequenceVersion': up_entry.sequence_version,
+        'upi': up_entry.upi,
+        'md5': up_entry.md5,
+        'isCanonical': not up_entry.canonical_uniprot_id,
+        'alias': up_entry.alias,
+        'ensemblDerived': up_entry.ensembl_derived,
+        'gene_symbol': up_entry.gene_symbol,
+        'gene_accession': up_entry.chromosome_line,
+        'length': up_entry.length,
+        'protein_existence_id': up_entry.protein_existence_id
+    }
+
+
+def unmapped_transcript_data(transcript):
+    """
+    Return the data of an ensembl transcript related to a mapping
+    """
+    return {
+        'transcript_id': transcript.transcript_id,
+        'enstId': transcript.enst_id,
+        'enstVersion': transcript.enst_version,
+        'upi': transcript.uniparc_accession,
+        'biotype': transcript.biotype,
+        'deleted': transcript.deleted,
+        'chromosome': transcript.gene.chromosome,
+        'regionAccession': transcript.gene.region_accession,
+        'seqRegionStart': transcript.seq_region_start,
+        'seqRegionEnd': transcript.seq_region_end,
+        'seqRegionStrand': transcript.gene.seq_region_strand,
+        'ensgId': transcript.gene.ensg_id,
+        'ensgName': transcript.gene.gene_name,
+        'ensgSymbol': transcript.gene.gene_symbol,
+        'ensgAccession': transcript.gene.gene_accession,
+        'ensgRegionAccession': transcript.gene.region_accession,
+        'sequence': None,
+        'enspId': transcript.ensp_id,
+        'enspLen': transcript.ensp_len,
+        'source': transcript.source,
+        'select': transcript.select
+    }
+
+
+def build_related_unmapped_entries_data(mapping, mapping_history=None):
     """
     Return the list of unmapped entries releated to the mapping (via grouping_id)
+
+    mapping_history is the latest mapped history of the mapping (see
+    latest_mapped_history), fetched when not given
     """
 
     # related unmapped entries share the same grouping_id and tax id
-    mapping_mh = mapping.mapping_history.latest('release_mapping_history__time_mapped')
-    mapping_mh_rmh = mapping_mh.release_mapping_history
-    mapping_grouping_id = mapping_mh.grouping_id
+    if mapping_history is None:
+        mapping_history = latest_mapped_history(mapping)
+
+    mapping_mh_rmh = mapping_history.release_mapping_history
+    mapping_grouping_id = mapping_history.grouping_id
 
     related_unmapped_ue_histories = UniprotEntryHistory.objects.filter(
         release_version=mapping_mh_rmh.uniprot_release,
         grouping_id=mapping_grouping_id
+    ).select_related(
+        'uniprot'
     )
 
-    related_unmapped_ue_entries = []
-    for ueh in related_unmapped_ue_histories:
-        up_entry = ueh.uniprot
-        related_unmapped_ue_entries.append({
-            'uniprot_id': up_entry.uniprot_id,
-            'uniprotAccession': up_entry.uniprot_acc,
-            'entryType': Mapping.entry_type(up_entry.entry_type_id),
-            'sequenceVersion': up_entry.sequence_version,
-            'upi': up_entry.upi,
-            'md5': up_entry.md5,
-            'isCanonical': not up_entry.canonical_uniprot_id,
-            'alias': up_entry.alias,
-            'ensemblDerived': up_entry.ensembl_derived,
-            'gene_symbol': up_entry.gene_symbol,
-            'gene_accession': up_entry.chromosome_line,
-            'length': up_entry.length,
-            'protein_existence_id': up_entry.protein_existence_id
-        })
+    related_unmapped_ue_entries = [
+        unmapped_uniprot_data(ueh.uniprot)
+        for ueh in related_unmapped_ue_histories
+    ]
 
     related_unmapped_transcript_histories = TranscriptHistory.objects.filter(
-        ensembl_species_history=mapping_mh_rmh.ensembl_species_history,
+        ensembl_species_history_id=mapping_mh_rmh.ensembl_species_history_id,
         grouping_id=mapping_grouping_id
+    ).select_related(
+        'transcript__gene'
     )
 
-    related_unmapped_transcripts = []
-    for t_hist in related_unmapped_transcript_histories:
-        transcript = t_hist.transcript
-        related_unmapped_transcripts.append({
-            'transcript_id': transcript.transcript_id,
-            'enstId': transcript.enst_id,
-            'enstVersion': transcript.enst_version,
-            'upi': transcript.uniparc_accession,
-            'biotype': transcript.biotype,
-            'deleted': transcript.deleted,
-            'chromosome': transcript.gene.chromosome,
-            'regionAccession': transcript.gene.region_accession,
-            'seqRegionStart': transcript.seq_region_start,
-            'seqRegionEnd': transcript.seq_region_end,
-            'seqRegionStrand': transcript.gene.seq_region_strand,
-            'ensgId': transcript.gene.ensg_id,
-            'ensgName': transcript.gene.gene_name,
-            'ensgSymbol': transcript.gene.gene_symbol,
-            'ensgAccession': transcript.gene.gene_accession,
-            'ensgRegionAccession': transcript.gene.region_accession,
-            'sequence': None,
-            'enspId': transcript.ensp_id,
-            'enspLen': transcript.ensp_len,
-            'source': transcript.source,
-            'select': transcript.select
-        })
+    related_unmapped_transcripts = [
+        unmapped_transcript_data(t_hist.transcript)
+        for t_hist in related_unmapped_transcript_histories
+    ]
 
     return {
         'ensembl': related_unmapped_transcripts,
@@ -221,6 +343,297 @@ def build_related_unmapped_entries_data(mapping):
     }
 
 
+def sequence_result(sequence_future, deadline, fetched):
+    """
+    Wait for sequences fetched with ensembl_sequence(s)_async until deadline
+    (a time.monotonic() time), None when they don't come in time or can't
+    be fetched. fetched describes what is fetched for the logs.
+    """
+    try:
+        return sequence_future.result(
+            timeout=max(0, deadline - time.monotonic())
+        )
+    except FutureTimeoutError:
+        logger.warning("Timed out fetching %s", fetched)
+    except Exception as e:  # pylint: disable=broad-except
+        logger.warning("Couldn't fetch %s: %s", fetched, e)
+
+    return None
+
+
+def load_mapping_detail(pk, fetch_sequence=True, authenticated=False):
+    """
+    Gather the data of the mapping detail: the mapping, its taxonomy, its
+    related mappings and unmapped entries, in a fixed number of batched
+    queries whatever the size of the mapping group.
+
+    The transcript sequence is fetched from Ensembl in the background while
+    the database is read, if it doesn't come within ENSEMBL_SEQUENCE_TIMEOUT
+    seconds the sequence is null.
+
+    Parameters
+    ----------
+    pk : int
+        The mapping id
+    fetch_sequence : bool
+        Whether to fetch the transcript sequence from Ensembl
+    authenticated : bool
+        Whether to give the users in the status history
+
+    Returns
+    -------
+    dict
+        taxonomy, mapping and relatedEntries of the detail
+    """
+    try:
+        mapping = Mapping.objects.select_related(*MAPPING_RELATIONS).get(pk=pk)
+    except Mapping.DoesNotExist:
+        raise Http404
+
+    # all the histories of the mapping in one go: build_mapping reports the
+    # latest one, the related entries come from the latest mapped release
+    mapping_histories = list(
+        mapping.mapping_history.select_related(*MAPPING_HISTORY_RELATIONS)
+    )
+    if not mapping_histories:
+        raise Http404("Couldn't find a history for mapping {}".format(pk))
+
+    latest_history = max(
+        mapping_histories,
+        key=lambda mh: mh.mapping_history_id
+    )
+    latest_mapped = max(
+        mapping_histories,
+        key=lambda mh: mh.release_mapping_history.time_mapped
+    )
+
+    sequence_future = None
+    if fetch_sequence:
+        ensembl_history = latest_history.release_mapping_history.ensembl_species_history
+        sequence_future = ensembl_sequence_async(
+            mapping.transcript.enst_id,
+            ensembl_history.ensembl_release
+        )
+        sequence_deadline = time.monotonic() + settings.ENSEMBL_SEQUENCE_TIMEOUT
+
+    detail = {
+        'taxonomy': build_taxonomy_data(mapping),
+        'mapping': MappingsSerializer.build_mapping(
+            mapping,
+            fetch_sequence=False,
+            authenticated=authenticated,
+            mapping_history=latest_history
+        ),
+        'relatedEntries': {
+            'mapped': build_related_mappings_data(
+                mapping,
+                mapping_history=latest_mapped
+            ),
+            'unmapped': build_related_unmapped_entries_data(
+                mapping,
+                mapping_history=latest_mapped
+            )
+        }
+    }
+
+    if sequence_future is not None:
+        detail['mapping']['ensemblTranscript']['sequence'] = sequence_result(
+            sequence_future,
+            sequence_deadline,
+            "the sequence of {}".format(mapping.transcript.enst_id)
+        )
+
+    return detail
+
+
+def load_mapping_details(pks, fetch_sequence=False, authenticated=False):
+    """
+    Gather the details of several mappings (see load_mapping_detail), each
+    kind of data being fetched for all the mappings at once: the number of
+    queries doesn't depend on the number of mappings.
+
+    The sequences are fetched in the background, in batches per release, and
+    the detail of a mapping whose sequence doesn't come within
+    ENSEMBL_SEQUENCE_TIMEOUT seconds has a null sequence.
+
+    Parameters
+    ----------
+    pks : iterable of int
+        The mapping ids
+    fetch_sequence : bool
+        Whether to fetch the transcript sequences from Ensembl
+    authenticated : bool
+        Whether to give the users in the status histories
+
+    Returns
+    -------
+    dict
+        mapping id -> detail, without the mappings which don't exist or
+        don't have a history
+    """
+    mappings = Mapping.objects.select_related(*MAPPING_RELATIONS).in_bulk(list(pks))
+
+    mapping_histories = defaultdict(list)
+    for mh in MappingHistory.objects.filter(
+            mapping_id__in=list(mappings)
+    ).select_related(
+        *MAPPING_HISTORY_RELATIONS
+    ):
+        mapping_histories[mh.mapping_id].append(mh)
+
+    # the species history of each transcript, as in build_taxonomy_data
+    species_histories = {
+        th.transcript_id: th.ensembl_species_history
+        for th in TranscriptHistory.objects.filter(
+            transcript_id__in={m.transcript_id for m in mappings.values()}
+        ).select_related(
+            'ensembl_species_history'
+        ).order_by(
+            'transcript_id',
+            '-ensembl_species_history__time_loaded'
+        ).distinct(
+            'transcript_id'
+        )
+    }
+
+    mappings = {
+        pk: mapping for pk, mapping in mappings.items()
+        if pk in mapping_histories and mapping.transcript_id in species_histories
+    }
+    if not mappings:
+        return {}
+
+    latest_history = {
+        pk: max(mapping_histories[pk], key=lambda mh: mh.mapping_history_id)
+        for pk in mappings
+    }
+    latest_mapped = {
+        pk: max(
+            mapping_histories[pk],
+            key=lambda mh: mh.release_mapping_history.time_mapped
+        )
+        for pk in mappings
+    }
+
+    # one batch of sequences per release
+    sequence_futures = {}
+    if fetch_sequence:
+        enst_ids = defaultdict(set)
+        for pk, mapping in mappings.items():
+            ensembl_history = latest_history[pk].release_mapping_history.ensembl_species_history
+            enst_ids[ensembl_history.ensembl_release].add(mapping.transcript.enst_id)
+
+        for release, release_enst_ids in enst_ids.items():
+            sequence_futures[release] = ensembl_sequences_async(release_enst_ids, release)
+        sequence_deadline = time.monotonic() + settings.ENSEMBL_SEQUENCE_TIMEOUT
+
+    # the mappings of all the groups, then the latest history of each
+    groups = {
+        (mh.release_mapping_history_id, mh.grouping_id)
+        for mh in latest_mapped.values()
+    }
+    group_mappings = defaultdict(list)
+    for mh in MappingHistory.objects.filter(
+            reduce(or_, (
+                Q(release_mapping_history_id=release_id, grouping_id=grouping_id)
+                for release_id, grouping_id in groups
+            ))
+    ).select_related(
+        *('mapping__{}'.format(relation) for relation in MAPPING_RELATIONS)
+    ):
+        group_mappings[(mh.release_mapping_history_id, mh.grouping_id)].append(mh.mapping)
+
+    related_mappings = list(chain.from_iterable(group_mappings.values()))
+    related_latest_history = latest_histories(m.mapping_id for m in related_mappings)
+
+    Mapping.prefetch_statuses(mappings.values(), usernames=authenticated)
+    Mapping.prefetch_statuses(related_mappings)
+
+    # the unmapped entries of all the groups
+    group_uniprot_entries = defaultdict(list)
+    for ueh in UniprotEntryHistory.objects.filter(
+            reduce(or_, (
+                Q(
+                    release_version=mh.release_mapping_history.uniprot_release,
+                    grouping_id=mh.grouping_id
+                )
+                for mh in latest_mapped.values()
+            ))
+    ).select_related(
+        'uniprot'
+    ):
+        group_uniprot_entries[(ueh.release_version, ueh.grouping_id)].append(
+            unmapped_uniprot_data(ueh.uniprot)
+        )
+
+    group_transcripts = defaultdict(list)
+    for t_hist in TranscriptHistory.objects.filter(
+            reduce(or_, (
+                Q(
+                    ensembl_species_history_id=mh.release_mapping_history.ensembl_species_history_id,
+                    grouping_id=mh.grouping_id
+                )
+                for mh in latest_mapped.values()
+            ))
+    ).select_related(
+        'transcript__gene'
+    ):
+        group_transcripts[(t_hist.ensembl_species_history_id, t_hist.grouping_id)].append(
+            unmapped_transcript_data(t_hist.transcript)
+        )
+
+    details = {}
+    for pk, mapping in mappings.items():
+        mapped = latest_mapped[pk]
+        release = mapped.release_mapping_history
+
+        details[pk] = {
+            'taxonomy': taxonomy_data(mapping, species_histories[mapping.transcript_id]),
+            'mapping': MappingsSerializer.build_mapping(
+                mapping,
+                fetch_sequence=False,
+                authenticated=authenticated,
+                mapping_history=latest_history[pk]
+            ),
+            'relatedEntries': {
+                'mapped': [
+                    MappingsSerializer.build_mapping(
+                        m,
+                        fetch_sequence=False,
+                        mapping_history=related_latest_history[m.mapping_id]
+                    )
+                    for m in group_mappings[(mapped.release_mapping_history_id, mapped.grouping_id)]
+                    if m.mapping_id != pk
+                ],
+                'unmapped': {
+                    'ensembl': group_transcripts[
+                        (release.ensembl_species_history_id, mapped.grouping_id)
+                    ],
+                    'uniprot': group_uniprot_entries[
+                        (release.uniprot_release, mapped.grouping_id)
+                    ]
+                }
+            }
+        }
+
+    sequences = {}
+    for release, sequence_future in sequence_futures.items():
+        sequences[release] = sequence_result(
+            sequence_future,
+            sequence_deadline,
+            "the sequences of release {}".format(release)
+        ) or {}
+
+    if fetch_sequence:
+        for pk, detail in details.items():
+            ensembl_history = latest_history[pk].release_mapping_history.ensembl_species_history
+            detail['mapping']['ensemblTranscript']['sequence'] = sequences[
+                ensembl_history.ensembl_release
+            ].get(mappings[pk].transcript.enst_id)
+
+    return details
+
+
 #
 # TODO: filter by ensembl release (optional argument)
 #
@@ -435,6 +848,7 @@ class MappingLabelView(APIView):
 
         if serializer.is_valid():
             serializer.save()
+            invalidate_details(MAPPING_DETAIL, mapping.mapping_id)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -451,6 +865,7 @@ class MappingLabelView(APIView):
 
         if mapping_labels:
             mapping_labels.delete()
+            invalidate_details(MAPPING_DETAIL, mapping.mapping_id)
 
             return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -478,15 +893,14 @@ class MappingLabelsView(APIView):
     def get(self, request, pk):
         mapping = get_mapping(pk)
 
-        all_labels = CvUeLabel.objects.all()
         mapping_labels = mapping.labels.values_list('label', flat=True)
 
         label_map = []
-        for label in all_labels:
+        for label_id, label in vocabulary.terms(vocabulary.LABEL):
             label_map.append({
-                'label': label.description,
-                'id': label.id,
-                'status': label.id in mapping_labels
+                'label': label,
+                'id': label_id,
+                'status': label_id in mapping_labels
             })
 
         data = {'labels': label_map}
@@ -547,6 +961,7 @@ class EditDeleteCommentView(APIView):
             comment.comment = request.data['text']
             comment.time_stamp = timezone.now()
             comment.save()
+            invalidate_details(MAPPING_DETAIL, mapping.mapping_id)
 
         editable = False
         if request.user and request.user == comment.user_stamp:
@@ -575,6 +990,7 @@ class EditDeleteCommentView(APIView):
         else:
             comment.deleted = True
             comment.save()
+            invalidate_details(MAPPING_DETAIL, mapping.mapping_id)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -649,6 +1065,7 @@ class MappingCommentsView(APIView):
 
         if serializer.is_valid():
             serializer.save()
+            invalidate_details(MAPPING_DETAIL, mapping.mapping_id)
 
             email = GiftsEmail(request)
             build_comments_email = email.build_comments_email(mapping)
@@ -688,19 +1105,16 @@ class MappingStatusView(APIView):
     def put(self, request, pk):
         mapping = get_mapping(pk)
 
-        # retrieve the status object associated to the given description
+        # retrieve the status id associated to the given description
         try:
-            s = CvUeStatus.objects.get(description=request.data['status'])
+            status_id = vocabulary.identity(vocabulary.STATUS, request.data['status'])
         except KeyError:
             raise Http404("Payload should have 'status'")
-        except CvUeStatus.DoesNotExist:
+
+        if status_id is None:
             raise Http404(
                 "Couldn't get status object for {}".format(request.data['status'])
             )
-        except MultipleObjectsReturned:
-            raise Http404(
-                "Couldn't get unique status for {}".format(request.data['status'])
-            )
 
         """
         If the mapping has already been assigned that status, update the timestamp,
@@ -716,7 +1130,7 @@ class MappingStatusView(APIView):
             pass
 
         else:
-            if mapping_status.status.id == s.id:
+            if mapping_status.status_id == status_id:
                 # The user is trying to change it to what the status
                 # already is, nothing to do.
                 return Response(status=status.HTTP_204_NO_CONTENT)
@@ -726,7 +1140,7 @@ class MappingStatusView(APIView):
             data={
                 'time_stamp': timezone.now(),
                 'user_stamp': request.user.pk,
-                'status': s.id,
+                'status': status_id,
                 'mapping': mapping.mapping_id
             }
         )
@@ -740,7 +1154,7 @@ class MappingStatusView(APIView):
             )
 
         # Update the status in the mapping record
-        mapping.status = s
+        mapping.status_id = status_id
         mapping.save()
 
         # update status on mapping_view corresponding entry,
@@ -753,12 +1167,25 @@ class MappingStatusView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
         else:
-            prev_status = CvUeStatus.objects.get(id=mv.status)
-            mv.status = s.id
+            prev_status = vocabulary.description(vocabulary.STATUS, mv.status)
+            mv.status = status_id
             mv.save()
 
+            # the status facet counts have changed, and so have the details
+            # of the entries related to the mapping
+            invalidate_facets()
+            invalidate_group_details(
+                mv.grouping_id,
+                mapping_id=pk,
+                mapping_view_id=mv.id
+            )
+
             email = GiftsEmail(request)
-            build_status_change_email = email.build_status_change_email(mapping, prev_status.description, s.description)
+            build_status_change_email = email.build_status_change_email(
+                mapping,
+                prev_status,
+                vocabulary.description(vocabulary.STATUS, status_id)
+            )
             if build_status_change_email:
                 email.send()
 
@@ -796,6 +1223,18 @@ class MappingAlignmentDifference(APIView):
         mapping.alignment_difference = difference
         mapping.save()
 
+        # the related entries of the details in the group show the difference
+        try:
+            mv = MappingView.objects.get(mapping_id=pk)
+        except MappingView.DoesNotExist:
+            invalidate_details(MAPPING_DETAIL, mapping.mapping_id)
+        else:
+            invalidate_group_details(
+                mv.grouping_id,
+                mapping_id=pk,
+                mapping_view_id=mv.id
+            )
+
         serializer = EnsemblUniprotMappingSerializer(
             MappingsSerializer.build_mapping(mapping)
         )
@@ -840,6 +1279,106 @@ class MappingPairwiseAlignment(APIView):
         return Response(serializer.data)
 
 
+class MappingsPairwiseAlignment(APIView):
+    """
+    Retrieve the pairwise alignments of a list of mappings, or of all the
+    mappings of a group, at once.
+    """
+
+    schema = ManualSchema(
+        description=(
+            "Retrieve the pairwise alignments of a list of mappings, or of all "
+            "the mappings of a group, at once"
+        ),
+        fields=[
+            coreapi.Field(
+                name="ids",
+                location="query",
+                schema=coreschema.String(),
+                description=(
+                    "Comma separated list of mapping ids (at most "
+                    "MAPPING_PAIRWISE_MAX_IDS)"
+                )
+            ),
+            coreapi.Field(
+                name="grouping_id",
+                location="query",
+                schema=coreschema.Integer(),
+                description="Id of the group of mappings, instead of ids"
+            ),
+        ]
+    )
+
+    def get(self, request):
+        grouping_id = request.query_params.get('grouping_id')
+        ids = request.query_params.get('ids')
+
+        try:
+            if grouping_id is not None:
+                pks = list(
+                    MappingView.objects.filter(
+                        grouping_id=int(grouping_id),
+                        mapping_id__isnull=False
+                    ).order_by(
+                        'mapping_id'
+                    ).values_list(
+                        'mapping_id',
+                        flat=True
+                    )
+                )
+            elif ids is not None:
+                pks = [int(pk) for pk in ids.split(',') if pk.strip()]
+            else:
+                raise Http404("Must provide ids or grouping_id")
+        except ValueError:
+            raise Http404("Invalid mapping or grouping id")
+
+        # keep the request order, without duplicates
+        pks = list(OrderedDict.fromkeys(pks))
+
+        if len(pks) > settings.MAPPING_PAIRWISE_MAX_IDS:
+            return Response(
+                {"error": "At most {} mappings at once".format(settings.MAPPING_PAIRWISE_MAX_IDS)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        mappings = Mapping.objects.select_related(
+            'transcript'
+        ).select_related(
+            'uniprot'
+        ).prefetch_related(
+            Prefetch(
+                'alignments',
+                queryset=Alignment.objects.select_related(
+                    'alignment_run',
+                    'pairwise'
+                ).order_by(
+                    'alignment_id'
+                )
+            )
+        ).in_bulk(pks)
+
+        # the mappings and sequences not found are left out, only Ensembl
+        # failing fails the request
+        try:
+            alignments = fetch_pairwise_many(
+                mappings[pk] for pk in pks if pk in mappings
+            )
+        except requests.RequestException as e:
+            logger.error("Couldn't fetch the sequences of the mappings %s: %s", pks, e)
+            return Response(
+                {"error": "Couldn't fetch the sequences from Ensembl"},
+                status=status.HTTP_502_BAD_GATEWAY
+            )
+
+        serializer = MappingsAlignmentsSerializer({
+            'results': alignments,
+            'notFound': [pk for pk in pks if pk not in mappings]
+        })
+
+        return Response(serializer.data)
+
+
 class MappingDetailed(APIView):
     """
     Retrieve a single mapping, includes related mappings/unmapped entries and taxonomy information.
@@ -862,8 +1401,6 @@ class MappingDetailed(APIView):
     )
 
     def get(self, request, pk):
-        mapping = get_mapping(pk)
-
         authenticated = False
         if request.user and request.user.is_authenticated:
             authenticated = True
@@ -873,25 +1410,96 @@ class MappingDetailed(APIView):
             for (recipient_id, recipient_details) in settings.EMAIL_RECIPIENT_LIST.items()
         }
 
-        data = {
-            'taxonomy': build_taxonomy_data(mapping),
-            'mapping': MappingsSerializer.build_mapping(
-                mapping,
-                fetch_sequence=True,
-                authenticated=authenticated
-            ),
-            'relatedEntries': {
-                'mapped': build_related_mappings_data(mapping),
-                'unmapped': build_related_unmapped_entries_data(mapping)
-            },
-            'emailRecipientsList': email_recipients_list
-        }
+        # a detail missing its sequence (Ensembl timed out) isn't cached
+        data = cached_detail(
+            MAPPING_DETAIL,
+            pk,
+            lambda: load_mapping_detail(pk, authenticated=authenticated),
+            authenticated=authenticated,
+            cacheable=lambda detail: detail['mapping']['ensemblTranscript']['sequence'] is not None
+        )
+        data['emailRecipientsList'] = email_recipients_list
 
         serializer = MappingSerializer(data)
 
         return Response(serializer.data)
 
 
+class MappingDetails(APIView):
+    """
+    Retrieve the details of a list of mappings at once, as mapping/:id does for
+    a single mapping.
+    """
+
+    schema = ManualSchema(
+        description=(
+            "Retrieve the details of a list of mappings at once, as mapping/:id "
+            "does for a single mapping."
+        ),
+        fields=[
+            coreapi.Field(
+                name="ids",
+                required=True,
+                location="query",
+                schema=coreschema.String(),
+                description=(
+                    "Comma separated list of mapping ids (at most "
+                    "MAPPING_DETAILS_MAX_IDS)"
+                )
+            ),
+            coreapi.Field(
+                name="sequence",
+                location="query",
+                schema=coreschema.Boolean(),
+                description=(
+                    "Whether to fetch the transcript sequences from Ensembl "
+                    "(default: false)"
+                )
+            ),
+        ]
+    )
+
+    def get(self, request):
+        try:
+            pks = [
+                int(pk)
+                for pk in request.query_params['ids'].split(',')
+                if pk.strip()
+            ]
+        except KeyError:
+            raise Http404("Must provide ids")
+        except ValueError:
+            raise Http404("Invalid mapping id in {}".format(request.query_params['ids']))
+
+        # keep the request order, without duplicates
+        pks = list(OrderedDict.fromkeys(pks))
+
+        if len(pks) > settings.MAPPING_DETAILS_MAX_IDS:
+            return Response(
+                {"error": "At most {} mappings at once".format(settings.MAPPING_DETAILS_MAX_IDS)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        authenticated = False
+        if request.user and request.user.is_authenticated:
+            authenticated = True
+
+        fetch_sequence = request.query_params.get('sequence', 'false').lower() == 'true'
+
+        details = load_mapping_details(
+            pks,
+            fetch_sequence=fetch_sequence,
+            authenticated=authenticated
+        )
+
+        serializer = MappingDetailsSerializer({
+            'results': [details[pk] for pk in pks if pk in details],
+            'notFound': [pk for pk in pks if pk not in details]
+        })
+
+        return Response(serializer.data)
+
+
 class MappingViewsSearch(generics.ListAPIView):
     """
     Search/retrieve all mappings views.
@@ -912,13 +1520,32 @@ class MappingViewsSearch(generics.ListAPIView):
         """
         facets_params = self.request.query_params.get('facets', None)
 
+        # 'fuzzy' matches gene symbols and names approximately, ranking the
+        # groups by similarity to the search term
+        search_mode = self.request.query_params.get('searchMode', None)
+
+        # annotation the pagination ranks the groups by, if any
+        self.search_score = None  # pylint: disable=attribute-defined-outside-init
+
         # search the mappings according to the search term 'type'
         queryset = None
         if search_term:
-            if re.match(r"^ENS[A-Z]*?G[0-9]+?$", search_term, re.I):
+            if search_mode == 'fuzzy':
+                search_type = 'fuzzy'
+                queryset = MappingView.objects.all().fuzzy_search(
+                    search_term,
+                    'gene_symbol_up',
+                    'gene_symbol_eg',
+                    'gene_name'
+                )
+                self.search_score = 'search_similarity'  # pylint: disable=attribute-defined-outside-init
+
+            elif re.match(r"^ENS[A-Z]*?G[0-9]+?$", search_term, re.I):
+                search_type = 'ensg'
                 queryset = MappingView.objects.filter(ensg_id__iexact=search_term)
 
             elif re.match(r"^ENS[A-Z]*?T[0-9]+(.[0-9]+)?$", search_term, re.I):
+                search_type = 'enst'
                 queryset = MappingView.objects.filter(enst_id__iexact=search_term)
 
             elif re.match(
@@ -926,22 +1553,29 @@ class MappingViewsSearch(generics.ListAPIView):
                     search_term, re.I
             ):  # looks like a Uniprot accession
                 # filter in order to get the isoforms as well
-                queryset = MappingView.objects.filter(
-                    uniprot_acc__iregex=r"^"+search_term
+                search_type = 'uniprot'
+                queryset = MappingView.objects.all().prefix_search(
+                    search_term, 'uniprot_acc'
                 )
 
             else:
                 # should be a search request with a gene symbol (both Uniprot
                 # and Ensembl) and possibly name
-                query_filter = Q(gene_symbol_up__iregex=r"^"+search_term)
-                query_filter |= Q(gene_symbol_eg__iregex=r"^"+search_term)
-                query_filter |= Q(gene_name__iregex=r"^"+search_term)
-                queryset = MappingView.objects.filter(query_filter)
+                search_type = 'gene'
+                queryset = MappingView.objects.all().prefix_search(
+                    search_term,
+                    'gene_symbol_up',
+                    'gene_symbol_eg',
+                    'gene_name'
+                )
 
         else:
             # no search term: return all mappings
+            search_type = 'all'
             queryset = MappingView.objects.all()
 
+        facets = {}
+
         #
         # Apply filters based on facets parameters
         #
@@ -951,7 +1585,6 @@ class MappingViewsSearch(generics.ListAPIView):
 
             # create facets dict from e.g.
             # 'organism:9606,10090;status:unreviewed;chromosome:10,11,X'
-            facets = {}
             for param in facets_params.split(';'):
                 p = param.split(':')
                 facets[p[0]] = p[1]
@@ -990,16 +1623,17 @@ class MappingViewsSearch(generics.ListAPIView):
                 status_filter = Q()
 
                 for status_description in facets['status'].split(','):
-                    try:
-                        status_id = CvUeStatus.objects.get(
-                            description=status_description.upper()
-                        ).id
-                    except:
+                    status_id = vocabulary.identity(
+                        vocabulary.STATUS,
+                        status_description.upper()
+                    )
+
+                    if status_id is None:
                         # TODO Should be a 400, how do we make this work with pagination?
                         # return Response(status=status.HTTP_400_BAD_REQUEST)
                         raise Http404("Invalid status type")
-                    else:
-                        status_filter |= Q(status=status_id)
+
+                    status_filter |= Q(status=status_id)
 
                 queryset = queryset.filter(status_filter)
 
@@ -1029,4 +1663,174 @@ class MappingViewsSearch(generics.ListAPIView):
                 elif facets["patches"] == 'only':
                     queryset = queryset.filter(region_accession__iregex=r"^CHR")
 
+        # the facets only depend on the search, not on the page requested
+        self.facets_cache_key = facets_cache_key(  # pylint: disable=attribute-defined-outside-init
+            search_type,
+            search_term,
+            facets
+        )
+
         return queryset
+
+
+class Echo(object):
+    """
+    File-like object returning what is written to it, to stream the lines
+    written by a csv writer
+    """
+
+    def write(self, value):
+        return value
+
+
+class MappingViewsExport(MappingViewsSearch):
+    """
+    Export all the mapping views matching a search, i.e. the same searchTerm,
+    searchMode and facets as the mappings/ endpoint, as NDJSON (one JSON object
+    per line) or TSV.
+
+    Results are streamed from a server-side cursor, neither paginated nor
+    faceted, so that memory use doesn't depend on the size of the export.
+    """
+
+    pagination_class = None
+
+    # rows fetched from the server-side cursor at a time
+    chunk_size = 2000
+
+    export_fields = (
+        'id',
+        'mapping_id',
+        'grouping_id',
+        'uniprot_acc',
+        'uniprot_tax_id',
+        'entry_type',
+        'sequence_version',
+        'gene_symbol_up',
+        'enst_id',
+        'enst_version',
+        'ensp_id',
+        'ensg_id',
+        'gene_symbol_eg',
+        'gene_name',
+        'chromosome',
+        'region_accession',
+        'seq_region_start',
+        'seq_region_end',
+        'seq_region_strand',
+        'biotype',
+        'ensembl_release',
+        'uniprot_release',
+        'time_mapped',
+        'alignment_difference',
+        'status',
+        'uniprot_mapping_status',
+    )
+
+    schema = ManualSchema(
+        description="Export all the mappings matching a search",
+        fields=[
+            coreapi.Field(
+                name="searchTerm",
+                required=False,
+                location="query",
+                schema=coreschema.String(),
+                description="ENSG, ENST, UniProt accession, gene symbol or gene name"
+            ),
+            coreapi.Field(
+                name="searchMode",
+                required=False,
+                location="query",
+                schema=coreschema.String(),
+                description="'fuzzy' to match gene symbols and names approximately"
+            ),
+            coreapi.Field(
+                name="facets",
+                required=False,
+                location="query",
+                schema=coreschema.String(),
+                description="Filters, e.g. organism:9606,status:unreviewed"
+            ),
+            coreapi.Field(
+                name="output",
+                required=False,
+                location="query",
+                schema=coreschema.String(),
+                description="Export format, 'ndjson' (default) or 'tsv'"
+            ),
+        ]
+    )
+
+    def get(self, request, *args, **kwargs):
+        output = request.query_params.get('output', 'ndjson')
+        if output not in ('ndjson', 'tsv'):
+            raise Http404("Invalid output format {}".format(output))
+
+        queryset = self.get_queryset()
+
+        if self.search_score is None:
+            queryset = queryset.order_by('grouping_id', 'id')
+        else:
+            queryset = queryset.order_by('-' + self.search_score, 'grouping_id', 'id')
+
+        rows = self.export_rows(queryset)
+
+        if output == 'tsv':
+            response = StreamingHttpResponse(
+                self.tsv_lines(rows),
+                content_type='text/tab-separated-values'
+            )
+            extension = 'tsv'
+        else:
+            response = StreamingHttpResponse(
+                self.ndjson_lines(rows),
+                content_type='application/x-ndjson'
+            )
+            extension = 'ndjson'
+
+        response['Content-Disposition'] = 'attachment; filename="mappings.{}"'.format(
+            extension
+        )
+
+        return response
+
+    def export_rows(self, queryset):
+        """
+        Yield the export fields of every mapping view in the queryset, with
+        the status and entry type descriptions rather than their ids
+        """
+        values = queryset.values_list(*self.export_fields).iterator(
+            chunk_size=self.chunk_size
+        )
+
+        status_index = self.export_fields.index('status')
+        entry_type_index = self.export_fields.index('entry_type')
+
+        # the rows are streamed after the request's memoisation context, the
+        # descriptions are resolved once rather than for every row
+        vocabularies = vocabulary.vocabularies()
+        statuses = vocabularies[vocabulary.STATUS][0]
+        entry_types = vocabularies[vocabulary.ENTRY_TYPE][0]
+
+        for row in values:
+            row = list(row)
+            row[status_index] = statuses.get(row[status_index])
+            row[entry_type_index] = entry_types.get(row[entry_type_index])
+
+            yield row
+
+    def ndjson_lines(self, rows):
+        encoder = DjangoJSONEncoder()
+
+        for row in rows:
+            yield encoder.encode(dict(zip(self.export_fields, row))) + '\n'
+
+    def tsv_lines(self, rows):
+        writer = csv.writer(Echo(), delimiter='\t', lineterminator='\n')
+
+        yield writer.writerow(self.export_fields)
+
+        for row in rows:
+            yield writer.writerow(
+                ['' if value is None else value for value in row]
+            )
@@ -18,6 +18,8 @@ from rest_framework import permissions
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
+from restui.lib import http_client
+from restui.lib import sequence_cache
 from restui.serializers.service import StatusSerializer, ServiceFlagSerializer
 
 
@@ -39,3 +41,23 @@ class ServiceStatus(APIView):
     def get(self, request):
         serializer = ServiceFlagSerializer()
         return Response(serializer.to_representation())
+
+
+class ExternalServicesMetrics(APIView):
+    """
+    Return the latency and error metrics of the calls this process made to
+    the external services (Ensembl REST, TaRK), per host
+    """
+
+    def get(self, request):
+        return Response(http_client.metrics())
+
+
+class SequenceCacheStats(APIView):
+    """
+    Return the hits and misses of the sequence cache lookups of this process,
+    with the number of entries cached
+    """
+
+    def get(self, request):
+        return Response(sequence_cache.stats())
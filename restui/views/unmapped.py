@@ -17,7 +17,6 @@
 
 from django.utils import timezone
 from django.http import Http404
-from django.core.exceptions import MultipleObjectsReturned
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
@@ -33,7 +32,6 @@ from restui.models.ensembl import EnsemblTranscript
 from restui.models.uniprot import UniprotEntry
 from restui.models.mappings import MappingView
 from restui.models.mappings import ReleaseMappingHistory
-from restui.models.annotations import CvUeStatus, CvUeLabel
 from restui.models.annotations import UeUnmappedEntryComment
 from restui.models.annotations import UeUnmappedEntryLabel
 from restui.models.annotations import UeUnmappedEntryStatus
@@ -48,6 +46,12 @@ from restui.serializers.annotations import UnmappedEntryLabelSerializer
 from restui.serializers.annotations import UnmappedEntryCommentSerializer
 from restui.serializers.annotations import UnmappedEntryStatusSerializer
 from restui.pagination import UnmappedEnsemblEntryPagination
+from restui.lib import vocabulary
+from restui.lib.cache import UNMAPPED_DETAIL
+from restui.lib.cache import cached_detail
+from restui.lib.cache import invalidate_details
+from restui.lib.cache import invalidate_facets
+from restui.lib.cache import invalidate_group_details
 from restui.lib.mail import GiftsEmail
 from django.conf import settings
 
@@ -81,6 +85,20 @@ class UnmappedDetailed(APIView):
     )
 
     def get(self, request, mapping_view_id):
+        data = cached_detail(
+            UNMAPPED_DETAIL,
+            mapping_view_id,
+            lambda: self.build_detail(mapping_view_id),
+            cacheable=lambda detail: 'error' not in detail
+        )
+
+        if 'error' in data:
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(data)
+
+    @staticmethod
+    def build_detail(mapping_view_id):
         try:
             mapping_view = MappingView.objects.get(pk=mapping_view_id)
         except MappingView.DoesNotExist:
@@ -91,10 +109,7 @@ class UnmappedDetailed(APIView):
                 mapping_view.uniprot_mapping_status == 'mapped' and
                 mapping_view.mapping_id is not None
         ):
-            return Response(
-                {"error":"Entry is mapped with id {}".format(mapping_view.mapping_id)},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+            return {"error":"Entry is mapped with id {}".format(mapping_view.mapping_id)}
 
         email_recipients_list = {
             recipient_id: recipient_details.get('name')
@@ -115,7 +130,7 @@ class UnmappedDetailed(APIView):
 
         serializer.data['entry']['status'] = MappingView.status_description(serializer.data['entry']['status'])
 
-        return Response(serializer.data)
+        return serializer.data
 
 
 class UnmappedEntries(APIView):
@@ -337,6 +352,7 @@ class AddDeleteLabel(APIView):
 
         if serializer.is_valid():
             serializer.save()
+            invalidate_details(UNMAPPED_DETAIL, mapping_view_id)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -352,6 +368,7 @@ class AddDeleteLabel(APIView):
         )
         if entry_labels:
             entry_labels.delete()
+            invalidate_details(UNMAPPED_DETAIL, mapping_view_id)
 
             return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -379,15 +396,14 @@ class GetLabels(APIView):
     def get(self, request, mapping_view_id):
         uniprot_entry = get_uniprot_entry(mapping_view_id)
 
-        all_labels = CvUeLabel.objects.all()
         entry_labels = uniprot_entry.labels.values_list('label', flat=True)
 
         label_map = []
-        for label in all_labels:
+        for label_id, label in vocabulary.terms(vocabulary.LABEL):
             label_map.append({
-                'label': label.description,
-                'id': label.id,
-                'status': label.id in entry_labels
+                'label': label,
+                'id': label_id,
+                'status': label_id in entry_labels
             })
 
         data = {'labels': label_map}
@@ -459,6 +475,7 @@ class AddGetComments(APIView):
 
         if serializer.is_valid():
             serializer.save()
+            invalidate_details(UNMAPPED_DETAIL, mapping_view_id)
 
             email = GiftsEmail(request)
             build_comments_email = email.build_unmapped_comments_email(mapping_view_id)
@@ -528,6 +545,7 @@ class EditDeleteComment(APIView):
             comment.comment = request.data['text']
             comment.time_stamp = timezone.now()
             comment.save()
+            invalidate_details(UNMAPPED_DETAIL, mapping_view_id)
 
         serializer = CommentSerializer({
             'commentId': comment.id,
@@ -552,6 +570,7 @@ class EditDeleteComment(APIView):
         else:
             comment.deleted = True
             comment.save()
+            invalidate_details(UNMAPPED_DETAIL, mapping_view_id)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -578,20 +597,16 @@ class StatusChange(APIView):
     def put(self, request, mapping_view_id):
         uniprot_entry = get_uniprot_entry(mapping_view_id)
 
-        # retrieve the status object associated to the given description
+        # retrieve the status id associated to the given description
         try:
-            s = CvUeStatus.objects.get(description=request.data['status'])
+            status_id = vocabulary.identity(vocabulary.STATUS, request.data['status'])
         except KeyError:
             raise Http404("Payload should have 'status'")
-        except CvUeStatus.DoesNotExist:
+
+        if status_id is None:
             raise Http404(
                 "Couldn't get status object for {}".format(request.data['status'])
             )
-        except MultipleObjectsReturned:
-            print("\nFAILED HERE MultipleObjectsReturned")
-            raise Http404(
-                "Couldn't get unique status for {}".format(request.data['status'])
-            )
 
         # If the entry has already been assigned that status, update the timestamp,
         # otherwise create one from scratch
@@ -605,7 +620,7 @@ class StatusChange(APIView):
             # It's alright, for the first status change the historic record won't exist.
             pass
         else:
-            if entry_status.status.id == s.id:
+            if entry_status.status_id == status_id:
                 # The user is trying to change it to what the status
                 # already is, nothing to do.
                 return Response(status=status.HTTP_204_NO_CONTENT)
@@ -615,7 +630,7 @@ class StatusChange(APIView):
             data={
                 'time_stamp': timezone.now(),
                 'user_stamp': request.user.pk,
-                'status': s.id,
+                'status': status_id,
                 'uniprot': uniprot_entry.uniprot_id
             }
         )
@@ -648,14 +663,27 @@ class StatusChange(APIView):
             )
         else:
             if map_view.status is not None:
-                prev_status = CvUeStatus.objects.get(id=map_view.status).description
+                prev_status = vocabulary.description(vocabulary.STATUS, map_view.status)
             else:
                 prev_status = 'No status'
-            map_view.status = s.id
+            map_view.status = status_id
             map_view.save()
 
+            # the status facet counts have changed, and so have the details
+            # of the entries related to this one
+            invalidate_facets()
+            invalidate_group_details(
+                map_view.grouping_id,
+                mapping_id=map_view.mapping_id,
+                mapping_view_id=map_view.id
+            )
+
         email = GiftsEmail(request)
-        build_status_change_email = email.build_unmapped_status_change_email(mapping_view_id, prev_status, s.description)
+        build_status_change_email = email.build_unmapped_status_change_email(
+            mapping_view_id,
+            prev_status,
+            vocabulary.description(vocabulary.STATUS, status_id)
+        )
         if build_status_change_email:
             email.send()
 
@@ -0,0 +1,28 @@
+--
+-- Unique indexes the bulk alignment load (alignments/alignment/bulk/) merges
+-- its rows on, with INSERT ... ON CONFLICT: one alignment per run and
+-- mapping, as AlignmentCreate ensures, and one cigar/mdz per alignment.
+--
+-- The duplicates left by concurrent loads are removed first, the earliest
+-- alignment being kept (their cigars go with the others, ON DELETE CASCADE).
+--
+-- CONCURRENTLY doesn't lock the tables against writes while building,
+-- it can't be run inside a transaction block.
+--
+
+DELETE FROM ensembl_gifts.alignment AS duplicate
+    USING ensembl_gifts.alignment AS kept
+    WHERE duplicate.alignment_run_id = kept.alignment_run_id
+    AND duplicate.mapping_id = kept.mapping_id
+    AND duplicate.alignment_id > kept.alignment_id;
+
+DELETE FROM ensembl_gifts.ensp_u_cigar AS duplicate
+    USING ensembl_gifts.ensp_u_cigar AS kept
+    WHERE duplicate.alignment_id = kept.alignment_id
+    AND duplicate.ctid > kept.ctid;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS alignment_run_mapping_uniq_idx
+    ON ensembl_gifts.alignment USING btree (alignment_run_id, mapping_id);
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ensp_u_cigar_alignment_uniq_idx
+    ON ensembl_gifts.ensp_u_cigar USING btree (alignment_id);
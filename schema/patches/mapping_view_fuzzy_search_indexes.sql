@@ -0,0 +1,21 @@
+--
+-- Trigram indexes serving the fuzzy gene symbol/name searches of the
+-- /mappings/ endpoint (searchMode=fuzzy), i.e. <column> % '<term>'
+-- (see MappingViewQuerySet.fuzzy_search).
+--
+-- CONCURRENTLY doesn't lock mapping_view against writes while building,
+-- it can't be run inside a transaction block.
+--
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS mapping_view_gene_name_trgm_idx
+    ON ensembl_gifts.mapping_view USING gin (gene_name public.gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS mapping_view_gene_symbol_eg_trgm_idx
+    ON ensembl_gifts.mapping_view USING gin (gene_symbol_eg public.gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS mapping_view_gene_symbol_up_trgm_idx
+    ON ensembl_gifts.mapping_view USING gin (gene_symbol_up public.gin_trgm_ops);
+
+ANALYZE ensembl_gifts.mapping_view;
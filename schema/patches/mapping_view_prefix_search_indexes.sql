@@ -0,0 +1,25 @@
+--
+-- Indexes serving the case insensitive prefix searches of the /mappings/
+-- endpoint, i.e. lower(<column>) LIKE '<term>%' (see
+-- MappingViewQuerySet.prefix_search).
+--
+-- text_pattern_ops is needed for LIKE prefix matches to use the index
+-- whatever the database collation.
+--
+-- CONCURRENTLY doesn't lock mapping_view against writes while building,
+-- it can't be run inside a transaction block.
+--
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS mapping_view_gene_name_lower_idx
+    ON ensembl_gifts.mapping_view USING btree (lower((gene_name)::text) text_pattern_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS mapping_view_gene_symbol_eg_lower_idx
+    ON ensembl_gifts.mapping_view USING btree (lower((gene_symbol_eg)::text) text_pattern_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS mapping_view_gene_symbol_up_lower_idx
+    ON ensembl_gifts.mapping_view USING btree (lower((gene_symbol_up)::text) text_pattern_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS mapping_view_uniprot_acc_lower_idx
+    ON ensembl_gifts.mapping_view USING btree (lower((uniprot_acc)::text) text_pattern_ops);
+
+ANALYZE ensembl_gifts.mapping_view;
@@ -38,6 +38,20 @@ CREATE EXTENSION IF NOT EXISTS plpgsql WITH SCHEMA pg_catalog;
 COMMENT ON EXTENSION plpgsql IS 'PL/pgSQL procedural language';
 
 
+--
+-- Name: pg_trgm; Type: EXTENSION; Schema: -; Owner: 
+--
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public;
+
+
+--
+-- Name: EXTENSION pg_trgm; Type: COMMENT; Schema: -; Owner: 
+--
+
+COMMENT ON EXTENSION pg_trgm IS 'text similarity measurement and index searching based on trigrams';
+
+
 --
 -- Name: on_mapping_insert_add_default_status(); Type: FUNCTION; Schema: ensembl_gifts; Owner: ensrw
 --
@@ -1433,6 +1447,13 @@ ALTER TABLE ONLY ensembl_gifts.uniprot_gene_accessions
     ADD CONSTRAINT uniprot_gene_accessions_pk PRIMARY KEY (gene_accession, uniprot_acc);
 
 
+--
+-- Name: alignment_run_mapping_uniq_idx; Type: INDEX; Schema: ensembl_gifts; Owner: ensrw
+--
+
+CREATE UNIQUE INDEX alignment_run_mapping_uniq_idx ON ensembl_gifts.alignment USING btree (alignment_run_id, mapping_id);
+
+
 --
 -- Name: ensembl_gifts_test100.aap_auth_aapuser_elixir_id_1626a210_like; Type: INDEX; Schema: ensembl_gifts; Owner: ensrw
 --
@@ -1440,6 +1461,13 @@ ALTER TABLE ONLY ensembl_gifts.uniprot_gene_accessions
 CREATE INDEX "ensembl_gifts_test100.aap_auth_aapuser_elixir_id_1626a210_like" ON ensembl_gifts.aap_auth_aapuser USING btree (elixir_id varchar_pattern_ops);
 
 
+--
+-- Name: ensp_u_cigar_alignment_uniq_idx; Type: INDEX; Schema: ensembl_gifts; Owner: ensrw
+--
+
+CREATE UNIQUE INDEX ensp_u_cigar_alignment_uniq_idx ON ensembl_gifts.ensp_u_cigar USING btree (alignment_id);
+
+
 --
 -- Name: idx_24996_alignment_run_id; Type: INDEX; Schema: ensembl_gifts; Owner: ensrw
 --
@@ -1573,6 +1601,48 @@ CREATE INDEX mapping_view_ensg_id_idx ON ensembl_gifts.mapping_view USING btree
 CREATE INDEX mapping_view_enst_id_idx ON ensembl_gifts.mapping_view USING btree (enst_id);
 
 
+--
+-- Name: mapping_view_gene_name_lower_idx; Type: INDEX; Schema: ensembl_gifts; Owner: ensrw
+--
+
+CREATE INDEX mapping_view_gene_name_lower_idx ON ensembl_gifts.mapping_view USING btree (lower((gene_name)::text) text_pattern_ops);
+
+
+--
+-- Name: mapping_view_gene_name_trgm_idx; Type: INDEX; Schema: ensembl_gifts; Owner: ensrw
+--
+
+CREATE INDEX mapping_view_gene_name_trgm_idx ON ensembl_gifts.mapping_view USING gin (gene_name public.gin_trgm_ops);
+
+
+--
+-- Name: mapping_view_gene_symbol_eg_lower_idx; Type: INDEX; Schema: ensembl_gifts; Owner: ensrw
+--
+
+CREATE INDEX mapping_view_gene_symbol_eg_lower_idx ON ensembl_gifts.mapping_view USING btree (lower((gene_symbol_eg)::text) text_pattern_ops);
+
+
+--
+-- Name: mapping_view_gene_symbol_eg_trgm_idx; Type: INDEX; Schema: ensembl_gifts; Owner: ensrw
+--
+
+CREATE INDEX mapping_view_gene_symbol_eg_trgm_idx ON ensembl_gifts.mapping_view USING gin (gene_symbol_eg public.gin_trgm_ops);
+
+
+--
+-- Name: mapping_view_gene_symbol_up_lower_idx; Type: INDEX; Schema: ensembl_gifts; Owner: ensrw
+--
+
+CREATE INDEX mapping_view_gene_symbol_up_lower_idx ON ensembl_gifts.mapping_view USING btree (lower((gene_symbol_up)::text) text_pattern_ops);
+
+
+--
+-- Name: mapping_view_gene_symbol_up_trgm_idx; Type: INDEX; Schema: ensembl_gifts; Owner: ensrw
+--
+
+CREATE INDEX mapping_view_gene_symbol_up_trgm_idx ON ensembl_gifts.mapping_view USING gin (gene_symbol_up public.gin_trgm_ops);
+
+
 --
 -- Name: mapping_view_grouping_id_idx; Type: INDEX; Schema: ensembl_gifts; Owner: ensrw
 --
@@ -1601,6 +1671,13 @@ CREATE INDEX mapping_view_release_mapping_history_id_idx ON ensembl_gifts.mappin
 CREATE INDEX mapping_view_uniprot_acc_idx ON ensembl_gifts.mapping_view USING btree (uniprot_acc);
 
 
+--
+-- Name: mapping_view_uniprot_acc_lower_idx; Type: INDEX; Schema: ensembl_gifts; Owner: ensrw
+--
+
+CREATE INDEX mapping_view_uniprot_acc_lower_idx ON ensembl_gifts.mapping_view USING btree (lower((uniprot_acc)::text) text_pattern_ops);
+
+
 --
 -- Name: mapping_view_uniprot_id_idx; Type: INDEX; Schema: ensembl_gifts; Owner: ensrw
 --